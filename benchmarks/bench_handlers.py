@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+'''Usage: bench_handlers.py [--calls=<n>] [--rounds=<n>] [--debug]
+
+Measure the per-request overhead of generated handlers, with and without
+"routegen --optimize". Each handler is called directly inside a Flask request
+context, so the numbers cover the handler itself (lookups, input assembly,
+negotiation, validation, the transform call and the response) but not WSGI or
+the network.
+
+Timings are noisy on a shared machine, so the best of several rounds is reported.
+The service is generated from data/good_sample_config.yaml, minus the per-transform
+features (caching, coalescing, admission control, timeouts and executor pools)
+which would otherwise dominate the measurement.
+
+Options:
+    --calls=<n>     calls per handler in each round [default: 20000]
+    --rounds=<n>    rounds, alternating between the two services; the best round counts [default: 7]
+    --debug         run the service with debug set (which logs every request's headers)
+'''
+
+import shutil
+import subprocess
+import sys
+import tempfile
+import docopt
+
+from bench_startup import build_project, generate_module, service_environment
+
+
+STANDARD_MODULE = 'bench_app'
+OPTIMIZED_MODULE = 'bench_optimized_app'
+FEATURE_SETTINGS = ['cache', 'coalesce', 'admission', 'timeout_ms', 'executor_pool']
+
+CASES = [
+    # (view function, path, method, JSON body)
+    ('ping', '/ping?id=1', 'GET', None),
+    ('post_target', '/posttest', 'POST', '{"placeholder": "value"}')
+]
+
+TIMING_SCRIPT = '''
+import time
+import %(standard)s as standard
+import %(optimized)s as optimized
+
+best = {}
+for round_number in range(%(rounds)d):
+    for variant, service in [('standard', standard), ('optimized', optimized)]:
+        app = service.app
+        for view_name, path, method, body in %(cases)r:
+            view = app.view_functions[view_name]
+            with app.test_request_context(path, method=method, data=body, content_type='application/json'):
+                view()
+                start = time.perf_counter()
+                for i in range(%(calls)d):
+                    view()
+                elapsed = (time.perf_counter() - start) / %(calls)d
+            key = (variant, view_name)
+            best[key] = min(elapsed, best.get(key, elapsed))
+
+for (variant, view_name), elapsed in best.items():
+    print('timing %%s %%s %%.9f' %% (variant, view_name, elapsed))
+'''
+
+
+def strip_features(debug):
+    def edit_config(yaml_config):
+        yaml_config['globals']['debug'] = debug
+        yaml_config['globals']['instrumentation'] = False
+        for transform_config in yaml_config['transforms'].values():
+            for setting in FEATURE_SETTINGS:
+                transform_config.pop(setting, None)
+    return edit_config
+
+
+def time_handlers(project_dir, config_filename, calls, rounds):
+    '''Time both services in one interpreter, alternating between them in each round.'''
+    script = TIMING_SCRIPT % {'standard': STANDARD_MODULE,
+                              'optimized': OPTIMIZED_MODULE,
+                              'cases': CASES,
+                              'calls': calls,
+                              'rounds': rounds}
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=project_dir,
+                                     env=service_environment(project_dir, config_filename),
+                                     stderr=subprocess.DEVNULL)
+    timings = {'standard': {}, 'optimized': {}}
+    for line in output.decode().splitlines():
+        # the services log to stdout as well
+        if line.startswith('timing '):
+            tag, variant, view_name, elapsed = line.split()
+            timings[variant][view_name] = float(elapsed)
+    return timings
+
+
+def main(args):
+    project_dir = tempfile.mkdtemp(prefix='snap_bench_')
+    try:
+        config_filename = build_project(project_dir, False, strip_features(args['--debug']))
+        generate_module(project_dir, config_filename, OPTIMIZED_MODULE, ['-p', '--optimize'])
+        timings = time_handlers(project_dir, config_filename, int(args['--calls']), int(args['--rounds']))
+        standard = timings['standard']
+        optimized = timings['optimized']
+
+        print('%-18s %12s %12s %9s' % ('handler', 'standard', 'optimized', 'speedup'))
+        for view_name, path, method, body in CASES:
+            print('%-18s %9.1f us %9.1f us %8.2fx' % ('%s %s' % (method, view_name),
+                                                      standard[view_name] * 1e6,
+                                                      optimized[view_name] * 1e6,
+                                                      standard[view_name] / optimized[view_name]))
+    finally:
+        shutil.rmtree(project_dir)
+
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+'''Usage: bench_rps.py [--calls=<n>] [--rounds=<n>] [--debug]
+
+Compare the requests per second of the Flask service generated by routegen with the
+native WSGI service ("routegen --target=wsgi"), with and without --optimize.
+
+Each app is called as a WSGI callable, in-process, with the same prepared environ,
+and its response body is read to the end. The numbers therefore cover routing, the
+request and response objects and the handler, but not an HTTP server or the network;
+behind gunicorn or uWSGI the server's own per-request cost adds to every column.
+
+Timings are noisy on a shared machine, so the best of several rounds is reported.
+The service is generated from data/good_sample_config.yaml, minus the per-transform
+features (caching, coalescing, admission control, timeouts and executor pools).
+
+Options:
+    --calls=<n>     requests per case in each round [default: 20000]
+    --rounds=<n>    rounds, alternating between the services; the best round counts [default: 5]
+    --debug         run the services with debug set (which logs every request's headers)
+'''
+
+import shutil
+import subprocess
+import sys
+import tempfile
+import docopt
+
+from bench_startup import build_project, generate_module, service_environment
+from bench_handlers import strip_features
+
+
+# (variant, module name, routegen arguments); build_project() generates bench_app itself
+SERVICES = [
+    ('flask', 'bench_app', None),
+    ('wsgi', 'bench_wsgi_app', ['-p', '--target=wsgi']),
+    ('wsgi-optimized', 'bench_optimized_wsgi_app', ['-p', '--target=wsgi', '--optimize'])
+]
+
+CASES = [
+    # (name, path, method, JSON body)
+    ('GET /ping', '/ping?id=1', 'GET', None),
+    ('POST /posttest', '/posttest', 'POST', '{"placeholder": "value"}')
+]
+
+TIMING_SCRIPT = '''
+import importlib
+import io
+import time
+from werkzeug.test import EnvironBuilder
+
+services = [(variant, importlib.import_module(module_name).app) for variant, module_name in %(services)r]
+
+def start_response(status, headers):
+    assert status.startswith('200'), status
+
+environs = []
+for name, path, method, body in %(cases)r:
+    builder = EnvironBuilder(path, method=method, data=body, content_type='application/json')
+    environ = builder.get_environ()
+    environs.append((name, environ, environ['wsgi.input'].read()))
+
+best = {}
+for round_number in range(%(rounds)d):
+    for variant, app in services:
+        for name, environ, body in environs:
+            start = time.perf_counter()
+            for i in range(%(calls)d):
+                request_environ = dict(environ)
+                request_environ['wsgi.input'] = io.BytesIO(body)
+                for chunk in app(request_environ, start_response):
+                    pass
+            elapsed = time.perf_counter() - start
+            key = (variant, name)
+            best[key] = min(elapsed, best.get(key, elapsed))
+
+for (variant, name), elapsed in best.items():
+    print('timing %%s %%s %%.9f' %% (variant, name.replace(' ', '_'), %(calls)d / elapsed))
+'''
+
+
+def measure_rps(project_dir, config_filename, calls, rounds):
+    '''Time all services in one interpreter, alternating between them in each round.'''
+    script = TIMING_SCRIPT % {'services': [(variant, module_name) for variant, module_name, routegen_args in SERVICES],
+                              'cases': CASES,
+                              'calls': calls,
+                              'rounds': rounds}
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=project_dir,
+                                     env=service_environment(project_dir, config_filename),
+                                     stderr=subprocess.DEVNULL)
+    rps = {}
+    for line in output.decode().splitlines():
+        # the services log to stdout as well
+        if line.startswith('timing '):
+            tag, variant, name, requests_per_second = line.split()
+            rps[(variant, name.replace('_', ' '))] = float(requests_per_second)
+    return rps
+
+
+def main(args):
+    project_dir = tempfile.mkdtemp(prefix='snap_bench_')
+    try:
+        config_filename = build_project(project_dir, False, strip_features(args['--debug']))
+        for variant, module_name, routegen_args in SERVICES:
+            if routegen_args:
+                generate_module(project_dir, config_filename, module_name, routegen_args)
+        rps = measure_rps(project_dir, config_filename, int(args['--calls']), int(args['--rounds']))
+
+        variants = [variant for variant, module_name, routegen_args in SERVICES]
+        print('%-16s' % 'req/s' + ''.join('%16s' % variant for variant in variants) + '%17s' % 'optimized/flask')
+        for name, path, method, body in CASES:
+            print('%-16s' % name
+                  + ''.join('%16.0f' % rps[(variant, name)] for variant in variants)
+                  + '%16.2fx' % (rps[('wsgi-optimized', name)] / rps[('flask', name)]))
+    finally:
+        shutil.rmtree(project_dir)
+
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
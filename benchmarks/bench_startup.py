@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+'''Usage: bench_startup.py [--runs=<n>] [--route=<route>] [--target=<runtime>...] [--logfile]
+
+Measure worker startup time: importing a generated snap service module (which runs
+snap.setup) and serving its first request, each in a fresh interpreter. Each runtime
+target is timed separately, and the report shows which web frameworks the worker
+loaded: the native WSGI and ASGI runtimes should load neither Flask nor Jinja2.
+
+The services are generated with routegen from data/good_sample_config.yaml into a
+temporary project directory.
+
+Options:
+    --runs=<n>          number of fresh-interpreter startups to time [default: 10]
+    --route=<route>     GET route to request once the service is up [default: /ping]
+    --target=<runtime>  runtime to time: flask, wsgi or asgi (repeatable; default: all three)
+    --logfile           keep the logfile setting (by default the service logs to the console only)
+'''
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import docopt
+import yaml
+
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVICE_MODULE = 'bench_app'
+TARGETS = ['flask', 'wsgi', 'asgi']
+
+STARTUP_SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import %(module)s as service
+imported = time.perf_counter()
+%(first_request)s
+done = time.perf_counter()
+frameworks = [name for name in ('flask', 'jinja2') if name in sys.modules]
+print('%%f %%f %%s' %% (imported - start, done - start, ','.join(frameworks) or '-'))
+'''
+
+# serve one GET request, the way each runtime's server would call the app
+FIRST_REQUEST = {
+    'flask': '''
+response = service.app.test_client().get('%(route)s')
+assert response.status_code == 200, response.status_code
+''',
+    'wsgi': '''
+import io
+started = []
+environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '%(route)s', 'QUERY_STRING': '', 'wsgi.input': io.BytesIO(b'')}
+b''.join(service.app(environ, lambda status, headers: started.append(status)))
+assert started[0].startswith('200'), started[0]
+''',
+    'asgi': '''
+import asyncio
+sent = []
+async def receive():
+    return {'type': 'http.request', 'body': b'', 'more_body': False}
+async def send(message):
+    sent.append(message)
+scope = {'type': 'http', 'method': 'GET', 'path': '%(route)s', 'query_string': b'', 'headers': []}
+asyncio.run(service.app(scope, receive, send))
+assert sent[0]['status'] == 200, sent[0]['status']
+'''
+}
+
+
+def build_project(project_dir, keep_logfile, edit_config=None):
+    tests_dir = os.path.join(PROJECT_HOME, 'tests')
+    for module_name in ['testbed_services', 'testbed_decode', 'testbed_validate']:
+        shutil.copy(os.path.join(tests_dir, '%s.py' % module_name), project_dir)
+    shutil.copy(os.path.join(tests_dir, 'testbed_transforms.py.tpl'),
+                os.path.join(project_dir, 'testbed_transforms.py'))
+
+    with open(os.path.join(PROJECT_HOME, 'data', 'good_sample_config.yaml')) as f:
+        yaml_config = yaml.safe_load(f)
+    yaml_config['globals']['project_directory'] = project_dir
+    if not keep_logfile:
+        del yaml_config['globals']['logfile']
+    if edit_config:
+        edit_config(yaml_config)
+
+    config_filename = os.path.join(project_dir, 'bench_config.yaml')
+    with open(config_filename, 'w') as f:
+        yaml.safe_dump(yaml_config, f)
+
+    # extend mode adds stubs for the transforms the testbed module doesn't define
+    generate_module(project_dir, config_filename, SERVICE_MODULE, ['-e'])
+    return config_filename
+
+
+def generate_module(project_dir, config_filename, module_name, routegen_args):
+    app_code = subprocess.check_output([sys.executable, os.path.join(PROJECT_HOME, 'scripts', 'routegen')]
+                                       + routegen_args + [config_filename],
+                                       cwd=project_dir,
+                                       env=service_environment(project_dir, config_filename))
+    # routegen logs to stdout; the generated module starts at its shebang line
+    app_code = app_code[app_code.index(b'#!/usr/bin/env python'):]
+    with open(os.path.join(project_dir, '%s.py' % module_name), 'wb') as f:
+        f.write(app_code)
+
+
+def service_environment(project_dir, config_filename):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([PROJECT_HOME, project_dir])
+    env['SNAP_CONFIG'] = config_filename
+    return env
+
+
+def time_startup(project_dir, env, module_name, target, route, runs):
+    script = STARTUP_SCRIPT % {'module': module_name,
+                               'first_request': FIRST_REQUEST[target] % {'route': route}}
+    import_times = []
+    first_request_times = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=project_dir, env=env)
+        import_time, first_request_time, frameworks = output.decode().strip().splitlines()[-1].split()
+        import_times.append(float(import_time))
+        first_request_times.append(float(first_request_time))
+
+    print('%s runtime (frameworks loaded: %s)' % (target, frameworks.replace(',', ', ')))
+    print('  import + setup:         median %.1f ms, best %.1f ms' % (statistics.median(import_times) * 1000,
+                                                                      min(import_times) * 1000))
+    print('  through first request:  median %.1f ms, best %.1f ms' % (statistics.median(first_request_times) * 1000,
+                                                                      min(first_request_times) * 1000))
+
+
+def main(args):
+    runs = int(args['--runs'])
+    targets = args['--target'] or TARGETS
+    for target in targets:
+        if target not in TARGETS:
+            print('Unknown target "%s"; choose from %s.' % (target, ', '.join(TARGETS)))
+            exit(1)
+
+    project_dir = tempfile.mkdtemp(prefix='snap_bench_')
+    try:
+        config_filename = build_project(project_dir, args['--logfile'])
+        env = service_environment(project_dir, config_filename)
+        for target in targets:
+            module_name = SERVICE_MODULE
+            if target != 'flask':
+                module_name = '%s_%s' % (SERVICE_MODULE, target)
+                generate_module(project_dir, config_filename, module_name, ['-p', '--target=%s' % target])
+            time_startup(project_dir, env, module_name, target, args['--route'], runs)
+
+        written = sorted(set(os.listdir(project_dir)) - {'__pycache__'})
+        print('files in project directory after startup: %s' % ', '.join(written))
+    finally:
+        shutil.rmtree(project_dir)
+
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+'''Usage: bench_validation.py [--fields=<n>] [--iterations=<n>]
+
+Compare the two-pass InputShape validation path (scan + validate_data_format)
+with the compiled single-pass validator used by Action.execute.
+
+Options:
+    --fields=<n>        number of fields in the benchmark shape [default: 32]
+    --iterations=<n>    number of validations per timing run [default: 20000]
+'''
+
+import os
+import sys
+import timeit
+import docopt
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from snap import core
+
+
+FIELD_TYPES = [('string', 'value'), ('int', '42'), ('float', '3.14'), ('bool', 'true'), ('list', [1, 2])]
+
+
+def build_shape(num_fields):
+    shape = core.InputShape('bench_shape')
+    record = {}
+    for i in range(num_fields):
+        datatype, sample_value = FIELD_TYPES[i % len(FIELD_TYPES)]
+        field_name = 'field_%d' % i
+        shape.add_field(field_name, datatype, i % 2 == 0)
+        record[field_name] = sample_value
+    return shape, record
+
+
+def two_pass(shape, record):
+    errors = shape.scan(record)
+    if len(errors):
+        raise core.MissingInputFieldException(errors)
+    format_errors = shape.validate_data_format(record)
+    if len(format_errors):
+        raise core.NonCompliantDataFormat(format_errors)
+
+
+def single_pass(shape, record):
+    shape.compile().validate(record)
+
+
+def main(args):
+    num_fields = int(args['--fields'])
+    iterations = int(args['--iterations'])
+    shape, record = build_shape(num_fields)
+
+    results = {}
+    for label, func in [('two-pass', two_pass), ('compiled', single_pass)]:
+        timer = timeit.Timer(lambda: func(shape, record))
+        best = min(timer.repeat(repeat=5, number=iterations))
+        results[label] = best
+        print('%-10s %d fields: %.2f usec per validation' % (label, num_fields, best / iterations * 1e6))
+
+    print('speedup: %.2fx' % (results['two-pass'] / results['compiled']))
+
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
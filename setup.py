@@ -25,6 +25,15 @@ DEPENDENCIES=['docopt',
               'Werkzeug',
               'requests']
 
+# optional, faster JSON codecs (selected with the json_codec global setting)
+# and libraries for the binary wire formats (application/msgpack, application/cbor)
+EXTRA_DEPENDENCIES = {
+    'orjson': ['orjson'],
+    'ujson': ['ujson'],
+    'msgpack': ['msgpack'],
+    'cbor': ['cbor2']
+}
+
 def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
@@ -35,9 +44,10 @@ setup(
     author='Dexter Taylor',
     author_email='binarymachineshop@gmail.com',
     platforms=['any'],
-    scripts=['scripts/routegen', 'scripts/uwsgen', 'scripts/snapconfig', 'scripts/snap-version'],
+    scripts=['scripts/routegen', 'scripts/uwsgen', 'scripts/snapconfig', 'scripts/snap-version', 'scripts/snap'],
     packages=find_packages(),
     install_requires=DEPENDENCIES,
+    extras_require=EXTRA_DEPENDENCIES,
     include_package_data=True,
     test_suite='tests',
     description=('Small Network Applications in Python: a microservices toolkit'),
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+#
+# Admission control and load shedding for transforms.
+#
+# Each controlled transform gets a concurrency limit and an optional bounded wait
+# queue. A request which can neither run nor wait is shed: the generated handler
+# answers 503 with a Retry-After header before it decodes the request body, so an
+# overloaded transform costs almost nothing to refuse and the other transforms in
+# the service keep their capacity.
+#
+# With a target latency set, the limit adapts (AIMD): every request completing
+# within the target while the limit is in use raises it by 1/limit (about +1 per
+# round of requests); a slower one multiplies it by the backoff factor.
+#
+
+
+import threading
+import time
+
+
+DEFAULT_RETRY_AFTER = 1
+DEFAULT_BACKOFF = 0.9
+
+
+class InvalidAdmissionSettingsException(Exception):
+    def __init__(self, reason):
+        Exception.__init__(self, 'Invalid admission control settings: %s' % reason)
+
+
+class Permit(object):
+    '''The right to run one request. Release it when the request is done.'''
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.started_at = time.monotonic()
+        self.released = False
+        self.held_by_stream = False
+
+    def release(self):
+        if not self.held_by_stream:
+            self._release()
+
+    def release_after(self, stream):
+        '''Hand the permit over to a streamed response body. A streaming transform keeps
+        running while its output is sent, so the permit is released (and the latency
+        recorded) when the stream is exhausted or closed; release() becomes a no-op.
+        '''
+        self.held_by_stream = True
+        if hasattr(stream, '__anext__'):
+            return AsyncPermitStream(stream, self._release)
+        return PermitStream(stream, self._release)
+
+    def _release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(time.monotonic() - self.started_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+
+class PermitStream(object):
+    '''An iterator over a streamed response body which calls release once the body is
+    exhausted, fails or is closed (a server closes the body when the client goes away,
+    possibly before the first chunk is read).
+    '''
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.stream, 'close'):
+                self.stream.close()
+        finally:
+            self.release()
+
+
+
+class AsyncPermitStream(object):
+    '''The async iterator counterpart of PermitStream.'''
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self.stream, 'aclose'):
+                await self.stream.aclose()
+        finally:
+            self.release()
+
+
+
+class NullPermit(object):
+    def release(self):
+        pass
+
+    def release_after(self, stream):
+        return stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_PERMIT = NullPermit()
+
+
+class AdmissionController(object):
+    def __init__(self,
+                 max_concurrency,
+                 max_queue=0,
+                 queue_timeout_ms=None,
+                 target_latency_ms=None,
+                 min_concurrency=1,
+                 backoff=DEFAULT_BACKOFF,
+                 retry_after=DEFAULT_RETRY_AFTER):
+
+        if not max_concurrency or max_concurrency < 1:
+            raise InvalidAdmissionSettingsException('max_concurrency must be at least 1.')
+        if min_concurrency < 1 or min_concurrency > max_concurrency:
+            raise InvalidAdmissionSettingsException('min_concurrency must be between 1 and max_concurrency.')
+        if not 0 < backoff < 1:
+            raise InvalidAdmissionSettingsException('backoff must be between 0 and 1.')
+
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_queue = max_queue or 0
+        self.queue_timeout = queue_timeout_ms / 1000.0 if queue_timeout_ms else None
+        self.target_latency = target_latency_ms / 1000.0 if target_latency_ms else None
+        self.backoff = backoff
+        self.retry_after = str(retry_after)
+        # the adaptive limit starts wide open; only observed latency brings it down
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+
+    @property
+    def adaptive(self):
+        return self.target_latency is not None
+
+
+    def try_acquire(self, block=True):
+        '''Return a Permit, or None if the request should be shed. A request which finds the
+        transform at its limit waits in the queue (for up to queue_timeout_ms) if there is
+        room and block is True; callers on an event loop must pass block=False.
+        '''
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                return self._admit()
+            if not block or self.waiting >= self.max_queue:
+                self.shed += 1
+                return None
+
+            self.waiting += 1
+            try:
+                deadline = None if self.queue_timeout is None else time.monotonic() + self.queue_timeout
+                while self.in_flight >= int(self.limit):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.shed += 1
+                        return None
+                    self._condition.wait(remaining)
+                return self._admit()
+            finally:
+                self.waiting -= 1
+
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+        return Permit(self)
+
+
+    def release(self, latency):
+        with self._condition:
+            at_limit = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if self.adaptive:
+                if latency > self.target_latency:
+                    self.limit = max(float(self.min_concurrency), self.limit * self.backoff)
+                elif at_limit:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._condition.notify()
+
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'waiting': self.waiting,
+                    'admitted': self.admitted,
+                    'shed': self.shed}
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+#
+# Minimal ASGI application container for generated snap services
+# (routegen --target=asgi)
+#
+
+
+import asyncio
+import io
+import json
+import os
+from snap import runtime
+from snap.loggers import request_logger as log
+
+
+END_OF_STREAM = object()
+
+
+def running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class ReceiveStream(io.RawIOBase):
+    '''The body of an ASGI request as a file-like object, for readers on a worker thread
+    (such as a streaming transform on the executor). Each chunk is received from the
+    event loop when the reader gets to it, so the body is never held in memory at once.
+    '''
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.chunk = b''
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk and self.more_body:
+            if running_loop() is self.loop:
+                # waiting here for the event loop would deadlock it
+                raise RuntimeError('a streamed request body cannot be read on the event loop thread.')
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            self.chunk = message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+class ASGIRequest(runtime.Request):
+    '''A runtime.Request whose body is only received from the server when it is asked for,
+    so that a request can be shed (by admission control, say) without waiting for its body.
+    The handler awaits load_body() before decoding the whole body on the event loop;
+    a streaming decoder reads it from the stream instead, chunk by chunk, on a worker thread.
+    '''
+
+    def __init__(self, method, path, query_string, headers, receive):
+        runtime.Request.__init__(self, method, path, query_string, headers, body=None)
+        self.receive = receive
+        self.loop = asyncio.get_running_loop()
+
+    @property
+    def data(self):
+        if self._data is None:
+            raise RuntimeError('the request body has not been received; await load_body() first.')
+        return self._data
+
+    @property
+    def stream(self):
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        # once the body has been streamed, it cannot be read again through data
+        self._data = b''
+        return io.BufferedReader(ReceiveStream(self.receive, self.loop))
+
+    async def load_body(self):
+        if self._data is None:
+            chunks = []
+            while True:
+                message = await self.receive()
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            self._data = b''.join(chunks)
+        return self._data
+
+
+class ASGIApplication(object):
+    '''Exposes the attributes snap.setup() expects of a Flask app (config, debug,
+    instance_path) and dispatches ASGI http requests to async handler functions
+    registered with the route() decorator.
+    '''
+
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self.config = {}
+        self.debug = False
+        self.instance_path = os.path.join(os.getcwd(), 'instance')
+        self.routes = runtime.RouteTable()
+
+
+    def route(self, rule, methods=None):
+        def decorator(handler):
+            self.routes.add(rule, methods or ['GET'], handler)
+            return handler
+        return decorator
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                services = self.config.get('services')
+                if services is not None:
+                    services.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+    async def handle_http(self, scope, receive, send):
+        headers = runtime.Headers((name.decode('latin-1'), value.decode('latin-1'))
+                                  for name, value in scope.get('headers', []))
+        request = ASGIRequest(scope['method'],
+                              scope['path'],
+                              scope.get('query_string', b'').decode('latin-1'),
+                              headers,
+                              receive)
+        try:
+            handler, route_vars = self.routes.match(request.method, request.path)
+            response = await handler(request, **route_vars)
+
+        except runtime.NoSuchRouteException as err:
+            response = runtime.Response(json.dumps({'error_message': str(err)}), status=404, mimetype='application/json')
+
+        except runtime.MethodNotAllowedException as err:
+            response = runtime.Response(json.dumps({'error_message': str(err)}), status=405, mimetype='application/json')
+
+        except Exception:
+            log.error('Exception thrown: ', exc_info=True)
+            response = runtime.Response(b'', status=500)
+
+        await self.send_response(response, send)
+
+
+    async def send_response(self, response, send):
+        await send({'type': 'http.response.start',
+                    'status': response.status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response.header_list()]})
+        if not response.is_streaming:
+            await send({'type': 'http.response.body', 'body': response.body})
+            return
+
+        # send each chunk as it is produced; synchronous iterators are advanced on
+        # a worker thread so that a slow generator doesn't block the event loop
+        try:
+            if hasattr(response.body, '__anext__'):
+                async for chunk in response.body:
+                    await send({'type': 'http.response.body', 'body': runtime.encode_chunk(chunk), 'more_body': True})
+            else:
+                loop = asyncio.get_running_loop()
+                while True:
+                    chunk = await loop.run_in_executor(None, next, response.body, END_OF_STREAM)
+                    if chunk is END_OF_STREAM:
+                        break
+                    await send({'type': 'http.response.body', 'body': runtime.encode_chunk(chunk), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # close the body even if the client went away part way through, so that
+            # whatever it holds (such as an admission permit) is released
+            if hasattr(response.body, 'aclose'):
+                await response.body.aclose()
+            elif hasattr(response.body, 'close'):
+                response.body.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+#
+# In-process response cache for GET transforms
+#
+
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class CacheEntry(object):
+    def __init__(self, body, expires_at):
+        self.body = body
+        self.expires_at = expires_at
+        encoded_body = body.encode() if isinstance(body, str) else body
+        self.etag = '"%s"' % hashlib.sha1(encoded_body).hexdigest()
+
+
+    @property
+    def headers(self):
+        '''Response headers for this entry. max-age is the time the entry has left, so that
+        clients don't go on using a response after this cache has dropped it.
+        '''
+        max_age = max(0, int(self.expires_at - time.monotonic()))
+        return {'ETag': self.etag, 'Cache-Control': 'max-age=%d' % max_age}
+
+
+    def matches(self, if_none_match):
+        '''Return True if the value of an If-None-Match request header names this entry.'''
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == self.etag:
+                return True
+        return False
+
+
+
+class ResponseCache(object):
+    '''LRU cache of transform output with a per-entry time-to-live.
+
+    Entries are keyed on the values of key_fields in the transform's input data
+    (or on all of the input data, if no key fields are given).
+    '''
+
+    def __init__(self, ttl, max_entries=None, key_fields=None):
+        self.ttl = ttl
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self.key_fields = tuple(key_fields) if key_fields else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def key_for(self, input_data, variant=None):
+        '''The variant (e.g. the negotiated output mimetype) keeps differently-encoded
+        responses to the same input apart.
+        '''
+        if self.key_fields is not None:
+            key = tuple(str(input_data.get(f)) for f in self.key_fields)
+        else:
+            key = tuple(sorted((k, str(v)) for k, v in input_data.items()))
+        return key if variant is None else (variant,) + key
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+
+    def put(self, key, body):
+        # only fully-built response bodies can be cached
+        if not isinstance(body, (str, bytes)):
+            return None
+
+        entry = CacheEntry(body, time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 
-import yaml
 import os
-import jinja2
+import contextlib
+import queue
+import threading
+import time
 from os.path import expanduser
 import json
 '''
@@ -19,6 +21,27 @@ class UnregisteredServiceObjectException(Exception):
         Exception.__init__(self, 'No ServiceObject registered under the alias "%s".' % alias)
 
 
+class ServiceObjectPoolExhaustedException(Exception):
+    def __init__(self, alias, timeout):
+        Exception.__init__(self, 'No instance of the pooled ServiceObject "%s" became available within %s seconds.'
+                           % (alias, timeout))
+
+
+class PooledServiceObjectLookupException(Exception):
+    def __init__(self, alias):
+        Exception.__init__(self, 'The ServiceObject "%s" is pooled; use checkout() instead of lookup().' % alias)
+
+
+class UnknownServiceDependencyException(Exception):
+    def __init__(self, alias, dependency):
+        Exception.__init__(self, 'The ServiceObject "%s" depends on "%s", which is not configured.' % (alias, dependency))
+
+
+class CircularServiceDependencyException(Exception):
+    def __init__(self, *aliases):
+        Exception.__init__(self, 'Circular dependency among the ServiceObjects: %s' % ', '.join(aliases))
+
+
 class MissingEnvironmentVarException(Exception):
     def __init__(self, env_var):
         Exception.__init__(self, 'The following environment variables have not been set: %s' % env_var)
@@ -41,6 +64,7 @@ def read_config_file(filename):
     '''Load a YAML initfile by name, returning a dictionary of its contents
 
     '''
+    import yaml
     config = None
     with open(filename, 'r') as filehandle:
         config = yaml.safe_load(filehandle)
@@ -104,6 +128,7 @@ class JinjaTemplateManager(object):
 
 
 def get_template_mgr_for_location(directory):
+    import jinja2
     j2env = jinja2.Environment(loader=jinja2.FileSystemLoader(directory))
     return JinjaTemplateManager(j2env)
 
@@ -194,14 +219,275 @@ class KeywordArgReader(object):
         return self.values.get(name)
 
 
-class ServiceObjectRegistry():
-    def __init__(self, service_object_dictionary):
-        self.services = service_object_dictionary
+class ServiceObjectPool(object):
+    '''A bounded pool of instances of one service object, for clients which are not
+    thread-safe. Instances are handed out one caller at a time by checkout().
+    '''
 
+    def __init__(self, alias, factory, size, timeout=None):
+        self.alias = alias
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        for i in range(size):
+            self._idle.put(factory())
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_in_use = 0
+        self.closed = False
 
-    def lookup(self, service_object_name):
+
+    @property
+    def in_use(self):
+        return self.size - self._idle.qsize()
+
+
+    def acquire(self, timeout=None):
+        '''Take an instance from the pool, waiting up to timeout seconds (the pool's
+        default if not given; None waits indefinitely) for one to be checked in.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            instance = self._idle.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            try:
+                instance = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.waits += 1
+                    self.timeouts += 1
+                raise ServiceObjectPoolExhaustedException(self.alias, timeout)
+            with self._lock:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+
+        with self._lock:
+            self.checkouts += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return instance
+
+
+    def release(self, instance):
+        if self.closed:
+            close_service_object(instance)
+            return
+        self._idle.put(instance)
+
+
+    def close(self):
+        '''Close the idle instances now; instances still checked out are closed when released.'''
+        self.closed = True
+        while True:
+            try:
+                close_service_object(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        instance = self.acquire(timeout)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+
+    def stats(self):
+        return {'size': self.size,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time_ms': self.wait_time * 1000}
+
+
+
+def close_service_object(sobj):
+    close_function = getattr(sobj, 'close', None)
+    if callable(close_function):
+        close_function()
+
+
+
+class ServiceObjectSpec(object):
+    '''How to build one configured service object: a single instance, or a pool of
+    instances if pool_size is set.
+    '''
+
+    def __init__(self, alias, factory, **kwargs):
+        self.alias = alias
+        self.factory = factory
+        self.pool_size = kwargs.get('pool_size')
+        self.pool_timeout = kwargs.get('pool_timeout')
+        self.lazy = kwargs.get('lazy', False)
+        self.depends_on = list(kwargs.get('depends_on') or [])
+        # a fork-safe service holds no per-process resources, so forked workers may share it
+        self.fork_safe = kwargs.get('fork_safe', False)
+
+
+    def build(self):
+        if self.pool_size:
+            return ServiceObjectPool(self.alias, self.factory, int(self.pool_size), timeout=self.pool_timeout)
+        return self.factory()
+
+
+
+class LazyServiceObject(object):
+    '''Stands in for a service object until its first lookup, which builds it
+    (after its dependencies) exactly once.
+    '''
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._instance = None
+        self._lock = threading.Lock()
+
+
+    def resolve(self, registry):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    for dependency in self.spec.depends_on:
+                        registry.resolve(dependency)
+                    self._instance = self.spec.build()
+        return self._instance
+
+
+
+def dependency_levels(service_specs):
+    '''Group service object specs into levels: every service depends only on services
+    in earlier levels, so the members of one level can be built concurrently.
+    '''
+    remaining = {}
+    for alias, spec in service_specs.items():
+        for dependency in spec.depends_on:
+            if dependency not in service_specs:
+                raise UnknownServiceDependencyException(alias, dependency)
+        remaining[alias] = set(spec.depends_on)
+
+    levels = []
+    while remaining:
+        level = [alias for alias, dependencies in remaining.items() if not dependencies]
+        if not level:
+            raise CircularServiceDependencyException(*sorted(remaining.keys()))
+        for alias in level:
+            del remaining[alias]
+        for dependencies in remaining.values():
+            dependencies.difference_update(level)
+        levels.append(level)
+    return levels
+
+
+def eager_service_names(service_specs):
+    '''Services not marked lazy, plus everything they (transitively) depend on.'''
+    eager = set()
+    pending = [alias for alias, spec in service_specs.items() if not spec.lazy]
+    while pending:
+        alias = pending.pop()
+        if alias not in eager:
+            eager.add(alias)
+            pending.extend(service_specs[alias].depends_on)
+    return eager
+
+
+
+class ServiceObjectRegistry():
+    def __init__(self, service_object_dictionary, service_specs=None):
+        self.services = service_object_dictionary
+        self.service_specs = service_specs or {}
+        self.pid = os.getpid()
+        self.closed = False
+        self._lifecycle_lock = threading.RLock()
+
+
+    def after_fork(self):
+        '''Re-initialize the registry in a forked worker. Service objects inherited from the
+        parent process are not closed (that would close the parent's connections); instead
+        each one is replaced by a lazy placeholder, so the worker builds its own on first use.
+        Services configured as fork_safe are kept and shared copy-on-write; services which
+        define an after_fork() method are asked to re-initialize themselves.
+        '''
+        with self._lifecycle_lock:
+            if self.pid == os.getpid():
+                return
+            for name, sobj in list(self.services.items()):
+                if isinstance(sobj, LazyServiceObject):
+                    self.services[name] = LazyServiceObject(sobj.spec)
+                    continue
+                spec = self.service_specs.get(name)
+                if spec is not None and spec.fork_safe:
+                    continue
+                hook = getattr(sobj, 'after_fork', None)
+                if callable(hook):
+                    hook()
+                elif spec is not None:
+                    self.services[name] = LazyServiceObject(spec)
+            self.pid = os.getpid()
+
+
+    def close(self):
+        '''Close every service object this process has built (calling its close() method,
+        if it has one), dependents before their dependencies. Safe to call more than once.
+        '''
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self._lifecycle_lock:
+            if self.closed:
+                return
+            self.closed = True
+            names = list(self.services.keys())
+            if self.service_specs:
+                names = [name for level in dependency_levels(self.service_specs) for name in level]
+            for name in reversed(names):
+                sobj = self.services.get(name)
+                if sobj is None or isinstance(sobj, LazyServiceObject):
+                    continue
+                close_service_object(sobj)
+
+
+    def resolve(self, service_object_name):
+        '''Return the service object (or pool) registered under the name, building it
+        first if it was configured as lazy or this process was forked since it was built.
+        '''
+        if self.pid != os.getpid():
+            self.after_fork()
         sobj = self.services.get(service_object_name)
         if not sobj:
             raise UnregisteredServiceObjectException(service_object_name)
+        if isinstance(sobj, LazyServiceObject):
+            sobj = sobj.resolve(self)
+            self.services[service_object_name] = sobj
+        return sobj
+
+
+    def lookup(self, service_object_name):
+        sobj = self.resolve(service_object_name)
+        if isinstance(sobj, ServiceObjectPool):
+            raise PooledServiceObjectLookupException(service_object_name)
         return sobj
 
+
+    @contextlib.contextmanager
+    def checkout(self, service_object_name, timeout=None):
+        '''Use a service object for the duration of a with-block. Pooled service objects
+        are returned to their pool on exit; unpooled ones are simply shared.
+        '''
+        sobj = self.resolve(service_object_name)
+        if not isinstance(sobj, ServiceObjectPool):
+            yield sobj
+            return
+        with sobj.checkout(timeout) as instance:
+            yield instance
+
+
+    def pool_stats(self):
+        '''Return {service object name: pool statistics} for every pooled service object.'''
+        return {name: sobj.stats() for name, sobj in self.services.items()
+                if isinstance(sobj, ServiceObjectPool)}
+
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+#
+# Request coalescing ("single-flight") for transforms.
+#
+# When identical calls overlap, the first one (the leader) does the work and the
+# others (followers) wait for its result instead of repeating it. Nothing outlives
+# the call: once the leader finishes, the next identical call starts a new flight,
+# so coalescing never serves stale data. A follower waits no longer than the timeout
+# it passes in (the time left before its own deadline).
+#
+
+
+import asyncio
+import threading
+
+
+def coalescing_key(input_data):
+    # repr() keeps 1 and '1' apart, and works for unhashable values such as lists
+    return tuple(sorted((key, repr(value)) for key, value in input_data.items()))
+
+
+class FlightTimeoutException(Exception):
+    def __init__(self, timeout):
+        Exception.__init__(self, 'Gave up waiting for a shared call after %.3f seconds.' % timeout)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+
+class SingleFlight(object):
+    '''Shares one execution among concurrent calls with the same key. Works from threads
+    (do) and from coroutines on an event loop (do_async).
+    '''
+
+    def __init__(self):
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.shared = 0
+
+
+    def do(self, key, func, *args, timeout=None, **kwargs):
+        '''Call func(*args, **kwargs), unless an identical call is already running; in that
+        case, wait for it (for up to timeout seconds, if given) and share its result (or its
+        exception). Returns a (result, shared) tuple.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            if not flight.done.wait(timeout):
+                raise FlightTimeoutException(timeout)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self.executions += 1
+            flight.done.set()
+        return flight.result, False
+
+
+    async def do_async(self, key, coroutine_func, *args, timeout=None, **kwargs):
+        '''Coroutine counterpart to do(). The shared work runs as its own task, so a
+        cancelled leader (or a follower which times out) does not cancel the others' result.
+        '''
+        task = self._async_flights.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(coroutine_func(*args, **kwargs))
+            self._async_flights[key] = task
+            task.add_done_callback(lambda t: self._end_async_flight(key, t))
+            return await asyncio.shield(task), shared
+
+        self.shared += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout), shared
+        except asyncio.TimeoutError:
+            raise FlightTimeoutException(timeout)
+
+
+    def _end_async_flight(self, key, task):
+        if self._async_flights.get(key) is task:
+            del self._async_flights[key]
+        self.executions += 1
+
+
+    def stats(self):
+        calls = self.executions + self.shared
+        return {'executions': self.executions,
+                'shared': self.shared,
+                'shared_ratio': float(self.shared) / calls if calls else 0.0}
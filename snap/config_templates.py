@@ -62,7 +62,278 @@ error_handlers:
           tx_status_code:       HTTP_BAD_REQUEST
 """
 
-ROUTES = """
+# Jinja macros shared by the routing module templates (ROUTES, ASGI_ROUTES and WSGI_ROUTES).
+# Macro bodies are written at the indentation of the generated code and end without a
+# newline ({%- endmacro %}), so each call goes on a line of its own at column 0.
+ROUTE_MACROS = """{% macro transform_registrations(transforms, executor_pools, optimize) %}
+#-- exception handlers ---
+
+xformer.register_error_code(snap.NullTransformInputDataException, snap.HTTP_BAD_REQUEST)
+xformer.register_error_code(snap.MissingInputFieldException, snap.HTTP_BAD_REQUEST)
+xformer.register_error_code(snap.TransformNotImplementedException, snap.HTTP_NOT_IMPLEMENTED)
+xformer.register_error_code(core.TransformTimeoutException, snap.HTTP_GATEWAY_TIMEOUT)
+xformer.register_error_code(executors.ExecutorPoolFullException, snap.HTTP_SERVICE_UNAVAILABLE)
+
+#-- data shapes ----------
+
+{% for transform in transforms.values() %}
+{{ transform.input_shape.name }} = core.InputShape("{{transform.input_shape.name}}")
+{% for field in transform.input_shape.fields %}
+{{ transform.input_shape.name }}.add_field('{{ field.name }}', '{{ field.datatype }}', {{ field.is_required }})
+{% endfor %}
+{% endfor %}
+
+#-- executor pools ----
+
+{% for pool_name, pool_spec in executor_pools.items() %}
+xformer.add_executor_pool('{{ pool_name }}', {{ pool_spec }})
+{% endfor %}
+
+#-- transforms ----
+
+{% for transform in transforms.values() %}
+xformer.register_transform('{{transform.name}}', {{ transform.input_shape.name }}, {{ transform.function_name }}, {{ transform.output_type_spec }})
+{% if transform.batch_enabled %}
+xformer.register_batch_transform('{{transform.name}}', {{ transform.batch_function_name }})
+{% endif %}
+{% if transform.cache_enabled %}
+xformer.enable_response_cache('{{transform.name}}', {{ transform.cache_spec }})
+{% endif %}
+{% if transform.coalesce %}
+xformer.enable_coalescing('{{transform.name}}')
+{% endif %}
+{% if transform.admission_enabled %}
+xformer.enable_admission_control('{{transform.name}}', {{ transform.admission_spec }})
+{% endif %}
+{% if transform.timeout_ms %}
+xformer.set_timeout('{{transform.name}}', {{ transform.timeout_ms }})
+{% endif %}
+{% if transform.executor_pool %}
+xformer.assign_executor_pool('{{transform.name}}', '{{ transform.executor_pool }}')
+{% endif %}
+{% endfor %}
+
+# rebuilds shapes, decoders and validators when the config file changes, if hot_reload is set
+snap.enable_hot_reload(app, xformer)
+{% if optimize %}
+
+#-- bound transforms (routegen --optimize): handlers call their transform's Action directly ----
+
+{% for transform in transforms.values() %}
+{{ transform.name }}_transform = xformer.bind('{{ transform.name }}')
+{% endfor %}
+{% endif %}
+{%- endmacro %}
+{%- macro admission_check(t, optimize, on_event_loop) %}
+{% if on_event_loop %}
+    # shed load before doing any work on the request. Waiting in the admission queue
+    # would block the event loop, so requests over the limit are shed at once.
+    permit = {% if optimize %}{{ t.name }}_transform.admit(block=False){% else %}xformer.admit('{{ t.name }}', block=False){% endif %}
+
+{% else %}
+    # shed load before doing any work on the request, including decoding its body
+    permit = {% if optimize %}{{ t.name }}_transform.admit(){% else %}xformer.admit('{{ t.name }}'){% endif %}
+
+{% endif %}
+    if permit is None:
+        return Response(jsoncodec.dumps({'error_message': 'This endpoint is overloaded; please retry later.'}),
+                        status=snap.HTTP_SERVICE_UNAVAILABLE,
+                        mimetype=core.MIMETYPE_JSON,
+                        headers={'Retry-After': xformer.retry_after('{{ t.name }}')})
+{%- endmacro %}
+{%- macro negotiate_output(t, optimize) %}
+{% if not optimize %}
+        if app.debug:
+            # dump request headers for easier debugging
+            log.info('### HTTP request headers:')
+            log.info(request.headers)
+
+{% endif %}
+        output_mimetype = {% if optimize %}{{ t.name }}_transform.negotiate(headers.get('Accept')){% else %}xformer.target_mimetype_for_transform('{{ t.name }}', request.headers.get('Accept')){% endif %}
+
+        if output_mimetype is None:
+            return Response(jsoncodec.dumps({'error_message': 'This endpoint cannot produce any of the requested media types.'}),
+                            status=snap.HTTP_NOT_ACCEPTABLE,
+                            mimetype=core.MIMETYPE_JSON)
+{%- endmacro %}
+{%- macro cache_lookup(t, optimize) %}
+        response_cache = {% if optimize %}{{ t.name }}_transform.response_cache{% else %}xformer.response_cache('{{ t.name }}'){% endif %}
+
+        cache_key = response_cache.key_for(input_data, output_mimetype)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            if cached.matches({% if optimize %}headers{% else %}request.headers{% endif %}.get('If-None-Match')):
+                return Response(status=snap.HTTP_NOT_MODIFIED, headers=cached.headers)
+            return Response(cached.body,
+                            status=snap.HTTP_OK,
+                            mimetype=output_mimetype,
+                            headers=cached.headers)
+{%- endmacro %}
+{%- macro respond(t, optimize) %}
+        with xformer.timed('{{ t.name }}', 'respond'):
+            if transform_status.ok:
+                output_data = core.encode_output(transform_status.output_data, output_mimetype)
+{% if t.admission_enabled %}
+                if core.is_output_stream(output_data):
+                    # the transform runs until its output has been sent, so the permit is
+                    # released when the response stream closes rather than on return
+                    output_data = permit.release_after(output_data)
+{% endif %}
+{% if t.cache_enabled %}
+                cached = response_cache.put(cache_key, output_data)
+                if cached is not None:
+                    # the client may already hold this output, from before the entry expired
+                    if cached.matches({% if optimize %}headers{% else %}request.headers{% endif %}.get('If-None-Match')):
+                        return Response(status=snap.HTTP_NOT_MODIFIED, headers=cached.headers)
+                    return Response(output_data,
+                                    status=snap.HTTP_OK,
+                                    mimetype=output_mimetype,
+                                    headers=cached.headers)
+{% endif %}
+                return Response(output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
+            return Response(core.encode_output(transform_status.user_data, output_mimetype),
+                            status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE,
+                            mimetype=output_mimetype)
+{%- endmacro %}
+{%- macro handler_cleanup(t) %}
+    except Exception as err:
+        log.error("Exception thrown: ", exc_info=True)
+        raise err
+{%- if t.admission_enabled %}
+
+    finally:
+        permit.release()
+{%- endif %}
+{%- endmacro %}
+{%- macro batch_handler(t, optimize, runtime) %}
+@app.route('{{ t.batch_route }}', methods=['POST'])
+{% if runtime == 'flask' %}
+def {{t.name}}_batch({{ ','.join(t.route_variables) }}):
+{% else %}
+{% if runtime == 'asgi' %}async {% endif %}def {{t.name}}_batch(request{% for route_variable in t.route_variables %}, {{ route_variable }}{% endfor %}):
+{% endif %}
+{% if t.admission_enabled %}
+{{ admission_check(t, optimize, runtime == 'asgi') }}
+{% endif %}
+    try:
+        try:
+            with xformer.timed('{{ t.name }}_batch', 'decode'):
+{% if runtime == 'asgi' %}
+                await request.load_body()
+{% endif %}
+                records = core.map_batch_content(request)
+        except (ValueError, core.BatchDecodingException) as err:
+            return Response(jsoncodec.dumps({'error_message': str(err)}),
+                            status=snap.HTTP_BAD_REQUEST,
+                            mimetype=core.MIMETYPE_JSON)
+{% for route_variable in t.route_variables %}
+        for record in records:
+            record['{{ route_variable }}'] = {{ route_variable }}
+{% endfor %}
+
+{% if runtime == 'asgi' %}
+        transform_statuses = await xformer.transform_batch_async('{{ t.name }}', records, headers=request.headers)
+{% else %}
+        transform_statuses = xformer.transform_batch('{{ t.name }}', records, headers=request.headers)
+{% endif %}
+        with xformer.timed('{{ t.name }}_batch', 'respond'):
+            return Response(jsoncodec.dumps_bytes(core.batch_status_data(transform_statuses)),
+                            status=snap.HTTP_OK,
+                            mimetype=core.MIMETYPE_JSON)
+{{ handler_cleanup(t) }}
+{%- endmacro %}
+{%- macro runtime_handlers(t, optimize, runtime) %}
+{% set on_event_loop = runtime == 'asgi' %}
+{% set await_ = 'await ' if on_event_loop else '' %}
+{% set headers = 'headers' if optimize else 'request.headers' %}
+@app.route('{{ t.route }}', methods=[{{ t.methods }}])
+{% if runtime == 'flask' %}
+{% if t.cors_enabled %}
+@cross_origin({{ t.cors_spec }})
+{% endif %}
+def {{t.name}}({{ ','.join(t.route_variables) }}):
+{% else %}
+{% if on_event_loop %}async {% endif %}def {{t.name}}(request{% for route_variable in t.route_variables %}, {{ route_variable }}{% endfor %}):
+{% endif %}
+{% if t.admission_enabled %}
+{{ admission_check(t, optimize, on_event_loop) }}
+{% endif %}
+    try:
+{% if optimize %}
+{% if runtime == 'flask' %}
+        # each request.headers goes through Flask's context-local proxy, so look it up once
+{% endif %}
+        headers = request.headers
+{% endif %}
+{{ negotiate_output(t, optimize) }}
+
+{% if optimize %}
+{% if t.methods == "'POST'" and not t.streaming %}
+        with xformer.timed('{{ t.name }}', 'decode'):
+{% if runtime == 'flask' %}
+            request.get_data()
+{% elif runtime == 'asgi' %}
+            await request.load_body()
+{% endif %}
+{% if t.route_variables %}
+            input_data = {{ t.route_variable_dict }}
+            input_data.update(xformer.map_content(request))
+{% else %}
+            input_data = xformer.map_content(request)
+{% endif %}
+{% elif t.route_variables %}
+        input_data = {{ t.route_variable_dict }}
+        input_data.update(request.args)
+{% elif runtime == 'flask' %}
+        input_data = request.args.to_dict()
+{% else %}
+        input_data = dict(request.args)
+{% endif %}
+{% else %}
+        input_data = {}
+{% for route_variable in t.route_variables %}
+        input_data['{{ route_variable }}'] = {{ route_variable }}
+{% endfor %}
+{% if t.methods == "'POST'" and t.streaming %}
+        input_data.update(request.args)
+{% elif t.methods == "'POST'" %}
+        with xformer.timed('{{ t.name }}', 'decode'):
+{% if runtime == 'flask' %}
+            request.get_data()
+{% elif runtime == 'asgi' %}
+            await request.load_body()
+{% endif %}
+            input_data.update(xformer.map_content(request))
+{% elif t.methods == "'GET'" or t.methods == "'DELETE'" %}
+        input_data.update(request.args)
+{% endif %}
+{% endif %}
+{% if t.methods == "'POST'" and t.streaming %}
+        # the request body is decoded record-by-record as the transform consumes it
+        records = xformer.map_stream_content(request)
+{% endif %}
+{% if (t.methods == "'GET'" or t.methods == "'DELETE'") and t.cache_enabled %}
+{{ cache_lookup(t, optimize) }}
+{% endif %}
+
+{% if t.streaming %}
+        transform_status = {{ await_ }}xformer.transform_stream{% if on_event_loop %}_async{% endif %}('{{ t.name }}', input_data, records, headers={{ headers }})
+{% elif optimize %}
+        transform_status = {{ await_ }}{{ t.name }}_transform.transform{% if on_event_loop %}_async{% endif %}(input_data, headers=headers)
+{% else %}
+        transform_status = {{ await_ }}xformer.transform{% if on_event_loop %}_async{% endif %}('{{ t.name }}', input_data, headers=request.headers)
+{% endif %}
+{{ respond(t, optimize) }}
+{{ handler_cleanup(t) }}
+{%- if t.batch_enabled %}
+
+
+{{ batch_handler(t, optimize, runtime) }}
+{%- endif %}
+{%- endmacro %}
+"""
+
+ROUTES = ROUTE_MACROS + """
 #!/usr/bin/env python
 
 #
@@ -75,9 +346,10 @@ from flask import Flask, request, Response
 from flask_cors import CORS, cross_origin
 from snap import snap
 from snap import core
+from snap import executors
+from snap import jsoncodec
 import logging
 import json
-import argparse
 import sys
 from snap.loggers import request_logger as log
 
@@ -99,70 +371,139 @@ else:
 
 app = snap.setup(f_runtime)
 xformer = core.Transformer(app.config.get('services'))
+if app.config['snap_globals'].get('instrumentation'):
+    xformer.enable_instrumentation()
 
 
-#-- exception handlers ---
-
-xformer.register_error_code(snap.NullTransformInputDataException, snap.HTTP_BAD_REQUEST)
-xformer.register_error_code(snap.MissingInputFieldException, snap.HTTP_BAD_REQUEST)
-xformer.register_error_code(snap.TransformNotImplementedException, snap.HTTP_NOT_IMPLEMENTED)
+{{ transform_registrations(transforms, executor_pools, optimize) }}
+#-- endpoints -----------------
 
-#-- data shapes ----------
+{% for t in transforms.values() %}
+{{ runtime_handlers(t, optimize, 'flask') }}
 
-{% for transform in transforms.values() %}
-{{ transform.input_shape.name }} = core.InputShape("{{transform.input_shape.name}}")
-{% for field in transform.input_shape.fields %}
-{{ transform.input_shape.name }}.add_field('{{ field.name }}', '{{ field.datatype }}', {{ field.is_required }})
-{% endfor %}
 {% endfor %}
 
-#-- transforms ----
 
-{% for transform in transforms.values() %}
-xformer.register_transform('{{transform.name}}', {{ transform.input_shape.name }}, {{ transform.function_name }}, '{{ transform.output_type }}')
-{% endfor %}
+if __name__ == '__main__':
+    #
+    # If we are loading from command line,
+    # run the Flask app explicitly
+    #
+    app.run(host='{{bind_host}}', port={{port}})
+
+"""
+
+ASGI_ROUTES = ROUTE_MACROS + """
+#!/usr/bin/env python
+
+#
+# Generated ASGI routing module for SNAP microservice framework
+#
+
+
+
+from snap import snap
+from snap import core
+from snap import executors
+from snap import jsoncodec
+from snap.asgi import ASGIApplication
+from snap.runtime import Response
+import logging
+import json
+import sys
+from snap.loggers import request_logger as log
+
+sys.path.append('{{ project_dir }}')
+
+{% if transform_module %}
+import {{ transform_module }} 
+{% endif %}
+
+a_runtime = ASGIApplication(__name__)
+
+if __name__ == '__main__':
+    print('starting SNAP microservice in standalone (debug) mode...')
+    a_runtime.config['startup_mode'] = 'standalone'
+    
+else:
+    print('starting SNAP microservice in asgi mode...')
+    a_runtime.config['startup_mode'] = 'server'
+
+app = snap.setup(a_runtime)
+xformer = core.Transformer(app.config.get('services'),
+                           sync_threads=app.config['snap_globals'].get('sync_threads'))
+if app.config['snap_globals'].get('instrumentation'):
+    xformer.enable_instrumentation()
+
 
+{{ transform_registrations(transforms, executor_pools, optimize) }}
 #-- endpoints -----------------
 
 {% for t in transforms.values() %}
-@app.route('{{ t.route }}', methods=[{{ t.methods }}])
-{% if t.cors_enabled %}@cross_origin({{ t.cors_spec }})
+{{ runtime_handlers(t, optimize, 'asgi') }}
+
+{% endfor %}
+
+
+if __name__ == '__main__':
+    #
+    # If we are loading from command line,
+    # serve the ASGI app with uvicorn
+    #
+    import uvicorn
+    uvicorn.run(app, host='{{bind_host}}', port={{port}})
+
+"""
+
+WSGI_ROUTES = ROUTE_MACROS + """
+#!/usr/bin/env python
+
+#
+# Generated WSGI routing module for SNAP microservice framework
+# (the native runtime: no Flask or Werkzeug request handling)
+#
+
+
+
+from snap import snap
+from snap import core
+from snap import executors
+from snap import jsoncodec
+from snap.wsgi import WSGIApplication
+from snap.runtime import Response
+import logging
+import json
+import sys
+from snap.loggers import request_logger as log
+
+sys.path.append('{{ project_dir }}')
+
+{% if transform_module %}
+import {{ transform_module }} 
 {% endif %}
-def {{t.name}}({{ ','.join(t.route_variables) }}):
-    try:
-        if app.debug:
-            # dump request headers for easier debugging
-            log.info('### HTTP request headers:')
-            log.info(request.headers)
 
-        input_data = {}
-        {% for route_variable in t.route_variables %}
-        input_data['{{ route_variable }}'] = {{ route_variable }}
-        {% endfor %}
-        {% if t.methods == "'POST'" %}
+w_runtime = WSGIApplication(__name__)
 
-        request.get_data()
-        input_data.update(core.map_content(request))
-        
-        transform_status = xformer.transform('{{ t.name }}', input_data, headers=request.headers)
+if __name__ == '__main__':
+    print('starting SNAP microservice in standalone (debug) mode...')
+    w_runtime.config['startup_mode'] = 'standalone'
+    
+else:
+    print('starting SNAP microservice in wsgi mode...')
+    w_runtime.config['startup_mode'] = 'server'
+
+app = snap.setup(w_runtime)
+xformer = core.Transformer(app.config.get('services'),
+                           sync_threads=app.config['snap_globals'].get('sync_threads'))
+if app.config['snap_globals'].get('instrumentation'):
+    xformer.enable_instrumentation()
 
-        {% elif t.methods == "'GET'" or t.methods == "'DELETE'" %}                
-        input_data.update(request.args)
-        
-        transform_status = xformer.transform('{{ t.name }}',
-                                             input_data,
-                                             headers=request.headers)
-        {% endif %}        
-        output_mimetype = xformer.target_mimetype_for_transform('{{ t.name }}')
-
-        if transform_status.ok:
-            return Response(transform_status.output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
-        return Response(json.dumps(transform_status.user_data), 
-                        status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE, 
-                        mimetype=output_mimetype) 
-    except Exception as err:
-        log.error("Exception thrown: ", exc_info=True)        
-        raise err
+
+{{ transform_registrations(transforms, executor_pools, optimize) }}
+#-- endpoints -----------------
+
+{% for t in transforms.values() %}
+{{ runtime_handlers(t, optimize, 'wsgi') }}
 
 {% endfor %}
 
@@ -170,9 +511,10 @@ def {{t.name}}({{ ','.join(t.route_variables) }}):
 if __name__ == '__main__':
     #
     # If we are loading from command line,
-    # run the Flask app explicitly
+    # serve the WSGI app with the (single-threaded) reference server
     #
-    app.run(host='{{bind_host}}', port={{port}})
+    from wsgiref.simple_server import make_server
+    make_server('{{bind_host}}', {{port}}, app).serve_forever()
 
 """
 
@@ -180,16 +522,17 @@ NGINX_CONFIG = """
 #
 # Generated nginx config file for snap endpoints via uWSGI
 #
+{% set p = nginx_config.pass_module %}
 
 
 user  nobody;
-worker_processes  1;
+worker_processes  {{ nginx_config.worker_processes }};
 
 error_log  logs/error.log;
 pid        logs/nginx.pid;
 
 events {
-    worker_connections  1024;
+    worker_connections  {{ nginx_config.worker_connections }};
 }
 
 
@@ -199,22 +542,80 @@ http {
 
     log_format  main  '$remote_addr - $remote_user [$time_local] "$request" '
                       '$status $body_bytes_sent "$http_referer" '
-                      '"$http_user_agent" "$http_x_forwarded_for"';
+                      '"$http_user_agent" "$http_x_forwarded_for"'{% if nginx_config.microcache %} ' cache=$upstream_cache_status'{% endif %};
 
     access_log  logs/access.log  main;
-    tcp_nopush     on;
-    keepalive_timeout  0;
     sendfile        on;
+    tcp_nopush      on;
+    tcp_nodelay     on;
+    keepalive_timeout  {{ nginx_config.keepalive_timeout }};
     client_max_body_size 75M;
-    #keepalive_timeout  65;
+{% if nginx_config.gzip %}
+
+    gzip              on;
+    gzip_comp_level   {{ nginx_config.gzip_comp_level }};
+    gzip_min_length   {{ nginx_config.gzip_min_length }};
+    gzip_proxied      any;
+    gzip_vary         on;
+    gzip_types        {{ nginx_config.gzip_types|join(' ') }};
+{% endif %}
+
+    upstream {{ nginx_config.upstream_name }} {
+{% if nginx_config.balance != 'round_robin' %}
+        {{ nginx_config.balance }};
+{% endif %}
+{% for server in nginx_config.upstream_servers %}
+        server {{ server }};
+{% endfor %}
+{% if nginx_config.upstream_keepalive %}
+        keepalive {{ nginx_config.upstream_keepalive }};
+{% endif %}
+    }
+{% if nginx_config.microcache %}
+
+    # microcache: nginx answers repeated reads of cacheable GET transforms for a second or
+    # so, and only one request per key at a time goes through to the service
+    {{ p }}_cache_path {{ nginx_config.microcache.path }} levels=1:2 keys_zone={{ nginx_config.upstream_name }}_cache:{{ nginx_config.microcache.zone_size }} max_size={{ nginx_config.microcache.max_size }} inactive=60s use_temp_path=off;
+{% endif %}
 
     server {
-        listen       {{ nginx_config.port }};
+        listen       {{ nginx_config.port }}{% if nginx_config.reuseport %} reuseport{% endif %};
         server_name  {{ nginx_config.hostname }};
 
+{% if p == 'uwsgi' %}
+        include uwsgi_params;
+{% else %}
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+{% endif %}
+{% if nginx_config.buffering %}
+        {{ p }}_buffering on;
+        {{ p }}_buffer_size {{ nginx_config.buffer_size }};
+        {{ p }}_buffers {{ nginx_config.buffers }};
+        {{ p }}_busy_buffers_size {{ nginx_config.busy_buffers_size }};
+{% else %}
+        {{ p }}_buffering off;
+{% endif %}
+{% for cached_route in nginx_config.microcached_routes %}
+
+        location {{ cached_route.location }} {
+            {{ p }}_pass {{ nginx_config.upstream_scheme }}{{ nginx_config.upstream_name }};
+            {{ p }}_cache {{ nginx_config.upstream_name }}_cache;
+            {{ p }}_cache_key "$request_method$request_uri$http_accept";
+            {{ p }}_cache_valid 200 {{ cached_route.ttl }}s;
+            {{ p }}_ignore_headers Cache-Control Expires;
+            {{ p }}_cache_lock on;
+            {{ p }}_cache_use_stale updating error timeout;
+            {{ p }}_cache_background_update on;
+            {{ p }}_cache_bypass $http_authorization;
+            {{ p }}_no_cache $http_authorization;
+        }
+{% endfor %}
+
         location / {
-            include uwsgi_params;
-            uwsgi_pass unix:{{ nginx_config.uwsgi_sockfile }};
+            {{ p }}_pass {{ nginx_config.upstream_scheme }}{{ nginx_config.upstream_name }};
         }
 
         # redirect server error pages to the static page /50x.html
@@ -254,6 +655,11 @@ TRANSFORM_BLOCK = """
 def {{ f }}(input_data, service_objects, **kwargs):
     raise snap.TransformNotImplementedException('{{f}}')
 {% endfor %}
+{% for batch_f, f in batch_functions %}
+def {{ batch_f }}(records, service_objects, **kwargs):
+    # called with every valid record in a batch request; replace with a bulk implementation
+    return [{{ f }}(record, service_objects, **kwargs) for record in records]
+{% endfor %}
 """
 
 
@@ -272,6 +678,12 @@ from snap.loggers import transform_logger as log
 def {{ f }}(input_data, service_objects, **kwargs):
     raise snap.TransformNotImplementedException('{{f}}')
 {% endfor %}
+{% for batch_f, f in batch_functions %}
+
+def {{ batch_f }}(records, service_objects, **kwargs):
+    # called with every valid record in a batch request; replace with a bulk implementation
+    return [{{ f }}(record, service_objects, **kwargs) for record in records]
+{% endfor %}
 """
 
 UWSGI = """
@@ -304,64 +716,47 @@ callable = app
 
 #location of log files
 logto = {{ uwsgi_config.log_dir }}/%n.log
-"""
 
+#-- performance: "{{ uwsgi_config.profile.name }}" profile, {{ uwsgi_config.cores }} cores ----
 
-LOGGING_CONFIG = """
-version: 1
-disable_existing_loggers: False
-formatters:
-    simple:
-        format: "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-
-handlers:
-    console:
-        class: logging.StreamHandler
-        level: DEBUG
-        formatter: simple
-        stream: ext://sys.stdout
-
-    file_handler:
-        class: logging.handlers.RotatingFileHandler
-        level: INFO
-        formatter: simple
-        filename: {{ log_filename }}
-        maxBytes: 10485760 # 10MB
-        backupCount: 20
-        encoding: utf8
-
-loggers:
-    root:
-        level: INFO
-        handlers: [console]
-        propagate: no
-
-    sqlalchemy:
-        level: ERROR
-        handlers: [console]
-        propagate: no
-
-    request:
-        level: INFO
-        handlers: [console]
-        propagate: no
-
-    init:
-        level: INFO
-        handlers: [console]
-        propagate: no
-
-    service:
-        level: INFO
-        handlers: [console]
-        propagate: no
-
-    transform:
-        level: INFO
-        handlers: [console]
-        propagate: no
-
-root:
-    level: INFO
-    handlers: [console, file_handler]
-"""
\ No newline at end of file
+master = true
+processes = {{ uwsgi_config.processes }}
+threads = {{ uwsgi_config.threads }}
+#snap starts its own threads (deadlines, executor pools, config watching), even with threads = 1
+enable-threads = true
+
+#connections the kernel queues while all workers are busy (capped by net.core.somaxconn)
+listen = {{ uwsgi_config.listen }}
+{% if uwsgi_config.thunder_lock %}
+thunder-lock = true
+{% endif %}
+{% if uwsgi_config.harakiri %}
+
+#kill a worker stuck on one request for this many seconds
+harakiri = {{ uwsgi_config.harakiri }}
+{% endif %}
+{% if uwsgi_config.max_requests %}
+
+#recycle each worker after this many requests; the delta staggers the restarts
+max-requests = {{ uwsgi_config.max_requests }}
+max-requests-delta = {{ (uwsgi_config.max_requests // 10) or 1 }}
+{% endif %}
+{% if uwsgi_config.cheaper %}
+
+#scale the workers with load, keeping at least this many running
+cheaper-algo = spare
+cheaper = {{ uwsgi_config.cheaper }}
+cheaper-initial = {{ uwsgi_config.cheaper }}
+cheaper-step = 1
+{% endif %}
+{% if uwsgi_config.offload_threads %}
+
+#threads which send large or static responses, freeing the workers
+offload-threads = {{ uwsgi_config.offload_threads }}
+{% endif %}
+{% if uwsgi_config.lazy_apps %}
+
+#load the app in each worker rather than once in the master
+lazy-apps = true
+{% endif %}
+"""
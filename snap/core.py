@@ -1,20 +1,46 @@
 #!/user/bin/env python
 
+from snap import admission
 from snap import common
-import argparse
+from snap import cache
+from snap import concurrency
+from snap import executors
+from snap import jsoncodec
+from snap import metrics
+from snap import wireformats
+import asyncio
+import functools
+import inspect
 import json
+import logging
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+log = logging.getLogger('transform')
 
 
 
 HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
 HTTP_BAD_REQUEST = 400
 HTTP_NOT_FOUND = 404
+HTTP_NOT_ACCEPTABLE = 406
 HTTP_DEFAULT_ERRORCODE = 400
 HTTP_NOT_IMPLEMENTED = 500
+HTTP_SERVICE_UNAVAILABLE = 503
+HTTP_GATEWAY_TIMEOUT = 504
 
 MIMETYPE_JSON = 'application/json'
+MIMETYPE_NDJSON = 'application/x-ndjson'
 CONFIG_FILE_ENV_VAR = 'BUTTONIZE_CFG'
+DEFAULT_SYNC_THREADS = 16
+DEFAULT_RECORDS_PER_CHUNK = 100
+MEDIA_TYPE_CACHE_SIZE = 1024
+# a caller's remaining time budget, in milliseconds, relative to when the request arrives
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
 
 ROUTE_VARIABLE_REGEX = re.compile(r'<([a-zA-Z_-]+):([a-zA-Z_-]+)>')
 
@@ -35,24 +61,168 @@ COLLECTION_TYPES = {
 }
 
 
+class MediaType(object):
+    '''A parsed media type (or media range, for Accept headers): type/subtype plus parameters.'''
+
+    def __init__(self, main_type, subtype, params):
+        self.main_type = main_type
+        self.subtype = subtype
+        self.params = params
+        self.essence = '%s/%s' % (main_type, subtype)
+        try:
+            self.quality = float(params.get('q', 1))
+        except ValueError:
+            self.quality = 0.0
+        # exact types outrank type/* ranges, which outrank */*
+        self.specificity = (main_type != '*') + (subtype != '*')
+
+    @staticmethod
+    def parse(value):
+        tokens = value.split(';')
+        essence = tokens[0].strip().lower()
+        if essence == '*':
+            essence = '*/*'
+        main_type, _, subtype = essence.partition('/')
+        params = {}
+        for token in tokens[1:]:
+            name, _, param_value = token.partition('=')
+            if name.strip():
+                params[name.strip().lower()] = param_value.strip().strip('"')
+        return MediaType(main_type, subtype or '*', params)
+
+    def matches(self, other):
+        '''True if this media range covers the media type other.'''
+        return ((self.main_type == '*' or self.main_type == other.main_type) and
+                (self.subtype == '*' or self.subtype == other.subtype))
+
+    def __repr__(self):
+        return self.essence
+
+
+_media_type_cache = {}
+_accept_cache = {}
+
+
+def _bounded_cache_put(cache_tbl, key, value):
+    # header values are client-controlled, so the caches are cleared rather than left to grow
+    if len(cache_tbl) >= MEDIA_TYPE_CACHE_SIZE:
+        cache_tbl.clear()
+    cache_tbl[key] = value
+
+
+def parse_media_type(value):
+    '''Parse a Content-Type style header value. Results are cached per distinct value.'''
+    media_type = _media_type_cache.get(value)
+    if media_type is None:
+        media_type = MediaType.parse(value)
+        _bounded_cache_put(_media_type_cache, value, media_type)
+    return media_type
+
+
+def parse_accept(value):
+    '''Parse an Accept header into media ranges, most preferred first. Results are cached.'''
+    ranges = _accept_cache.get(value)
+    if ranges is None:
+        ranges = [parse_media_type(token) for token in value.split(',') if token.strip()]
+        ranges.sort(key=lambda r: (-r.quality, -r.specificity))
+        _bounded_cache_put(_accept_cache, value, ranges)
+    return ranges
+
+
+def negotiate(accept_header, offered_mimetypes):
+    '''Return the offered mimetype the client prefers according to its Accept header,
+    or None if the client accepts none of them. With no Accept header, the first
+    offered mimetype is returned.
+    '''
+    if not accept_header:
+        return offered_mimetypes[0]
+
+    ranges = parse_accept(accept_header)
+    best_mimetype = None
+    best_quality = 0.0
+    for mimetype in offered_mimetypes:
+        offered = parse_media_type(mimetype)
+        # the most specific range covering the offered type decides its quality
+        quality = 0.0
+        specificity = -1
+        for media_range in ranges:
+            if media_range.specificity > specificity and media_range.matches(offered):
+                quality = media_range.quality
+                specificity = media_range.specificity
+        if quality > best_quality:
+            best_mimetype = mimetype
+            best_quality = quality
+    return best_mimetype
+
+
+class MediaTypeMap(dict):
+    '''A dict keyed by content type, which can also resolve any spelling of a
+    Content-Type header (parameters, case, wildcard registrations) to its entry.
+    Resolutions are cached per distinct header value.
+    '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self._by_essence = {}
+        self._resolved = {}
+
+    def __setitem__(self, content_type, value):
+        dict.__setitem__(self, content_type, value)
+        self._by_essence[parse_media_type(content_type).essence] = value
+        self._resolved = {}
+
+    def resolve(self, header_value):
+        try:
+            return self._resolved[header_value]
+        except KeyError:
+            pass
+
+        value = dict.get(self, header_value)
+        if value is None and header_value:
+            media_type = parse_media_type(header_value)
+            for key in (media_type.essence, '%s/*' % media_type.main_type, '*/*'):
+                value = self._by_essence.get(key)
+                if value is not None:
+                    break
+        _bounded_cache_put(self._resolved, header_value, value)
+        return value
+
+
 class ContentProtocol(object):
     def __init__(self):
-        self.decoding_map = {}        
+        self.decoding_map = MediaTypeMap()
+        self.streaming_map = MediaTypeMap()
 
 
     def update(self, content_type, decode_function):
         self.decoding_map[content_type] = decode_function
         return self
+
+
+    def update_streaming(self, content_type, decode_function):
+        '''Register a streaming decoder: a function which reads the request body incrementally
+        (from http_request.stream) and returns an iterator of input records.
+        '''
+        self.streaming_map[content_type] = decode_function
+        return self
     
 
     def decode(self, http_request):
         ctype = http_request.headers['Content-Type']
-        func = self.decoding_map.get(ctype)
+        func = self.decoding_map.resolve(ctype)
         if not func:
             raise ContentDecodingException(ctype)        
         return func(http_request)
 
 
+    def decode_stream(self, http_request):
+        ctype = http_request.headers['Content-Type']
+        func = self.streaming_map.resolve(ctype)
+        if not func:
+            raise ContentDecodingException(ctype)
+        return func(http_request)
+
+
 def decode_json(http_request):
     result =  http_request.get_json(silent=True)
     if not result:
@@ -61,7 +231,7 @@ def decode_json(http_request):
 
 def decode_text_plain(http_request):
     if http_request.data:
-        return json.loads(http_request.data)
+        return jsoncodec.loads(http_request.data)
     return {}
 
 
@@ -71,6 +241,45 @@ def decode_form_urlenc(http_request):
 
 def map_content(http_request):
     return default_content_protocol.decode(http_request)
+
+
+def map_stream_content(http_request):
+    return default_content_protocol.decode_stream(http_request)
+
+
+def map_batch_content(http_request):
+    '''Decode the body of a batch request -- either a JSON array or newline-delimited
+    JSON objects -- into a list of input records.
+    '''
+    ctype = http_request.headers.get('Content-Type') or ''
+    body = http_request.get_data()
+    if parse_media_type(ctype).essence == MIMETYPE_NDJSON:
+        records = [jsoncodec.loads(line) for line in body.splitlines() if line.strip()]
+    elif not body.strip():
+        records = []
+    else:
+        records = jsoncodec.loads(body)
+
+    if not isinstance(records, list):
+        raise BatchDecodingException('a batch request body must be a JSON array or NDJSON.')
+    for record in records:
+        if not isinstance(record, dict):
+            raise BatchDecodingException('every record in a batch request must be a JSON object.')
+    return records
+
+
+def batch_status_data(transform_statuses):
+    '''Build the per-record response data for a completed batch transform.'''
+    results = []
+    for index, status in enumerate(transform_statuses):
+        if status.ok:
+            results.append({'index': index, 'ok': True, 'status': HTTP_OK, 'data': status.output_data})
+        else:
+            results.append({'index': index,
+                            'ok': False,
+                            'status': status.get_error_code() or HTTP_DEFAULT_ERRORCODE,
+                            'error': status.user_data})
+    return results
         
 
 def utf8_encode(raw_input_data):
@@ -108,9 +317,52 @@ default_content_protocol = ContentProtocol()
 default_content_protocol.update('application/json', decode_json)
 default_content_protocol.update('text/plain', decode_text_plain)
 default_content_protocol.update('application/x-www-form-urlencoded', decode_form_urlenc)
-default_content_protocol.update('text/plain; charset=UTF-8', decode_text_plain)
 
-custom_field_type_validators = {}
+# response encoders, keyed by the output_mimetype of a transform
+output_encoders = MediaTypeMap()
+output_encoders[wireformats.MIMETYPE_MSGPACK] = wireformats.encode_msgpack
+output_encoders[wireformats.MIMETYPE_CBOR] = wireformats.encode_cbor
+
+
+class FieldValidatorTable(dict):
+    '''User-defined field validators, keyed by datatype. The table counts its changes, so
+    that shapes compiled against it know when to recompile.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, datatype, validator):
+        dict.__setitem__(self, datatype, validator)
+        self.version += 1
+
+    def __delitem__(self, datatype):
+        dict.__delitem__(self, datatype)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, datatype, validator=None):
+        self.version += 1
+        return dict.setdefault(self, datatype, validator)
+
+    def pop(self, *args):
+        self.version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+
+
+custom_field_type_validators = FieldValidatorTable()
 
 
 class MissingDataStatus():
@@ -152,6 +404,22 @@ class ContentDecodingException(Exception):
         Exception.__init__(self, 'No decoding function has been registered for content-type "%s".' % mime_type)
 
 
+class BatchDecodingException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, 'Unable to decode batch request: %s' % message)
+
+
+class BatchResultMismatchException(Exception):
+    def __init__(self, transform_name, num_records, num_results):
+        Exception.__init__(self, 'The batch function for transform "%s" returned %d statuses for %d records.'
+                           % (transform_name, num_results, num_records))
+
+
+class TransformTimeoutException(Exception):
+    def __init__(self, transform_name, timeout_ms):
+        Exception.__init__(self, 'Transform "%s" did not finish within its deadline of %d ms.' % (transform_name, timeout_ms))
+
+
 def is_sequence(arg):
     return (not hasattr(arg, "strip") and
             hasattr(arg, "__getitem__") or
@@ -168,6 +436,57 @@ def convert_multidict(md):
     return result
 
 
+def encode_output(output_data, mimetype=None):
+    '''Framework-level response encoder. If an output encoder is registered for the
+    response mimetype, it encodes the output; otherwise transforms may return their
+    output already encoded (str or bytes), and any other output (dicts, lists...) is
+    encoded as JSON with the configured codec. Generators are never encoded here.
+    '''
+    if output_data is None or is_output_stream(output_data):
+        return output_data
+    encode_function = output_encoders.resolve(mimetype) if mimetype else None
+    if encode_function is not None:
+        return encode_function(output_data)
+    if isinstance(output_data, (str, bytes)):
+        return output_data
+    return jsoncodec.dumps_bytes(output_data)
+
+
+def is_output_stream(output_data):
+    return hasattr(output_data, '__next__') or hasattr(output_data, '__anext__')
+
+
+def stream_json_array(records, records_per_chunk=DEFAULT_RECORDS_PER_CHUNK):
+    '''Incrementally encode an iterable of dicts as a single JSON array. Yields string
+    chunks of up to records_per_chunk records each, so that the whole array is never
+    held in memory.
+    '''
+    chunk = ['[']
+    separator = ''
+    for record in records:
+        chunk.append(separator)
+        chunk.append(jsoncodec.dumps(record))
+        separator = ','
+        if len(chunk) >= records_per_chunk * 2:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def stream_ndjson(records, records_per_chunk=DEFAULT_RECORDS_PER_CHUNK):
+    '''Incrementally encode an iterable of dicts as newline-delimited JSON.'''
+    chunk = []
+    for record in records:
+        chunk.append(jsoncodec.dumps(record))
+        chunk.append('\n')
+        if len(chunk) >= records_per_chunk * 2:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, complex):
@@ -182,36 +501,98 @@ class DataField():
         self.datatype = datatype
         self.is_required = is_required
 
+    def resolve_validator(self, field_validators=None):
+        # look up the conversion function for this field's datatype once, so that
+        # callers validating many records don't have to search the type tables each time.
+        # A user-defined field validator takes precedence over the builtins.
+        if field_validators is None:
+            field_validators = custom_field_type_validators
+        if self.datatype in field_validators:
+            return field_validators[self.datatype]
+
+        if self.datatype in SCALAR_TYPES:
+            return SCALAR_TYPES[self.datatype]
+
+        if self.datatype in COLLECTION_TYPES:
+            return COLLECTION_TYPES[self.datatype]
+
+        message = 'Unrecognized datatype "%s" for datafield "%s".' % (self.datatype, self.name)
+
+        def unrecognized_datatype(value):
+            raise Exception(message)
+
+        return unrecognized_datatype
+
     def validate(self, value):
         # will throw a type conversion error if the data does not conform
         # to the specified type
+        self.resolve_validator()(value)
 
-        # if a user-defined field validator has been registered, that should take precedence
-        # over the builtins
-        if self.datatype in custom_field_type_validators:
-            custom_field_type_validators[self.datatype](value)
+    def __str__(self):
+        return 'DataField <%s>, type=%s, required = %s' % (self.name, self.datatype, self.is_required)
 
-        elif self.datatype in SCALAR_TYPES:
-            SCALAR_TYPES[self.datatype](value)
 
-        elif self.datatype in COLLECTION_TYPES:
-            COLLECTION_TYPES[self.datatype](value)
+class CompiledShape():
+    '''Single-pass validator for an InputShape, with the type lookup for each field
+    resolved up front. check() reports missing and malformed fields in one walk
+    over the shape.
+    '''
+
+    def __init__(self, input_shape, field_validators=None):
+        if field_validators is None:
+            field_validators = custom_field_type_validators
+        self.name = input_shape.name
+        self.field_validators = field_validators
+        self.version = getattr(field_validators, 'version', None)
+        self._checks = tuple((f.name, f.is_required, f.resolve_validator(field_validators))
+                             for f in input_shape.fields)
+
+    @property
+    def is_stale(self):
+        # a validator was added to (or replaced in) the table since the shape was compiled
+        return getattr(self.field_validators, 'version', None) != self.version
+
+    def check(self, input_data):
+        missing = []
+        errors = []
+        for field_name, is_required, convert in self._checks:
+            value = input_data.get(field_name)
+            if value is None:
+                if is_required:
+                    missing.append(repr(MissingDataStatus(field_name)))
+                continue
+            try:
+                convert(value)
+            except Exception as err:
+                errors.append('invalid input field "%s": %s' % (field_name, str(err)))
+        return missing, errors
+
+    def validate(self, input_data):
+        missing, errors = self.check(input_data)
+        if missing:
+            raise MissingInputFieldException(missing)
+        if errors:
+            raise NonCompliantDataFormat(errors)
 
-        else:
-            raise Exception('Unrecognized datatype "%s" for datafield "%s".' % (self.datatype, self.name))
 
-    def __str__(self):
-        return 'DataField <%s>, type=%s, required = %s' % (self.name, self.datatype, self.is_required)
-    
-    
 class InputShape():
     def __init__(self, name):
         self.name = name
         self._fields = {}
+        self._compiled = None
 
     def add_field(self, field_name, datatype, is_required=False):
         self._fields[field_name] = DataField(field_name, datatype, is_required)
+        self._compiled = None
 
+    def compile(self, field_validators=None):
+        # the compiled form is cached until the shape or its validator table changes.
+        # Passing a validator table (other than the global one) recompiles the shape against it.
+        if self._compiled is None or field_validators is not None:
+            self._compiled = CompiledShape(self, field_validators)
+        elif self._compiled.is_stale:
+            self._compiled = CompiledShape(self, self._compiled.field_validators)
+        return self._compiled
 
     def validate_data_format(self, input_data):
         errors = []
@@ -245,25 +626,128 @@ class InputShape():
         return self._fields.values()
     
 
+def offered_mimetypes(mimetypes):
+    '''Return the output mimetypes a transform can actually produce: binary formats whose
+    library is not installed are not offered to clients, and JSON stands in if none is left.
+    '''
+    offered = []
+    for mimetype in mimetypes:
+        if wireformats.available(mimetype):
+            offered.append(mimetype)
+        else:
+            log.warning('%s output will not be offered: the "%s" package is not installed.',
+                        mimetype, wireformats.FORMATS[mimetype].package_name)
+    return offered or [MIMETYPE_JSON]
+
+
 class Action():
-    def __init__(self, input_shape, transform_function, mimetype):
+    def __init__(self, input_shape, transform_function, mimetype, field_validators=None):
         self.input_shape = input_shape
         self.transform_function = transform_function
-        self.output_mimetype = mimetype
+        # a transform may offer several output mimetypes; the first is its default
+        self.output_mimetypes = offered_mimetypes(list(mimetype) if isinstance(mimetype, (list, tuple)) else [mimetype])
+        self.output_mimetype = self.output_mimetypes[0]
+        self.batch_function = None
+        self.response_cache = None
+        self.coalescer = None
+        self.admission = None
+        self.timeout_ms = None
+        self.executor_pool = None
+        self.is_async = inspect.iscoroutinefunction(transform_function)
+        # resolve the shape's field validators at registration time rather than per request
+        input_shape.compile(field_validators)
+
+
+    def validate(self, input_data):
+        # check that all the data is present and that the data formats are correct,
+        # in a single pass over the shape
+        self.input_shape.compile().validate(input_data)
+
+
+    def run(self, input_data, service_object_registry, **kwargs):
+        if self.is_async:
+            # an async transform called from a synchronous runtime gets its own event loop
+            return asyncio.run(self.transform_function(input_data, service_object_registry, **kwargs))
+        return self.transform_function(input_data, service_object_registry, **kwargs)
 
 
     def execute(self, input_data, service_object_registry, **kwargs):
-        errors = self.input_shape.scan(input_data)
-        # check that all the data is present
-        if len(errors):
-            raise MissingInputFieldException(errors)
+        self.validate(input_data)
+        return self.run(input_data, service_object_registry, **kwargs)
 
-        # check to see if the data formats are correct
-        format_errors = self.input_shape.validate_data_format(input_data)
-        if len(format_errors):
-            raise NonCompliantDataFormat(format_errors)
 
-        return self.transform_function(input_data, service_object_registry, **kwargs)
+    async def run_async(self, input_data, service_object_registry, executor, **kwargs):
+        if self.is_async:
+            return await self.transform_function(input_data, service_object_registry, **kwargs)
+
+        # synchronous transforms run on the (bounded) executor so that they don't block the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor,
+                                          functools.partial(self.transform_function,
+                                                            input_data,
+                                                            service_object_registry,
+                                                            **kwargs))
+
+
+    async def execute_async(self, input_data, service_object_registry, executor, **kwargs):
+        self.validate(input_data)
+        return await self.run_async(input_data, service_object_registry, executor, **kwargs)
+
+
+    def run_batch(self, records, service_object_registry, **kwargs):
+        if inspect.iscoroutinefunction(self.batch_function):
+            return asyncio.run(self.batch_function(records, service_object_registry, **kwargs))
+        return self.batch_function(records, service_object_registry, **kwargs)
+
+
+    async def run_batch_async(self, records, service_object_registry, executor, **kwargs):
+        if inspect.iscoroutinefunction(self.batch_function):
+            return await self.batch_function(records, service_object_registry, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor,
+                                          functools.partial(self.batch_function,
+                                                            records,
+                                                            service_object_registry,
+                                                            **kwargs))
+
+
+
+class Deadline(object):
+    '''The time by which a transform must finish. Transforms run under a deadline receive
+    it in the "deadline" keyword argument, so that they can bound their own service calls
+    (e.g. socket timeouts) by remaining().
+    '''
+
+    def __init__(self, timeout_ms):
+        self.timeout_ms = timeout_ms
+        self.expires_at = time.monotonic() + timeout_ms / 1000.0
+
+    def remaining(self):
+        '''Return the time left, in seconds.'''
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self):
+        return int(self.remaining() * 1000)
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+def parse_timeout_header(headers):
+    '''Return the timeout in a request's X-Request-Timeout-Ms header, or None if it has
+    no usable one.
+    '''
+    if headers is None:
+        return None
+    value = headers.get(REQUEST_TIMEOUT_HEADER)
+    if not value:
+        return None
+    try:
+        timeout_ms = float(value)
+    except ValueError:
+        return None
+    return timeout_ms if timeout_ms > 0 else None
 
 
 
@@ -274,6 +758,13 @@ class TransformStatus(object):
         self.user_data = kwargs
         self.has_data = True if output_data else False
 
+    @property
+    def is_streaming(self):
+        '''True if the output is a generator or other iterator, to be sent as a chunked
+        response rather than as a single body.
+        '''
+        return is_output_stream(self.output_data)
+
     def get_userdata(self, tag):
         return self.user_data.get(tag, 'unknown')
 
@@ -281,62 +772,646 @@ class TransformStatus(object):
         return self.user_data.get('error_code')
 
 
+class RuntimeState(object):
+    '''The reloadable part of a Transformer: its actions (with their compiled shapes), the
+    content protocol used to decode requests and the custom field validator table.
+    A hot reload builds a complete new RuntimeState and swaps it in with one assignment.
+    '''
+
+    def __init__(self, actions, content_protocol, field_validators):
+        self.actions = actions
+        self.content_protocol = content_protocol
+        self.field_validators = field_validators
+
+
+
+class BoundTransform(object):
+    '''A handle on one registered transform, for generated handlers which serve the same
+    transform on every request (see "routegen --optimize"). It holds the transform's
+    Action, so its calls skip the lookups by name; Transformer.swap_state() rebinds it
+    to the new Action on a hot reload.
+    '''
+
+    def __init__(self, transformer, type_name):
+        self.transformer = transformer
+        self.name = type_name
+        self.action = transformer.actions.get(type_name)
+        if not self.action:
+            raise UnregisteredTransformException(type_name)
+
+
+    def rebind(self, state):
+        action = state.actions.get(self.name)
+        if action is not None:
+            self.action = action
+
+
+    @property
+    def response_cache(self):
+        return self.action.response_cache
+
+
+    def negotiate(self, accept_header):
+        '''Same as Transformer.target_mimetype_for_transform(), without the lookup.'''
+        action = self.action
+        if not accept_header or accept_header == '*/*':
+            return action.output_mimetype
+        return negotiate(accept_header, action.output_mimetypes)
+
+
+    def admit(self, block=True):
+        admission_controller = self.action.admission
+        if admission_controller is None:
+            return admission.NULL_PERMIT
+        return admission_controller.try_acquire(block)
+
+
+    def transform(self, input_data, **kwargs):
+        if input_data is None:
+            raise NullTransformInputDataException(self.name)
+        action = self.action
+        transformer = self.transformer
+        if action.coalescer is None and not action.timeout_ms and action.executor_pool is None \
+           and transformer.metrics is None and 'deadline' not in kwargs \
+           and parse_timeout_header(kwargs.get('headers')) is None:
+            # nothing to coalesce, time or wait on: run it inline, as Transformer._transform() would
+            try:
+                return action.execute(input_data, transformer.services, **kwargs)
+            except Exception as err:
+                return transformer.error_status(err)
+        return transformer.run_action(self.name, action, input_data, **kwargs)
+
+
+    async def transform_async(self, input_data, **kwargs):
+        if input_data is None:
+            raise NullTransformInputDataException(self.name)
+        return await self.transformer.run_action_async(self.name, self.action, input_data, **kwargs)
+
+
+
 class Transformer():
-    def __init__(self, service_object_tbl):
+    def __init__(self, service_object_tbl, **kwargs):
         self.services = service_object_tbl
-        self.actions = {}
+        self.state = RuntimeState({}, default_content_protocol, custom_field_type_validators)
         self.error_table = {}
+        self.sync_threads = kwargs.get('sync_threads') or DEFAULT_SYNC_THREADS
+        self._executor = None
+        self.executor_pools = {}
+        self.bound_transforms = {}
+        self.metrics = None
+
+
+    @property
+    def actions(self):
+        return self.state.actions
+
+
+    def swap_state(self, new_state):
+        '''Atomically replace the actions, content protocol and field validators. Every
+        lookup sees either the old state or the new one, never a partly built one.
+        '''
+        old_state = self.state
+        self.state = new_state
+        for bound_transform in self.bound_transforms.values():
+            bound_transform.rebind(new_state)
+        return old_state
+
+
+    def bind(self, type_name):
+        '''Return the BoundTransform for a registered transform.'''
+        bound_transform = self.bound_transforms.get(type_name)
+        if bound_transform is None:
+            bound_transform = self.bound_transforms[type_name] = BoundTransform(self, type_name)
+        return bound_transform
+
+
+    def map_content(self, http_request):
+        return self.state.content_protocol.decode(http_request)
+
+
+    def map_stream_content(self, http_request):
+        return self.state.content_protocol.decode_stream(http_request)
+
+
+    @property
+    def executor(self):
+        '''Thread pool used by the async runtime to run synchronous transform functions.'''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.sync_threads,
+                                                thread_name_prefix='snap-transform')
+        return self._executor
+
+
+    def enable_instrumentation(self):
+        '''Start recording per-transform, per-stage latencies. See stage_report().'''
+        if self.metrics is None:
+            self.metrics = metrics.TransformMetrics()
+        return self.metrics
+
+
+    def disable_instrumentation(self):
+        self.metrics = None
+
+
+    def timed(self, type_name, stage):
+        '''Return a context manager which records the time spent in one stage of a
+        transform request. When instrumentation is off this is a shared no-op.
+        '''
+        if self.metrics is None:
+            return metrics.NULL_TIMER
+        return self.metrics.time(type_name, stage)
+
+
+    def stage_report(self):
+        '''Return latency percentiles and call counts by transform and stage
+        (decode, validate, transform, respond).
+        '''
+        if self.metrics is None:
+            return {}
+        return self.metrics.report()
 
 
     def register_transform(self, type_name, input_shape, transform_func, mimetype):
         self.actions[type_name] = Action(input_shape, transform_func, mimetype)
 
 
+    def register_batch_transform(self, type_name, batch_func):
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        action.batch_function = batch_func
+
+
+    def enable_response_cache(self, type_name, ttl, max_entries=None, key_fields=None):
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        action.response_cache = cache.ResponseCache(ttl, max_entries, key_fields)
+        return action.response_cache
+
+
+    def response_cache(self, type_name):
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        return action.response_cache
+
+
+    def cache_stats(self):
+        '''Return the hit/miss counters for every transform with a response cache, by transform name.'''
+        return {name: action.response_cache.stats() for name, action in self.actions.items()
+                if action.response_cache is not None}
+
+
+    def enable_coalescing(self, type_name):
+        '''Let concurrent requests to a transform with identical input data share a single
+        execution. Only for transforms whose output depends on nothing but their input data.
+        '''
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        action.coalescer = concurrency.SingleFlight()
+        return action.coalescer
+
+
+    def coalescing_stats(self):
+        '''Return the execution/sharing counters for every coalescing transform, by transform name.'''
+        return {name: action.coalescer.stats() for name, action in self.actions.items()
+                if action.coalescer is not None}
+
+
+    def enable_admission_control(self, type_name, **settings):
+        '''Limit the number of concurrent requests to a transform; see admission.AdmissionController
+        for the settings.
+        '''
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        action.admission = admission.AdmissionController(**settings)
+        return action.admission
+
+
+    def admit(self, type_name, block=True):
+        '''Return a Permit for one request to a transform, or None if the request should be
+        shed. Transforms without admission control admit everything.
+        '''
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        if action.admission is None:
+            return admission.NULL_PERMIT
+        return action.admission.try_acquire(block)
+
+
+    def retry_after(self, type_name):
+        action = self.actions.get(type_name)
+        if not action or action.admission is None:
+            return str(admission.DEFAULT_RETRY_AFTER)
+        return action.admission.retry_after
+
+
+    def admission_stats(self):
+        '''Return the limit, occupancy and shed counters for every admission-controlled transform.'''
+        return {name: action.admission.stats() for name, action in self.actions.items()
+                if action.admission is not None}
+
+
+    def set_timeout(self, type_name, timeout_ms):
+        '''Run a transform under a deadline of timeout_ms milliseconds; see request_deadline().'''
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        action.timeout_ms = timeout_ms
+
+
+    def request_deadline(self, action, kwargs):
+        '''Return the earliest of the deadlines that apply to a transform request: one passed
+        in by the caller, the transform's own timeout and the request's X-Request-Timeout-Ms
+        header. None means the request has no deadline.
+        '''
+        deadlines = []
+        if kwargs.get('deadline') is not None:
+            deadlines.append(kwargs['deadline'])
+        if action.timeout_ms:
+            deadlines.append(Deadline(action.timeout_ms))
+        header_timeout_ms = parse_timeout_header(kwargs.get('headers'))
+        if header_timeout_ms:
+            deadlines.append(Deadline(header_timeout_ms))
+        if not deadlines:
+            return None
+        return min(deadlines, key=lambda d: d.expires_at)
+
+
+    def add_executor_pool(self, pool_name, threads, max_queue=None):
+        self.executor_pools[pool_name] = executors.BoundedExecutor(pool_name, threads, max_queue)
+        return self.executor_pools[pool_name]
+
+
+    def assign_executor_pool(self, type_name, pool_name):
+        '''Run a transform's (synchronous) transform function on the named executor pool,
+        isolating it from the transforms which run on other pools or inline.
+        '''
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        if pool_name not in self.executor_pools:
+            raise executors.NoSuchExecutorPoolException(pool_name)
+        action.executor_pool = self.executor_pools[pool_name]
+
+
+    def executor_pool_stats(self):
+        return {name: pool.stats() for name, pool in self.executor_pools.items()}
+
+
     def register_error_code(self, exception_type, code):          
         self.error_table[exception_type.__name__] = code
 
 
-    def target_mimetype_for_transform(self, type_name):
+    def error_status(self, err, default_code=None):
+        '''Convert an exception raised while transforming into a failed TransformStatus,
+        using the registered error code for its type. Unknown exceptions are re-raised
+        unless a default code is given.
+        '''
+        error_code = self.error_table.get(err.__class__.__name__) or default_code
+        if not error_code:
+            raise err
+        return TransformStatus(None, False, error_message=str(err), error_code=error_code)
+
+
+    def target_mimetype_for_transform(self, type_name, accept_header=None):
+        '''Return the output mimetype for a transform. If the request's Accept header is
+        passed, choose the best of the transform's mimetypes for the client; None means
+        the client accepts none of them.
+        '''
         action = self.actions.get(type_name)          
         if not action:              
              raise UnregisteredTransformException(type_name)
-        return action.output_mimetype
+        if accept_header is None:
+            return action.output_mimetype
+        return negotiate(accept_header, action.output_mimetypes)
       
           
-    def transform(self, type_name, raw_input_data, **kwargs):
-        if raw_input_data is None:
+    def transform(self, type_name, input_data, **kwargs):
+        if input_data is None:
             raise NullTransformInputDataException(type_name)
-
-        input_data = {}
-        for key in raw_input_data:
-            encoded_key = key
-            encoded_value = raw_input_data[key]
-            if key.__class__.__name__ == 'unicode':
-                encoded_key = key.encode('utf-8')
-
-            if encoded_value.__class__.__name__ == 'unicode':
-                encoded_value = encoded_value.encode('utf-8')
-            input_data[encoded_key] = encoded_value
           
         action = self.actions.get(type_name)          
         if not action:              
             raise UnregisteredTransformException(type_name)
+        return self.run_action(type_name, action, input_data, **kwargs)
+
 
+    def run_action(self, type_name, action, input_data, **kwargs):
+        '''Run an Action which the caller has already looked up (see bind()).'''
+        if action.coalescer is None:
+            return self._transform(type_name, action, input_data, **kwargs)
+
+        # a follower waits for the shared call only until its own deadline
+        deadline = self.request_deadline(action, kwargs)
+        key = concurrency.coalescing_key(input_data)
+        try:
+            transform_status, shared = action.coalescer.do(key, self._transform, type_name, action, input_data,
+                                                           timeout=deadline.remaining() if deadline else None,
+                                                           **kwargs)
+        except concurrency.FlightTimeoutException:
+            return self.error_status(TransformTimeoutException(type_name, deadline.timeout_ms), HTTP_GATEWAY_TIMEOUT)
+        if shared and transform_status.is_streaming:
+            # a stream can only be consumed once; this caller needs its own
+            return self._transform(type_name, action, input_data, **kwargs)
+        return transform_status
+
+
+    def _transform(self, type_name, action, input_data, **kwargs):
         try:
-            return action.execute(input_data, self.services, **kwargs)
+            deadline = self.request_deadline(action, kwargs)
+            # the deadline goes to the transform as its own argument; see _call_on_executor()
+            kwargs.pop('deadline', None)
+            if deadline is not None or action.executor_pool is not None:
+                with self.timed(type_name, 'validate'):
+                    action.validate(input_data)
+                with self.timed(type_name, 'transform'):
+                    return self._dispatch(type_name, action, input_data, deadline, **kwargs)
+
+            if self.metrics is None:
+                return action.execute(input_data, self.services, **kwargs)
+
+            with self.metrics.time(type_name, 'validate'):
+                action.validate(input_data)
+            with self.metrics.time(type_name, 'transform'):
+                return action.run(input_data, self.services, **kwargs)
         except Exception as err:
-            error_type = err.__class__.__name__              
-            if self.error_table.get(error_type):
-                return TransformStatus(None, 
-                                       False, 
-                                       error_message=str(err),  
-                                       error_code=self.error_table[error_type])
             # if we don't know what code to return for a given downstream exception, 
-            # re-raise it and assume that someone will handle it upstream
-            raise err
+            # error_status() re-raises it and assumes that someone will handle it upstream
+            return self.error_status(err)
 
 
+    def _dispatch(self, type_name, action, input_data, deadline, **kwargs):
+        # Run the transform on its executor pool, or on the shared executor if it only has
+        # a deadline, so that this thread can stop waiting for it when the deadline passes.
+        # Python threads cannot be killed: a transform that overruns its deadline keeps its
+        # executor thread until it returns, which is why it is handed the deadline.
+        return self._call_on_executor(type_name, action, deadline, action.run, input_data, self.services, **kwargs)
 
 
+    def _call_on_executor(self, type_name, action, deadline, func, *args, **kwargs):
+        executor = action.executor_pool or self.executor
+        if deadline is None:
+            return executor.submit(func, *args, **kwargs).result()
 
+        if deadline.expired:
+            raise TransformTimeoutException(type_name, deadline.timeout_ms)
+        kwargs['deadline'] = deadline
+        future = executor.submit(func, *args, **kwargs)
+        try:
+            return future.result(timeout=deadline.remaining())
+        except FutureTimeoutError:
+            future.cancel()
+            raise TransformTimeoutException(type_name, deadline.timeout_ms)
+
+
+    def transform_batch(self, type_name, records, **kwargs):
+        '''Validate and transform a list of input records in one call. Returns a list of
+        TransformStatus objects, one per record and in the same order.
+
+        Records which pass validation are handed to the transform's batch function
+        (if one is registered) as a single list, so that it can do bulk work;
+        otherwise the regular transform function is called once per record.
+        '''
+        if records is None:
+            raise NullTransformInputDataException(type_name)
+
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+
+        statuses, valid_indices, valid_records = self._check_batch(type_name, action, records)
+        if not valid_records:
+            return statuses
+
+        # a batch runs under the same deadline and executor pool as a single request would,
+        # taking one pool thread for all of its records
+        deadline = self.request_deadline(action, kwargs)
+        kwargs.pop('deadline', None)
+        try:
+            with self.timed('%s_batch' % type_name, 'transform'):
+                if deadline is not None or action.executor_pool is not None:
+                    results = self._call_on_executor(type_name, action, deadline,
+                                                     self._run_batch, type_name, action, valid_records, **kwargs)
+                else:
+                    results = self._run_batch(type_name, action, valid_records, **kwargs)
+        except (TransformTimeoutException, executors.ExecutorPoolFullException) as err:
+            results = self.batch_error_statuses(err, len(valid_records))
+        return self._merge_batch_results(type_name, statuses, valid_indices, results)
+
+
+    def batch_error_statuses(self, err, count):
+        '''One failed TransformStatus per record, for an error which failed a whole batch (or
+        one record of it). Unlike a single request, a batch never lets an unmapped exception
+        escape: that would turn the other records' results into a 500.
+        '''
+        default_code = HTTP_DEFAULT_ERRORCODE
+        if isinstance(err, TransformTimeoutException):
+            default_code = HTTP_GATEWAY_TIMEOUT
+        elif isinstance(err, executors.ExecutorPoolFullException):
+            default_code = HTTP_SERVICE_UNAVAILABLE
+        elif err.__class__.__name__ not in self.error_table:
+            log.error('Exception thrown by a batch transform: ', exc_info=err)
+        return [self.error_status(err, default_code) for i in range(count)]
+
+
+    def _check_batch(self, type_name, action, records):
+        '''Validate a batch. Returns the list of statuses, with the invalid records' errors
+        filled in, and the indices and the records which passed.
+        '''
+        compiled_shape = action.input_shape.compile()
+        statuses = [None] * len(records)
+        valid_indices = []
+        valid_records = []
+        # batch requests are timed separately from single-record requests to the same transform
+        with self.timed('%s_batch' % type_name, 'validate'):
+            for index, record in enumerate(records):
+                missing, errors = compiled_shape.check(record)
+                if missing:
+                    statuses[index] = self.error_status(MissingInputFieldException(missing), HTTP_BAD_REQUEST)
+                elif errors:
+                    statuses[index] = self.error_status(NonCompliantDataFormat(errors), HTTP_BAD_REQUEST)
+                else:
+                    valid_indices.append(index)
+                    valid_records.append(record)
+        return statuses, valid_indices, valid_records
+
+
+    def _merge_batch_results(self, type_name, statuses, valid_indices, results):
+        results = list(results)
+        if len(results) != len(valid_indices):
+            raise BatchResultMismatchException(type_name, len(valid_indices), len(results))
+        for index, status in zip(valid_indices, results):
+            statuses[index] = status
+        return statuses
+
+
+    def _run_batch(self, type_name, action, valid_records, **kwargs):
+        if action.batch_function:
+            try:
+                return action.run_batch(valid_records, self.services, **kwargs)
+            except Exception as err:
+                return self.batch_error_statuses(err, len(valid_records))
+
+        results = []
+        for record in valid_records:
+            try:
+                results.append(action.run(record, self.services, **kwargs))
+            except Exception as err:
+                results.extend(self.batch_error_statuses(err, 1))
+        return results
+
+
+    def transform_stream(self, type_name, input_data, records, **kwargs):
+        '''Run a streaming transform. The transform function is called once, with the
+        request's route variables and query args as its input data and an iterator over
+        the decoded body records in the "records" keyword argument.
+
+        Each record is validated against the transform's InputShape as the transform
+        consumes it, so the body never has to be held in memory all at once.
+        '''
+        if records is None:
+            raise NullTransformInputDataException(type_name)
+
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+
+        compiled_shape = action.input_shape.compile()
+
+        def validated_records():
+            for record in records:
+                compiled_shape.validate(record)
+                yield record
+
+        try:
+            with self.timed(type_name, 'transform'):
+                return action.run(input_data, self.services, records=validated_records(), **kwargs)
+        except Exception as err:
+            return self.error_status(err)
+
+
+    async def transform_async(self, type_name, raw_input_data, **kwargs):
+        '''Coroutine counterpart to transform(), for the ASGI runtime. async transform
+        functions are awaited directly; synchronous ones run on the Transformer's executor.
+        '''
+        if raw_input_data is None:
+            raise NullTransformInputDataException(type_name)
+
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+        return await self.run_action_async(type_name, action, raw_input_data, **kwargs)
+
+
+    async def run_action_async(self, type_name, action, raw_input_data, **kwargs):
+        if action.coalescer is None:
+            return await self._transform_async(type_name, action, raw_input_data, **kwargs)
+
+        deadline = self.request_deadline(action, kwargs)
+        key = concurrency.coalescing_key(raw_input_data)
+        try:
+            transform_status, shared = await action.coalescer.do_async(key, self._transform_async,
+                                                                       type_name, action, raw_input_data,
+                                                                       timeout=deadline.remaining() if deadline else None,
+                                                                       **kwargs)
+        except concurrency.FlightTimeoutException:
+            return self.error_status(TransformTimeoutException(type_name, deadline.timeout_ms), HTTP_GATEWAY_TIMEOUT)
+        if shared and transform_status.is_streaming:
+            return await self._transform_async(type_name, action, raw_input_data, **kwargs)
+        return transform_status
+
+
+    async def _transform_async(self, type_name, action, raw_input_data, **kwargs):
+        # synchronous transform functions run on the transform's executor pool, if it has one
+        executor = action.executor_pool or self.executor
+        try:
+            deadline = self.request_deadline(action, kwargs)
+            if deadline is not None:
+                with self.timed(type_name, 'validate'):
+                    action.validate(raw_input_data)
+                kwargs['deadline'] = deadline
+                try:
+                    with self.timed(type_name, 'transform'):
+                        return await asyncio.wait_for(action.run_async(raw_input_data, self.services, executor, **kwargs),
+                                                      deadline.remaining())
+                except asyncio.TimeoutError:
+                    raise TransformTimeoutException(type_name, deadline.timeout_ms)
+
+            if self.metrics is None:
+                return await action.execute_async(raw_input_data, self.services, executor, **kwargs)
+
+            with self.metrics.time(type_name, 'validate'):
+                action.validate(raw_input_data)
+            with self.metrics.time(type_name, 'transform'):
+                return await action.run_async(raw_input_data, self.services, executor, **kwargs)
+        except Exception as err:
+            return self.error_status(err)
+
+
+    async def transform_batch_async(self, type_name, records, **kwargs):
+        '''Coroutine counterpart to transform_batch(). async transform (and batch) functions
+        are awaited on the event loop; synchronous ones run on the executor.
+        '''
+        if records is None:
+            raise NullTransformInputDataException(type_name)
+
+        action = self.actions.get(type_name)
+        if not action:
+            raise UnregisteredTransformException(type_name)
+
+        statuses, valid_indices, valid_records = self._check_batch(type_name, action, records)
+        if not valid_records:
+            return statuses
+
+        deadline = self.request_deadline(action, kwargs)
+        try:
+            with self.timed('%s_batch' % type_name, 'transform'):
+                if deadline is None:
+                    results = await self._run_batch_async(type_name, action, valid_records, **kwargs)
+                else:
+                    kwargs['deadline'] = deadline
+                    try:
+                        results = await asyncio.wait_for(self._run_batch_async(type_name, action, valid_records, **kwargs),
+                                                         deadline.remaining())
+                    except asyncio.TimeoutError:
+                        raise TransformTimeoutException(type_name, deadline.timeout_ms)
+        except (TransformTimeoutException, executors.ExecutorPoolFullException) as err:
+            results = self.batch_error_statuses(err, len(valid_records))
+        return self._merge_batch_results(type_name, statuses, valid_indices, results)
+
+
+    async def _run_batch_async(self, type_name, action, valid_records, **kwargs):
+        executor = action.executor_pool or self.executor
+        if action.batch_function:
+            try:
+                return await action.run_batch_async(valid_records, self.services, executor, **kwargs)
+            except executors.ExecutorPoolFullException:
+                raise
+            except Exception as err:
+                return self.batch_error_statuses(err, len(valid_records))
+
+        if not action.is_async:
+            # one executor call for the whole batch, rather than one per record
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor,
+                                              functools.partial(self._run_batch, type_name, action, valid_records, **kwargs))
+
+        async def run_record(record):
+            try:
+                return await action.run_async(record, self.services, executor, **kwargs)
+            except Exception as err:
+                return self.batch_error_statuses(err, 1)[0]
+
+        return await asyncio.gather(*[run_record(record) for record in valid_records])
+
+
+    async def transform_stream_async(self, type_name, input_data, records, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(self.transform_stream, type_name, input_data, records, **kwargs))
 
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
 
+import codecs
+import csv
 import json
 import urllib
 from urllib.parse import urlparse, parse_qs
+from snap import jsoncodec
+from snap import wireformats
 from snap.loggers import request_logger as log
 
 
 def decode_application_json(http_request):
     log.info('### Invoking application/json request decoder.')
-    decoder_output = json.loads(http_request.data.decode())    
+    decoder_output = jsoncodec.loads(http_request.data)    
     return decoder_output
 
 
@@ -17,14 +21,14 @@ def decode_text_plain(http_request):
     log.info('### Invoking text/plain request decoder.')
     if not len(http_request.data):
         return {}
-    return json.loads(http_request.data.decode())
+    return jsoncodec.loads(http_request.data)
 
 
 def decode_text_plain_utf8(http_request):
     log.info('### Invoking text/plain; charset=UTF-8 request decoder.')
     if not len(http_request.data):
         return {}
-    return json.loads(http_request.data.decode())
+    return jsoncodec.loads(http_request.data)
 
 
 def decode_form_urlencoded(http_request):
@@ -38,3 +42,32 @@ def decode_form_urlencoded(http_request):
         value = urllib.parse.unquote(tokens[1])
         data[key] = value
     return data
+
+
+def decode_msgpack(http_request):
+    log.info('### Invoking application/msgpack request decoder.')
+    if not len(http_request.data):
+        return {}
+    return wireformats.get(wireformats.MIMETYPE_MSGPACK).loads(http_request.data)
+
+
+def decode_cbor(http_request):
+    log.info('### Invoking application/cbor request decoder.')
+    if not len(http_request.data):
+        return {}
+    return wireformats.get(wireformats.MIMETYPE_CBOR).loads(http_request.data)
+
+
+def decode_ndjson_stream(http_request):
+    log.info('### Invoking application/x-ndjson streaming request decoder.')
+    for line in http_request.stream:
+        if line.strip():
+            yield jsoncodec.loads(line)
+
+
+def decode_csv_stream(http_request):
+    log.info('### Invoking text/csv streaming request decoder.')
+    reader = csv.DictReader(codecs.iterdecode(http_request.stream, 'utf-8'))
+    for row in reader:
+        yield row
+
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+#
+# Named executor pools ("bulkheads") for transforms.
+#
+# A transform assigned to a pool runs on that pool's threads only, and the pool
+# holds at most max_queue waiting calls beyond those threads. A slow transform
+# can therefore use up its own pool, but never the worker threads serving the
+# other transforms in the same process: calls over its pool's capacity are
+# refused at once with ExecutorPoolFullException.
+#
+
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorPoolFullException(Exception):
+    def __init__(self, pool_name, capacity):
+        Exception.__init__(self, 'The executor pool "%s" is full (%d running or queued calls).' % (pool_name, capacity))
+
+
+class NoSuchExecutorPoolException(Exception):
+    def __init__(self, pool_name):
+        Exception.__init__(self, 'No executor pool named "%s" has been configured.' % pool_name)
+
+
+class InvalidExecutorPoolSettingsException(Exception):
+    def __init__(self, pool_name, reason):
+        Exception.__init__(self, 'Invalid settings for executor pool "%s": %s' % (pool_name, reason))
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    '''A ThreadPoolExecutor whose queue holds at most max_queue calls (by default, as many
+    as it has threads). submit() raises ExecutorPoolFullException rather than queueing more.
+    '''
+
+    def __init__(self, name, threads, max_queue=None):
+        if not isinstance(threads, int) or threads < 1:
+            raise InvalidExecutorPoolSettingsException(name, 'threads must be a positive integer.')
+        if max_queue is None:
+            max_queue = threads
+        if not isinstance(max_queue, int) or max_queue < 0:
+            raise InvalidExecutorPoolSettingsException(name, 'max_queue must be zero or a positive integer.')
+
+        ThreadPoolExecutor.__init__(self, max_workers=threads, thread_name_prefix='snap-pool-%s' % name)
+        self.name = name
+        self.threads = threads
+        self.max_queue = max_queue
+        self.capacity = threads + max_queue
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.pending >= self.capacity:
+                self.rejected += 1
+                raise ExecutorPoolFullException(self.name, self.capacity)
+            self.pending += 1
+        try:
+            future = ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(self._call_done)
+        return future
+
+
+    def _call_done(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+
+    def stats(self):
+        with self._lock:
+            return {'threads': self.threads,
+                    'capacity': self.capacity,
+                    'pending': self.pending,
+                    'completed': self.completed,
+                    'rejected': self.rejected}
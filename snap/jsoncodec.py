@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+#
+# Pluggable JSON encoding and decoding for request bodies and responses.
+#
+# The codec is selected with the "json_codec" setting in the globals section
+# of the config file (stdlib, orjson, ujson or auto). If the requested library
+# is not installed, snap falls back to the next fastest one available.
+#
+
+
+import json
+import logging
+
+
+log = logging.getLogger('init')
+
+AUTO_CODEC_ORDER = ['orjson', 'ujson', 'stdlib']
+
+
+class UnsupportedJSONCodecException(Exception):
+    def __init__(self, codec_name):
+        Exception.__init__(self, 'Unsupported JSON codec "%s". Valid codecs are: auto, %s.'
+                           % (codec_name, ', '.join(CODECS.keys())))
+
+
+def encode_default(obj):
+    # complex numbers are encoded as [real, imag], as core.ComplexEncoder does
+    if isinstance(obj, complex):
+        return [obj.real, obj.imag]
+    raise TypeError('Object of type %s is not JSON serializable' % obj.__class__.__name__)
+
+
+class StdlibCodec(object):
+    name = 'stdlib'
+
+    def loads(self, data):
+        # json.loads accepts bytes directly, so there is no need to decode to str first
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=encode_default)
+
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode()
+
+
+class OrjsonCodec(object):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+    def dumps(self, obj):
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj):
+        return self._orjson.dumps(obj, default=encode_default, option=self._options)
+
+
+class UjsonCodec(object):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, default=encode_default)
+
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode()
+
+
+CODECS = {
+    'stdlib': StdlibCodec,
+    'orjson': OrjsonCodec,
+    'ujson': UjsonCodec
+}
+
+current = StdlibCodec()
+
+
+def select(codec_name=None):
+    '''Make the named codec the one used by loads() and dumps(). "auto" picks the fastest
+    installed library; an uninstalled one falls back to the next in line.
+    '''
+    global current
+
+    codec_name = codec_name or 'stdlib'
+    if codec_name == 'auto':
+        candidates = AUTO_CODEC_ORDER
+    elif codec_name in CODECS:
+        candidates = [codec_name] + [c for c in AUTO_CODEC_ORDER if c != codec_name]
+    else:
+        raise UnsupportedJSONCodecException(codec_name)
+
+    for candidate in candidates:
+        try:
+            current = CODECS[candidate]()
+            break
+        except ImportError:
+            log.warning('JSON codec "%s" is not installed; trying the next available codec.' % candidate)
+
+    return current
+
+
+def loads(data):
+    return current.loads(data)
+
+
+def dumps(obj):
+    return current.dumps(obj)
+
+
+def dumps_bytes(obj):
+    return current.dumps_bytes(obj)
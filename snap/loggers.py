@@ -1,7 +1,5 @@
 import logging
 import logging.config
-import pkgutil
-import yaml
 from snap import snap
 
 #logging.config.dictConfig(snap.logging_config)
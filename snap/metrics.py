@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+#
+# Per-transform, per-stage latency instrumentation
+#
+
+
+import contextlib
+import math
+import threading
+import time
+
+
+STAGES = ('decode', 'validate', 'transform', 'respond')
+
+# bucket boundaries grow geometrically, so every recorded latency is
+# reported to within about 2% of its real value
+BUCKET_GROWTH = 1.04
+LOG_BUCKET_GROWTH = math.log(BUCKET_GROWTH)
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+class LatencyHistogram(object):
+    '''Log-bucketed latency histogram. Recording a sample costs one log() and one
+    dict update; percentiles are computed from the buckets on demand.
+    '''
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def record(self, seconds):
+        microseconds = seconds * 1e6
+        bucket = int(math.log(microseconds) / LOG_BUCKET_GROWTH) if microseconds > 1 else 0
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+
+    def percentile(self, pct):
+        '''Return the latency, in seconds, below which pct percent of the samples fall.'''
+        with self._lock:
+            if not self.count:
+                return 0.0
+            threshold = self.count * pct / 100.0
+            seen = 0
+            for bucket in sorted(self._buckets):
+                seen += self._buckets[bucket]
+                if seen >= threshold:
+                    # report the midpoint of the bucket
+                    return min(BUCKET_GROWTH ** (bucket + 0.5) / 1e6, self.max)
+            return self.max
+
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': (self.total / self.count) * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1000,
+                'p95_ms': self.percentile(95) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                'max_ms': self.max * 1000}
+
+
+
+class StageTimer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+
+
+class TransformMetrics(object):
+    '''Latency histograms keyed by (transform name, stage).'''
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+    def histogram(self, transform_name, stage):
+        key = (transform_name, stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+
+    def time(self, transform_name, stage):
+        return StageTimer(self.histogram(transform_name, stage))
+
+
+    def report(self):
+        '''Return {transform name: {stage: summary}} for every stage with recorded samples.'''
+        report = {}
+        for (transform_name, stage), histogram in list(self._histograms.items()):
+            report.setdefault(transform_name, {})[stage] = histogram.summary()
+        return report
+
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
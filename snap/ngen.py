@@ -1,13 +1,13 @@
 #!/usr/bin/env python
 #
-# ngen: nginx initfile generator for snap microservices 
-# 
+# ngen: nginx initfile generator for snap microservices
+#
 #
 # Note: the docopt usage string must start on the first non-comment, non-whitespace line.
 #
 
-"""Usage: 
-        ngen.py [--env=<environment>] <configfile> 
+"""Usage:
+        ngen.py [--env=<environment>] <configfile>
         ngen.py (-l | --list) <configfile>
         ngen.py (-h | --help)
 
@@ -20,40 +20,185 @@ Options:
 
 
 from docopt import docopt
-import yaml
+import re
 import jinja2
 import os, sys
-import common
+from snap import common
+from snap import config_templates
+
+
+BALANCE_METHODS = ['least_conn', 'round_robin', 'ip_hash']
+UPSTREAM_PROTOCOLS = ['uwsgi', 'http']
+DEFAULT_GZIP_TYPES = ['application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/xml', 'application/xml']
+DEFAULT_MICROCACHE_TTL = 1
+
+
+class InvalidNginxSettingException(Exception):
+    def __init__(self, server_name, reason):
+        Exception.__init__(self, 'Invalid settings for nginx server "%s": %s' % (server_name, reason))
+
+
+class UpstreamServer(object):
+    '''One uWSGI instance in an upstream pool: a socket file, or a host:port address,
+    plus any nginx server parameters (weight, max_fails, fail_timeout, backup).
+    '''
+
+    def __init__(self, address, **params):
+        self.address = address
+        self.params = params
+
+
+    def __str__(self):
+        address = 'unix:%s' % self.address if self.address.startswith(os.sep) else self.address
+        params = ['%s=%s' % (name, value) for name, value in sorted(self.params.items()) if name != 'backup']
+        if self.params.get('backup'):
+            params.append('backup')
+        return ' '.join([address] + params)
 
 
-class NginxConfig():
-    def __init__(self, name, hostname, port, socket_file):
+
+class MicrocachedRoute(object):
+    def __init__(self, route, ttl):
+        self.route = route
+        self.ttl = ttl
+
+
+    @property
+    def location(self):
+        # Flask-style route variables (<int:id>) become regex path segments
+        if '<' not in self.route:
+            return '= %s' % self.route
+        segments = re.split(r'<[^>]+>', self.route)
+        return '~ ^%s$' % '[^/]+'.join(re.escape(segment) for segment in segments)
+
+
+
+class NginxConfig(object):
+    def __init__(self, name, hostname, port, upstream_servers, **settings):
         self.name = name
         self.hostname = hostname
         self.port = port
-        self.uwsgi_sockfile = socket_file
+        if not upstream_servers:
+            raise InvalidNginxSettingException(name, 'at least one uWSGI socket or upstream server is required.')
+        self.upstream_servers = upstream_servers
 
+        self.protocol = settings.get('protocol', 'uwsgi')
+        if self.protocol not in UPSTREAM_PROTOCOLS:
+            raise InvalidNginxSettingException(name, 'protocol must be one of %s.' % ', '.join(UPSTREAM_PROTOCOLS))
+        self.balance = settings.get('balance', 'least_conn')
+        if self.balance not in BALANCE_METHODS:
+            raise InvalidNginxSettingException(name, 'balance must be one of %s.' % ', '.join(BALANCE_METHODS))
 
-    def __repr__(self):
-        return '%s:\n--hostname: %s\n--port: %s\n--uWSGI socket: %s' % (self.name, 
-                                                                   self.hostname, 
-                                                                   self.port, 
-                                                                   self.uwsgi_sockfile)
+        # nginx can only reuse upstream connections over HTTP/1.1; the uwsgi protocol
+        # closes the connection after every request
+        self.upstream_keepalive = settings.get('upstream_keepalive', 32) if self.protocol == 'http' else 0
+        self.worker_processes = settings.get('worker_processes', 'auto')
+        self.worker_connections = settings.get('worker_connections', 4096)
+        self.keepalive_timeout = settings.get('keepalive_timeout', 65)
+        self.reuseport = settings.get('reuseport', False)
+
+        self.gzip = settings.get('gzip', True)
+        self.gzip_comp_level = settings.get('gzip_comp_level', 5)
+        self.gzip_min_length = settings.get('gzip_min_length', 1024)
+        self.gzip_types = settings.get('gzip_types', DEFAULT_GZIP_TYPES)
+
+        self.buffering = settings.get('buffering', True)
+        self.buffer_size = settings.get('buffer_size', '16k')
+        self.buffers = settings.get('buffers', '8 16k')
+        self.busy_buffers_size = settings.get('busy_buffers_size', '32k')
 
+        self.microcache = settings.get('microcache')
+        self.microcached_routes = settings.get('microcached_routes', []) if self.microcache else []
+
+
+    @property
+    def pass_module(self):
+        return 'uwsgi' if self.protocol == 'uwsgi' else 'proxy'
+
+
+    @property
+    def upstream_name(self):
+        return 'snap_%s' % re.sub(r'\W', '_', self.name)
+
+
+    @property
+    def upstream_scheme(self):
+        return '' if self.protocol == 'uwsgi' else 'http://'
+
+
+    def __repr__(self):
+        return '%s:\n--hostname: %s\n--port: %s\n--upstream (%s, %s): %s' % (self.name,
+                                                                          self.hostname,
+                                                                          self.port,
+                                                                          self.protocol,
+                                                                          self.balance,
+                                                                          ', '.join(str(s) for s in self.upstream_servers))
+
+
+
+def load_upstream_servers(server_config):
+    # uwsgi_sock is the original single-socket setting; upstreams lists any number of sockets and hosts
+    servers = []
+    if server_config.get('uwsgi_sock'):
+        servers.append(UpstreamServer(server_config['uwsgi_sock']))
+    for upstream in server_config.get('upstreams') or []:
+        if isinstance(upstream, dict):
+            params = dict(upstream)
+            servers.append(UpstreamServer(params.pop('address'), **params))
+        else:
+            servers.append(UpstreamServer(upstream))
+    return servers
+
+
+def load_microcache_settings(server_name, server_config):
+    microcache = server_config.get('microcache')
+    if not microcache:
+        return None
+    if microcache is True:
+        microcache = {}
+    ttl = microcache.get('ttl', DEFAULT_MICROCACHE_TTL)
+    if not isinstance(ttl, int) or isinstance(ttl, bool) or ttl < 1:
+        raise InvalidNginxSettingException(server_name, 'microcache ttl must be a positive number of seconds.')
+    return {'ttl': ttl,
+            'path': microcache.get('path', '/var/cache/nginx/snap_%s' % server_name),
+            'zone_size': microcache.get('zone_size', '10m'),
+            'max_size': microcache.get('max_size', '256m')}
+
+
+def load_microcached_routes(yaml_config, microcache):
+    '''Every GET transform with a cache section is microcached, for the microcache ttl or the
+    transform's own ttl, whichever is shorter.
+    '''
+    routes = []
+    for transform_config in (yaml_config.get('transforms') or {}).values():
+        cache_settings = transform_config.get('cache')
+        if cache_settings and transform_config.get('method', 'GET').upper() == 'GET':
+            ttl = min(microcache['ttl'], cache_settings.get('ttl') or microcache['ttl'])
+            routes.append(MicrocachedRoute(transform_config['route'], ttl))
+    return routes
 
 
 def load_nginx_config_table(yaml_config_obj):
     configs = {}
     config_section = yaml_config_obj['nginx_servers']
     for server_name in config_section:
-        host = config_section[server_name]['hostname']
-        port = config_section[server_name]['port']
-        uwsgi_socketfile = config_section[server_name]['uwsgi_sock']
-        configs[server_name] = NginxConfig(server_name, host, port, uwsgi_socketfile)
+        server_config = dict(config_section[server_name])
+        host = server_config.pop('hostname')
+        port = server_config.pop('port')
+        upstream_servers = load_upstream_servers(server_config)
+        microcache = load_microcache_settings(server_name, server_config)
+        server_config['microcache'] = microcache
+        if microcache:
+            server_config['microcached_routes'] = load_microcached_routes(yaml_config_obj, microcache)
+        configs[server_name] = NginxConfig(server_name, host, port, upstream_servers, **server_config)
 
     return configs
-        
-        
+
+
+def render_nginx_config(nginx_config):
+    j2env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+    return j2env.from_string(config_templates.NGINX_CONFIG).render(nginx_config=nginx_config)
+
 
 
 
@@ -62,18 +207,20 @@ def main():
 
     config_filename = common.full_path(args['<configfile>'])
     yaml_config = common.read_config_file(config_filename)
-    configs = load_nginx_config_table(yaml_config)
-    template_mgr = common.get_template_mgr_for_location('templates')
-    config_template = template_mgr.get_template('nginx_config.j2')
+    try:
+        configs = load_nginx_config_table(yaml_config)
+    except InvalidNginxSettingException as err:
+        print(str(err), file=sys.stderr)
+        exit(1)
 
     # show all the configurations
     #
-    if args['-l'] or args['--list']:        
+    if args['-l'] or args['--list']:
         for key in configs.keys():
-            print configs[key]
+            print(configs[key])
 
         exit(0)
-        
+
     # we can generate without a specific nginx config, iff there's just one
     #
     output = None
@@ -81,22 +228,22 @@ def main():
 
     if args['<configfile>'] and not config_name:
         if len(configs.keys()) > 1:
-            print 'Multiple configurations found. Please specify one.'
-            exit(0)        
-        output = config_template.render(nginx_config=configs.values()[0])
-        
+            print('Multiple configurations found. Please specify one.')
+            exit(0)
+        output = render_nginx_config(list(configs.values())[0])
+
     else:
         if not configs.get(config_name):
-            print 'No nginx configuration labeled "%s" in %s.' % (config_name, config_filename)
+            print('No nginx configuration labeled "%s" in %s.' % (config_name, config_filename))
             exit(0)
-        output = config_template.render(nginx_config=configs[config_name])
-        
-    print output
+        output = render_nginx_config(configs[config_name])
+
+    print(output)
     exit(0)
-        
 
 
-    
+
+
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+#
+# Pre-forking WSGI server for snap services ("snap serve").
+#
+# The master process imports the generated module once: the config, the service
+# objects and the route tables are built before any worker exists. It then calls
+# gc.freeze(), so that the collector in each worker never touches (and so never
+# copies) the objects inherited from the master, and forks the workers. They accept
+# connections from one listening socket inherited from the master or, with
+# reuseport, from per-worker SO_REUSEPORT sockets, which the kernel balances.
+#
+# The master only supervises: it replaces workers which exit, including those
+# recycled after max_requests requests or for using more than max_memory_mb of
+# private memory, and reports how much of the workers' memory is still shared.
+#
+# Signals to the master:
+#   TERM, INT   graceful shutdown: workers finish their requests in progress
+#   HUP         replace every worker (gracefully)
+#   USR1        log a memory report
+#
+
+
+import errno
+import gc
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import threading
+import time
+from werkzeug.serving import BaseWSGIServer, ThreadedWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
+
+
+log = logging.getLogger('init')
+
+DEFAULT_GRACEFUL_TIMEOUT = 30
+DEFAULT_BACKLOG = 1024
+# a worker which exits sooner than this after starting is considered to be crashing
+MIN_WORKER_LIFETIME = 1.0
+MAX_RESPAWN_DELAY = 10.0
+SMAPS_FIELDS = ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty']
+
+
+class InvalidServerSettingException(Exception):
+    def __init__(self, setting, value):
+        Exception.__init__(self, 'Invalid value %r for server setting "%s".' % (value, setting))
+
+
+def parse_smaps(smaps_text):
+    '''Sum the memory fields (in kB) of /proc/<pid>/smaps or smaps_rollup content.'''
+    totals = dict.fromkeys(SMAPS_FIELDS, 0)
+    for line in smaps_text.splitlines():
+        field, _, value = line.partition(':')
+        if field in totals:
+            totals[field] += int(value.split()[0])
+    return totals
+
+
+def read_memory_usage(pid):
+    '''Return the memory of a process in kB (rss, pss, shared and private), or None where
+    /proc does not provide it.
+    '''
+    for filename in ['smaps_rollup', 'smaps']:
+        try:
+            with open('/proc/%d/%s' % (pid, filename)) as f:
+                totals = parse_smaps(f.read())
+            break
+        except (IOError, OSError):
+            continue
+    else:
+        return None
+    return {'rss': totals['Rss'],
+            'pss': totals['Pss'],
+            'shared': totals['Shared_Clean'] + totals['Shared_Dirty'],
+            'private': totals['Private_Clean'] + totals['Private_Dirty']}
+
+
+def memory_report(pids):
+    '''Memory per worker, plus totals. The PSS total is the real cost of the whole group,
+    with each shared page divided among the processes which map it.
+    '''
+    workers = {}
+    for pid in pids:
+        usage = read_memory_usage(pid)
+        if usage is not None:
+            workers[pid] = usage
+    totals = {field: sum(usage[field] for usage in workers.values()) for field in ['rss', 'pss', 'shared', 'private']}
+    return {'workers': workers, 'totals': totals}
+
+
+def format_memory_report(report):
+    lines = ['%8s %10s %10s %10s %10s' % ('pid', 'rss kB', 'shared kB', 'private kB', 'pss kB')]
+    for pid, usage in sorted(report['workers'].items()):
+        lines.append('%8d %10d %10d %10d %10d' % (pid, usage['rss'], usage['shared'], usage['private'], usage['pss']))
+    totals = report['totals']
+    lines.append('%8s %10d %10d %10d %10d' % ('total', totals['rss'], totals['shared'], totals['private'], totals['pss']))
+    return '\n'.join(lines)
+
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    # the generated services log their own requests
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+
+class Worker(object):
+    '''Serves requests from the listening socket in a forked process until it has
+    handled max_requests of them or is told to stop (SIGTERM), then lets the requests
+    in progress finish, for up to graceful_timeout seconds.
+    '''
+
+    def __init__(self, app, listener, max_requests=0, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT, threaded=False):
+        self.app = app
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.handled = 0
+        self.in_flight = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+        server_class = ThreadedWSGIServer if threaded else BaseWSGIServer
+        host, port = listener.getsockname()[:2]
+        self.server = server_class(host, port, self.wsgi_app, handler=QuietRequestHandler, fd=listener.fileno())
+
+
+    def wsgi_app(self, environ, start_response):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            self.request_done()
+            raise
+        # streamed responses are in flight until the server has sent (and closed) them
+        return ClosingIterator(app_iter, [self.request_done])
+
+
+    def request_done(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.handled += 1
+            recycle = self.max_requests and self.handled >= self.max_requests
+        if recycle:
+            self.stop()
+
+
+    def stop(self, *args):
+        if not self.stopping:
+            self.stopping = True
+            # shutdown() waits for serve_forever() to return, so it cannot run on the serving thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.server.serve_forever(poll_interval=0.5)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.close_services()
+        self.server.server_close()
+
+
+    def close_services(self):
+        # the worker leaves through os._exit(), which skips the atexit hook that closes the
+        # service objects (and their pooled connections), so it closes its own here
+        config = getattr(self.app, 'config', None) or {}
+        services = config.get('services')
+        if services is None:
+            return
+        try:
+            services.close()
+        except Exception:
+            log.error('snap worker %d failed to close its service objects.', os.getpid(), exc_info=True)
+
+
+
+class WorkerRecord(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.started_at = time.monotonic()
+
+
+
+class PreforkServer(object):
+    def __init__(self,
+                 app,
+                 host,
+                 port,
+                 workers=None,
+                 threaded=False,
+                 reuseport=False,
+                 max_requests=0,
+                 max_requests_jitter=0,
+                 max_memory_mb=0,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT,
+                 memory_report_interval=0,
+                 backlog=DEFAULT_BACKLOG):
+
+        workers = workers or os.cpu_count() or 1
+        for setting, value in [('workers', workers),
+                               ('max_requests', max_requests),
+                               ('max_requests_jitter', max_requests_jitter),
+                               ('max_memory_mb', max_memory_mb),
+                               ('graceful_timeout', graceful_timeout),
+                               ('memory_report_interval', memory_report_interval)]:
+            if not isinstance(value, (int, float)) or value < 0:
+                raise InvalidServerSettingException(setting, value)
+        if reuseport and not hasattr(socket, 'SO_REUSEPORT'):
+            raise InvalidServerSettingException('reuseport', reuseport)
+
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.threaded = threaded
+        self.reuseport = reuseport
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_memory_mb = max_memory_mb
+        self.graceful_timeout = graceful_timeout
+        self.memory_report_interval = memory_report_interval
+        self.backlog = backlog
+
+        self.listener = None
+        self.workers = {}
+        self.stopping = False
+        self.respawn_delay = 0
+        self._signals = []
+        self._wakeup_read = None
+        self._wakeup_write = None
+
+
+    def new_socket(self):
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
+
+
+    def bind(self):
+        '''Bind the listening address (resolving port 0). With reuseport, the master's socket
+        only holds the port: each worker listens on a socket of its own.
+        '''
+        self.listener = self.new_socket()
+        self.listener.bind((self.host, self.port))
+        self.port = self.listener.getsockname()[1]
+        if not self.reuseport:
+            self.listener.listen(self.backlog)
+        return self.port
+
+
+    def worker_listener(self):
+        if not self.reuseport:
+            return self.listener
+        sock = self.new_socket()
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+
+    def spawn_worker(self):
+        # objects which exist now are shared with the worker; keep the collector off them
+        gc.freeze()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = WorkerRecord(pid)
+            return pid
+
+        exit_code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+            max_requests = self.max_requests
+            if max_requests and self.max_requests_jitter:
+                # staggered, so that the workers are not all recycled at once
+                max_requests += random.randint(0, self.max_requests_jitter)
+            Worker(self.app, self.worker_listener(), max_requests, self.graceful_timeout, self.threaded).run()
+        except BaseException:
+            log.error('snap worker %d failed.', os.getpid(), exc_info=True)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+
+    def signal_workers(self, signum, pids=None):
+        for pid in list(pids or self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            record = self.workers.pop(pid, None)
+            if record is None:
+                continue
+            exit_code = os.waitstatus_to_exitcode(status)
+            lifetime = time.monotonic() - record.started_at
+            if exit_code != 0 and not self.stopping:
+                log.warning('snap worker %d exited with status %d after %.1fs.', pid, exit_code, lifetime)
+            if exit_code != 0 and lifetime < MIN_WORKER_LIFETIME:
+                # back off, rather than fork a crashing worker in a tight loop
+                self.respawn_delay = min(MAX_RESPAWN_DELAY, max(0.1, self.respawn_delay * 2))
+            else:
+                self.respawn_delay = 0
+
+
+    def recycle_large_workers(self, report):
+        for pid, usage in report['workers'].items():
+            if pid in self.workers and usage['private'] > self.max_memory_mb * 1024:
+                log.info('recycling snap worker %d: %d kB of private memory.', pid, usage['private'])
+                self.signal_workers(signal.SIGTERM, [pid])
+
+
+    def check_memory(self):
+        report = memory_report(self.workers)
+        if self.memory_report_interval:
+            log.info('snap worker memory:\n%s', format_memory_report(report))
+        if self.max_memory_mb:
+            self.recycle_large_workers(report)
+        return report
+
+
+    def _handle_signal(self, signum, frame):
+        # the main loop does the work; a handler only records the signal
+        self._signals.append(signum)
+
+
+    def install_signal_handlers(self):
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in [self._wakeup_read, self._wakeup_write]:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self._wakeup_write)
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD]:
+            signal.signal(signum, self._handle_signal)
+
+
+    def process_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stopping = True
+            elif signum == signal.SIGHUP:
+                log.info('replacing all snap workers.')
+                self.signal_workers(signal.SIGTERM)
+            elif signum == signal.SIGUSR1:
+                log.info('snap worker memory:\n%s', format_memory_report(memory_report(self.workers)))
+
+
+    def wait(self, timeout):
+        try:
+            select.select([self._wakeup_read], [], [], timeout)
+        except InterruptedError:
+            pass
+        try:
+            while os.read(self._wakeup_read, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def shutdown(self):
+        log.info('stopping %d snap workers.', len(self.workers))
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.wait(0.1)
+            self.reap_workers()
+        if self.workers:
+            log.warning('killing %d snap workers still busy after %ds.', len(self.workers), self.graceful_timeout)
+            self.signal_workers(signal.SIGKILL)
+            while self.workers:
+                self.wait(0.1)
+                self.reap_workers()
+        self.listener.close()
+
+
+    def run(self):
+        if self.listener is None:
+            self.bind()
+        self.install_signal_handlers()
+        # collect the garbage left over from startup before freezing what remains
+        gc.collect()
+        log.info('snap master %d serving on %s:%d with %d workers.', os.getpid(), self.host, self.port, self.num_workers)
+
+        next_report = time.monotonic() + (self.memory_report_interval or 10)
+        while not self.stopping:
+            self.reap_workers()
+            if len(self.workers) < self.num_workers:
+                if self.respawn_delay:
+                    self.wait(self.respawn_delay)
+                    self.process_signals()
+                    if self.stopping:
+                        break
+                while len(self.workers) < self.num_workers:
+                    self.spawn_worker()
+
+            if (self.memory_report_interval or self.max_memory_mb) and time.monotonic() >= next_report:
+                self.check_memory()
+                next_report = time.monotonic() + (self.memory_report_interval or 10)
+
+            self.wait(1.0)
+            self.process_signals()
+
+        self.shutdown()
+
+
+def serve(app, host, port, **settings):
+    server = PreforkServer(app, host, port, **settings)
+    server.run()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#
+# Config file watching, for hot reloads of a running service.
+#
+# A ConfigWatcher polls the config file from a daemon thread and calls back when
+# its size or mtime changes. Polling needs no platform-specific notification API
+# and costs one stat() per interval.
+#
+
+
+import logging
+import os
+import threading
+
+
+log = logging.getLogger('init')
+
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+def file_signature(path):
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (file_stat.st_size, file_stat.st_mtime_ns)
+
+
+class ConfigWatcher(object):
+    def __init__(self, config_path, callback, interval=DEFAULT_POLL_INTERVAL):
+        self.config_path = config_path
+        self.callback = callback
+        self.interval = interval
+        self.signature = file_signature(config_path)
+        self.pid = os.getpid()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def check(self):
+        '''Call back if the file changed since the last check. Returns True if it did.
+        A failed callback is logged; the service keeps running with what it had.
+        '''
+        signature = file_signature(self.config_path)
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            self.callback()
+        except Exception as err:
+            log.error('Failed to reload %s: %s' % (self.config_path, err))
+        return True
+
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name='snap-config-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+
+    def ensure_running(self):
+        '''Threads do not survive fork(); restart the watcher in a forked worker.'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.start()
+
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+#
+# Framework-neutral request, response and routing objects for the snap runtimes
+# which do not sit on top of Flask.
+#
+
+
+import io
+import json
+import re
+from urllib.parse import parse_qs
+
+from snap.constants import ROUTE_VARIABLE_REGEX
+
+
+HTTP_STATUS_PHRASES = {
+    200: 'OK',
+    204: 'No Content',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    406: 'Not Acceptable',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout'
+}
+
+ROUTE_CONVERTERS = {
+    'string': (r'[^/]+', str),
+    'int': (r'\d+', int),
+    'float': (r'\d+\.\d+', float),
+    'path': (r'.+', str),
+    'uuid': (r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', str)
+}
+
+
+class NoSuchRouteException(Exception):
+    def __init__(self, path):
+        Exception.__init__(self, 'No route matches the path "%s".' % path)
+
+
+class MethodNotAllowedException(Exception):
+    def __init__(self, method, path):
+        Exception.__init__(self, 'The method %s is not allowed for the path "%s".' % (method, path))
+
+
+class UnsupportedRouteConverterException(Exception):
+    def __init__(self, converter_name, route):
+        Exception.__init__(self, 'Unsupported variable type "%s" in route "%s".' % (converter_name, route))
+
+
+def status_line(status):
+    return '%d %s' % (status, HTTP_STATUS_PHRASES.get(status, 'Unknown'))
+
+
+class Headers(dict):
+    '''Case-insensitive header table. Names are stored lowercased.'''
+
+    def __init__(self, header_pairs=()):
+        dict.__init__(self)
+        for name, value in header_pairs:
+            dict.__setitem__(self, name.lower(), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class Request(object):
+    '''The subset of the Flask request interface used by generated handlers and content decoders.
+
+    The body is either passed in as bytes or, by runtimes which can read it incrementally,
+    as a file-like body_stream. A stream is only read in full when data, get_data() or
+    get_json() is used, so streaming decoders can consume a large body record by record.
+    '''
+
+    def __init__(self, method, path, query_string, headers, body=b'', body_stream=None):
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.headers = headers
+        self._data = body if body_stream is None else None
+        self._body_stream = body_stream
+        self._args = None
+        self._form = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._body_stream.read()
+            self._body_stream = None
+        return self._data
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = {k: v[0] for k, v in parse_qs(self.query_string).items()}
+        return self._args
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._form = {}
+            if (self.headers.get('Content-Type') or '').startswith('application/x-www-form-urlencoded'):
+                self._form = {k: v[0] for k, v in parse_qs(self.data.decode()).items()}
+        return self._form
+
+    @property
+    def stream(self):
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        # once the body has been streamed, it cannot be read again through data
+        stream, self._body_stream = self._body_stream, None
+        self._data = b''
+        return stream
+
+    def get_data(self):
+        return self.data
+
+    def get_json(self, silent=False):
+        try:
+            return json.loads(self.data)
+        except ValueError:
+            if silent:
+                return None
+            raise
+
+
+def encode_chunk(chunk):
+    return chunk.encode() if isinstance(chunk, str) else chunk
+
+
+class Response(object):
+    '''An HTTP response. The body is either a str/bytes value or, for streamed responses,
+    an iterator (or async iterator) of str/bytes chunks.
+    '''
+
+    def __init__(self, body=b'', status=200, mimetype=None, headers=None):
+        if body is None:
+            body = b''
+        self.is_streaming = hasattr(body, '__next__') or hasattr(body, '__anext__')
+        self.body = body if self.is_streaming else encode_chunk(body)
+        self.status = status
+        self.mimetype = mimetype
+        self.headers = headers or {}
+
+    def header_list(self):
+        header_list = [(name, str(value)) for name, value in self.headers.items()]
+        if self.mimetype:
+            header_list.append(('Content-Type', self.mimetype))
+        if not self.is_streaming:
+            header_list.append(('Content-Length', str(len(self.body))))
+        return header_list
+
+
+class Route(object):
+    def __init__(self, rule, methods, handler):
+        self.rule = rule
+        self.methods = set(m.upper() for m in methods)
+        self.handler = handler
+        self.converters = []
+        self.pattern = None
+
+        pattern = '^'
+        position = 0
+        for match in re.finditer(ROUTE_VARIABLE_REGEX, rule):
+            converter_name, var_name = match.group(1), match.group(2)
+            if converter_name not in ROUTE_CONVERTERS:
+                raise UnsupportedRouteConverterException(converter_name, rule)
+            regex, convert = ROUTE_CONVERTERS[converter_name]
+            pattern += re.escape(rule[position:match.start()]) + '(?P<%s>%s)' % (var_name, regex)
+            self.converters.append((var_name, convert))
+            position = match.end()
+
+        if self.converters:
+            self.pattern = re.compile(pattern + re.escape(rule[position:]) + '$')
+
+    @property
+    def is_static(self):
+        return self.pattern is None
+
+    def match(self, path):
+        match = self.pattern.match(path)
+        if not match:
+            return None
+        return {name: convert(match.group(name)) for name, convert in self.converters}
+
+
+class RouteTable(object):
+    '''Dispatch table for snap routes. Routes without variables are resolved with a single
+    dict lookup; routes with <type:name> variables are compiled to regular expressions
+    and tried in registration order.
+    '''
+
+    def __init__(self):
+        self.static_routes = {}
+        self.dynamic_routes = []
+
+    def add(self, rule, methods, handler):
+        route = Route(rule, methods, handler)
+        if route.is_static:
+            self.static_routes.setdefault(rule, []).append(route)
+        else:
+            self.dynamic_routes.append(route)
+        return route
+
+    def match(self, method, path):
+        path_matched = False
+        for route in self.static_routes.get(path, ()):
+            path_matched = True
+            if method in route.methods:
+                return route.handler, {}
+
+        for route in self.dynamic_routes:
+            route_vars = route.match(path)
+            if route_vars is None:
+                continue
+            path_matched = True
+            if method in route.methods:
+                return route.handler, route_vars
+
+        if path_matched:
+            raise MethodNotAllowedException(method, path)
+        raise NoSuchRouteException(path)
@@ -5,30 +5,39 @@
 #
 # 
 
-from flask import Flask
-import argparse
+import atexit
+import functools
+import importlib
 import sys, os
 import logging.config
-import yaml
-import jinja2
+from concurrent.futures import ThreadPoolExecutor
 
 from snap import core
 from snap import common
 from snap import decoders
+from snap import jsoncodec
+from snap import snapshot
+from snap import reload
 from snap import config_templates
 
 
 HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
 HTTP_BAD_REQUEST = 400
 HTTP_NOT_FOUND = 404
+HTTP_NOT_ACCEPTABLE = 406
 HTTP_DEFAULT_ERRORCODE = 400
 HTTP_NOT_IMPLEMENTED = 500
+HTTP_SERVICE_UNAVAILABLE = 503
+HTTP_GATEWAY_TIMEOUT = 504
 
 MIMETYPE_JSON = 'application/json'
 CONFIG_FILE_ENV_VAR = 'BUTTONIZE_CFG'
 
 
 logging_config = None
+log = logging.getLogger('init')
+
 
 class MissingDataStatus():
     def __init__(self, field_name):
@@ -71,6 +80,8 @@ class NoSuchFieldValidator(Exception):
 def load_snap_config(mode, app):
     config_file_path = None
     if mode == 'standalone':
+        # argparse is only needed in standalone mode, so it is not imported by server workers
+        import argparse
         parser = argparse.ArgumentParser()
         parser.add_argument("--configfile",
                             metavar='<configfile>',
@@ -93,11 +104,13 @@ def load_snap_config(mode, app):
         print('please set the "SNAP_CONFIG" environment variable in the WSGI command string.')
         exit(1)
         
-    return common.read_config_file(config_file_path)
+    app.config['snap_config_path'] = config_file_path
+    # a fresh snapshot written by "snap compile-config" spares every worker the YAML parse
+    return snapshot.load_config(config_file_path)
 
 
-def initialize_services(yaml_config_obj):
-    service_objects = {}
+def load_service_specs(yaml_config_obj):
+    service_specs = {}
     configured_services = yaml_config_obj.get('service_objects')
     if configured_services is None:
         configured_services = []
@@ -116,44 +129,142 @@ def initialize_services(yaml_config_obj):
             param_tbl[param_name] = param_value
 
         klass = common.load_class(service_object_classname, service_module_name)
-        service_object = klass(**param_tbl)
-        service_objects[service_object_name] = service_object
-        
+        service_specs[service_object_name] = common.ServiceObjectSpec(service_object_name,
+                                                                      functools.partial(klass, **param_tbl),
+                                                                      pool_size=config_segment.get('pool_size'),
+                                                                      pool_timeout=config_segment.get('pool_timeout'),
+                                                                      lazy=config_segment.get('lazy') == True,
+                                                                      depends_on=config_segment.get('depends_on'),
+                                                                      fork_safe=config_segment.get('fork_safe') == True)
+    return service_specs
+
+
+def initialize_services(yaml_config_obj, service_specs=None):
+    '''Build the configured service objects. Services marked lazy are built on first lookup;
+    the others are built now, after the services they depend on. With service_warmup_threads
+    set in globals, services which don't depend on each other are built concurrently.
+    '''
+    if service_specs is None:
+        service_specs = load_service_specs(yaml_config_obj)
+    eager_services = common.eager_service_names(service_specs)
+    warmup_threads = int(yaml_config_obj['globals'].get('service_warmup_threads') or 1)
+
+    built_services = {}
+    with ThreadPoolExecutor(max_workers=warmup_threads) as executor:
+        for level in common.dependency_levels(service_specs):
+            names = [name for name in level if name in eager_services]
+            if warmup_threads > 1 and len(names) > 1:
+                built_services.update(zip(names, executor.map(lambda name: service_specs[name].build(), names)))
+            else:
+                for name in names:
+                    built_services[name] = service_specs[name].build()
+
+    service_objects = {}
+    for service_object_name, spec in service_specs.items():
+        if service_object_name in built_services:
+            service_objects[service_object_name] = built_services[service_object_name]
+        else:
+            service_objects[service_object_name] = common.LazyServiceObject(spec)
     return service_objects
     
 
+def register_post_fork_hook(hook):
+    '''Run hook in every worker forked from this process: through os.fork() (e.g. gunicorn
+    --preload) or uWSGI, which forks from C. Service registries also detect forks by
+    checking their pid, so this only moves the re-initialization off the first request.
+    '''
+    os.register_at_fork(after_in_child=hook)
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        return
+    postfork(hook)
+
+
+LOGGER_NAMES = ['sqlalchemy', 'request', 'init', 'service', 'transform']
+
+
+def build_logging_config(log_filename=None):
+    '''Build the logging.config dictionary for a service. Everything logs to the console;
+    if log_filename is set, the root logger also writes to a rotating logfile.
+    '''
+    config = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'simple': {'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s'}
+        },
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'level': 'DEBUG',
+                'formatter': 'simple',
+                'stream': 'ext://sys.stdout'
+            }
+        },
+        'loggers': {
+            'root': {'level': 'INFO', 'handlers': ['console'], 'propagate': False}
+        },
+        'root': {'level': 'INFO', 'handlers': ['console']}
+    }
+    for logger_name in LOGGER_NAMES:
+        config['loggers'][logger_name] = {'level': 'ERROR' if logger_name == 'sqlalchemy' else 'INFO',
+                                          'handlers': ['console'],
+                                          'propagate': False}
+    if log_filename:
+        config['handlers']['file_handler'] = {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'level': 'INFO',
+            'formatter': 'simple',
+            'filename': log_filename,
+            'maxBytes': 10485760, # 10MB
+            'backupCount': 20,
+            'encoding': 'utf8'
+        }
+        config['root']['handlers'].append('file_handler')
+    return config
+
+
 def configure_logging(yaml_config):
+    '''Configure logging from an in-memory dictionary. Nothing is written to the project
+    directory, so this works on read-only filesystems; omit the logfile setting to log
+    to the console only.
+    '''
     global logging_config
     if not logging_config:
-        project_dir = common.load_config_var(yaml_config['globals']['project_directory'])
-        logfile_full_path = os.path.join(project_dir,
-                                         yaml_config['globals']['logfile'])
-        j2env = jinja2.Environment()
-        template_mgr = common.JinjaTemplateManager(j2env)
-        log_config_template = j2env.from_string(config_templates.LOGGING_CONFIG)
-    
-        log_config_file = os.path.join(project_dir,
-                                      'logging_config.yaml')
-        with open(log_config_file, 'w') as f:
-            f.write(log_config_template.render(log_filename=logfile_full_path))
-        
-        with open(log_config_file, 'rt') as f:
-            logging_config = yaml.safe_load(f.read())
+        log_filename = None
+        if yaml_config['globals'].get('logfile'):
+            project_dir = common.load_config_var(yaml_config['globals']['project_directory'])
+            log_filename = os.path.join(project_dir, yaml_config['globals']['logfile'])
+        logging_config = build_logging_config(log_filename)
         logging.config.dictConfig(logging_config)
 
 
-def load_default_content_decoders():    
-    core.default_content_protocol.update('text/plain', decoders.decode_text_plain)
-    core.default_content_protocol.update('text/plain; charset=UTF-8', decoders.decode_text_plain_utf8)
-    core.default_content_protocol.update('application/x-www-form-urlencoded', decoders.decode_form_urlencoded)
-    core.default_content_protocol.update('application/json', decoders.decode_application_json)
+def load_default_content_decoders(content_protocol=None):    
+    content_protocol = content_protocol or core.default_content_protocol
+    content_protocol.update('text/plain', decoders.decode_text_plain)
+    content_protocol.update('application/x-www-form-urlencoded', decoders.decode_form_urlencoded)
+    content_protocol.update('application/json', decoders.decode_application_json)
+    content_protocol.update('application/msgpack', decoders.decode_msgpack)
+    content_protocol.update('application/cbor', decoders.decode_cbor)
+    content_protocol.update_streaming('application/x-ndjson', decoders.decode_ndjson_stream)
+    content_protocol.update_streaming('text/csv', decoders.decode_csv_stream)
+
+
+def import_user_module(module_name, reload_module=False):
+    module = __import__(module_name)
+    if reload_module:
+        # pick up functions added since startup (see reload_runtime_state)
+        module = importlib.reload(module)
+    return module
 
 
-def load_user_content_decoders(yaml_config):
+def load_user_content_decoders(yaml_config, content_protocol=None, reload_module=False):
+    content_protocol = content_protocol or core.default_content_protocol
     decoder_module_name = yaml_config['globals'].get('decoder_module')
     if not decoder_module_name: 
         return
-    decoder_module = __import__(decoder_module_name)
+    decoder_module = import_user_module(decoder_module_name, reload_module)
     if not yaml_config.get('decoders'):
         return
 
@@ -162,14 +273,16 @@ def load_user_content_decoders(yaml_config):
         if not hasattr(decoder_module, function_name):
             raise NoSuchMimeTypeDecoder(mime_type, function_name, decoder_module_name)
         decode_function = getattr(decoder_module, function_name)
-        core.default_content_protocol.update(mime_type, decode_function)
+        content_protocol.update(mime_type, decode_function)
 
-def load_custom_validators(yaml_config):
+def load_custom_validators(yaml_config, field_validators=None, reload_module=False):
+    if field_validators is None:
+        field_validators = core.custom_field_type_validators
     validator_module_name = yaml_config['globals'].get('validator_module')
     if not validator_module_name:
         return
 
-    validator_module = __import__(validator_module_name)
+    validator_module = import_user_module(validator_module_name, reload_module)
     if not yaml_config.get('field_validators'):
         return
 
@@ -179,7 +292,101 @@ def load_custom_validators(yaml_config):
             raise NoSuchFieldValidator(type_name, func_name, validator_module_name)
         
         validator_function = getattr(validator_module, func_name)
-        core.custom_field_type_validators[type_name] = validator_function
+        field_validators[type_name] = validator_function
+
+
+def load_input_shapes(yaml_config):
+    input_shapes = {}
+    for shape_name, shape_config in yaml_config['data_shapes'].items():
+        input_shape = core.InputShape(shape_name)
+        for field in shape_config['fields']:
+            input_shape.add_field(field['name'], field['datatype'], bool(field.get('required')))
+        input_shapes[shape_name] = input_shape
+    return input_shapes
+
+
+def reload_executor_pool(xformer, transform_name, transform_config, current_action):
+    # pools are created at startup, so a reload can move a transform between them but not add one
+    pool_name = transform_config.get('executor_pool')
+    if pool_name is None:
+        return None
+    if pool_name not in xformer.executor_pools:
+        log.warning('New executor pool "%s" for transform "%s" needs a regenerated routing module and a restart.'
+                    % (pool_name, transform_name))
+        return current_action.executor_pool
+    return xformer.executor_pools[pool_name]
+
+
+def build_runtime_state(xformer, yaml_config):
+    '''Build a complete core.RuntimeState from a config: a new content protocol and field
+    validator table, and a new Action for every registered transform, with the data shape,
+    output mimetypes, timeout and executor pool now configured for it. Transform functions, batch functions,
+    response caches, coalescers and admission controllers carry over from the current
+    actions; so do transforms which are no longer in the config, since their routes are
+    still being served.
+    '''
+    content_protocol = core.ContentProtocol()
+    load_default_content_decoders(content_protocol)
+    load_user_content_decoders(yaml_config, content_protocol, reload_module=True)
+
+    field_validators = core.FieldValidatorTable()
+    load_custom_validators(yaml_config, field_validators, reload_module=True)
+
+    input_shapes = load_input_shapes(yaml_config)
+    actions = {}
+    for transform_name, current_action in xformer.actions.items():
+        transform_config = yaml_config['transforms'].get(transform_name)
+        if transform_config is None:
+            actions[transform_name] = current_action
+            continue
+        action = core.Action(input_shapes[transform_config['input_shape']],
+                             current_action.transform_function,
+                             transform_config['output_mimetype'],
+                             field_validators=field_validators)
+        action.batch_function = current_action.batch_function
+        action.response_cache = current_action.response_cache
+        action.coalescer = current_action.coalescer
+        action.admission = current_action.admission
+        action.timeout_ms = transform_config.get('timeout_ms')
+        action.executor_pool = reload_executor_pool(xformer, transform_name, transform_config, current_action)
+        actions[transform_name] = action
+
+    for transform_name in yaml_config['transforms']:
+        if transform_name not in actions:
+            log.warning('New transform "%s" needs a regenerated routing module and a restart.' % transform_name)
+
+    return core.RuntimeState(actions, content_protocol, field_validators)
+
+
+def reload_runtime_state(config_file_path, xformer):
+    '''Re-read the config file and swap a freshly built RuntimeState into the Transformer.
+    If the new config is invalid, the current state is kept.
+    '''
+    yaml_config = snapshot.load_config(config_file_path)
+    errors = snapshot.validate_config(yaml_config)
+    if errors:
+        raise snapshot.InvalidConfigException(config_file_path, errors)
+    xformer.swap_state(build_runtime_state(xformer, yaml_config))
+    log.info('Reloaded data shapes, decoders and validators from %s.' % config_file_path)
+
+
+def enable_hot_reload(app, xformer):
+    '''Watch the config file in the background if the hot_reload global is set (to true,
+    or to the polling interval in seconds), rebuilding the Transformer's runtime state
+    when the file changes.
+    '''
+    hot_reload = app.config['snap_globals'].get('hot_reload')
+    if not hot_reload:
+        return None
+    interval = reload.DEFAULT_POLL_INTERVAL if hot_reload is True else float(hot_reload)
+    config_file_path = app.config['snap_config_path']
+    watcher = reload.ConfigWatcher(config_file_path,
+                                   functools.partial(reload_runtime_state, config_file_path, xformer),
+                                   interval)
+    watcher.start()
+    register_post_fork_hook(watcher.ensure_running)
+    app.config['config_watcher'] = watcher
+    return watcher
 
 
 def setup(app):
@@ -189,13 +396,18 @@ def setup(app):
     mode = app.config.get('startup_mode')
     yaml_config = load_snap_config(mode, app)
     app.debug = yaml_config['globals']['debug']
+    app.config['snap_globals'] = yaml_config['globals']
     configure_logging(yaml_config)
+    jsoncodec.select(yaml_config['globals'].get('json_codec'))
 
     load_default_content_decoders()
     load_user_content_decoders(yaml_config)
     load_custom_validators(yaml_config)
 
-    service_object_tbl = initialize_services(yaml_config)
-    app.config['services'] = common.ServiceObjectRegistry(service_object_tbl)
+    service_specs = load_service_specs(yaml_config)
+    service_object_tbl = initialize_services(yaml_config, service_specs)
+    app.config['services'] = common.ServiceObjectRegistry(service_object_tbl, service_specs)
+    atexit.register(app.config['services'].close)
+    register_post_fork_hook(app.config['services'].after_fork)
     app.config['initialized'] = True
     return app
\ No newline at end of file
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+#
+# Precompiled configuration snapshots.
+#
+# "snap compile-config" validates a YAML config file, normalizes it and pickles the
+# result next to the source file. load_config() uses the snapshot while it matches
+# the source file, and parses the YAML otherwise. Environment variable references
+# ($VAR) are kept as-is, so one snapshot works in every environment.
+#
+
+
+import hashlib
+import logging
+import os
+import pickle
+
+from snap import common
+
+
+log = logging.getLogger('init')
+
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_FORMAT_VERSION = 1
+
+REQUIRED_GLOBALS = ['port', 'debug', 'project_directory', 'transform_function_module', 'service_module']
+REQUIRED_TRANSFORM_SETTINGS = ['route', 'method', 'input_shape', 'output_mimetype']
+
+
+class InvalidConfigException(Exception):
+    def __init__(self, config_path, errors):
+        Exception.__init__(self, 'Invalid config file %s:\n    %s' % (config_path, '\n    '.join(errors)))
+        self.errors = errors
+
+
+def default_snapshot_path(config_path):
+    return config_path + SNAPSHOT_SUFFIX
+
+
+def file_digest(config_path):
+    with open(config_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def validate_config(yaml_config):
+    '''Return a list of the problems found in a config; an empty list means it is valid.'''
+    if not isinstance(yaml_config, dict):
+        return ['the config file must contain a YAML mapping.']
+
+    errors = []
+    global_settings = yaml_config.get('globals') or {}
+    for setting in REQUIRED_GLOBALS:
+        if setting not in global_settings:
+            errors.append('globals: missing the required setting "%s".' % setting)
+
+    data_shapes = yaml_config.get('data_shapes') or {}
+    for shape_name, shape_config in data_shapes.items():
+        for field in (shape_config or {}).get('fields') or []:
+            if not field.get('name') or not field.get('datatype'):
+                errors.append('data shape "%s": every field needs a name and a datatype.' % shape_name)
+
+    executor_pools = yaml_config.get('executor_pools') or {}
+    for pool_name, pool_config in executor_pools.items():
+        threads = (pool_config or {}).get('threads')
+        if not isinstance(threads, int) or isinstance(threads, bool) or threads < 1:
+            errors.append('executor pool "%s": threads must be a positive integer.' % pool_name)
+
+    for transform_name, transform_config in (yaml_config.get('transforms') or {}).items():
+        for setting in REQUIRED_TRANSFORM_SETTINGS:
+            if setting not in transform_config:
+                errors.append('transform "%s": missing the required setting "%s".' % (transform_name, setting))
+        shape_name = transform_config.get('input_shape')
+        if shape_name is not None and shape_name not in data_shapes:
+            errors.append('transform "%s": no data shape named "%s".' % (transform_name, shape_name))
+        pool_name = transform_config.get('executor_pool')
+        if pool_name is not None and pool_name not in executor_pools:
+            errors.append('transform "%s": no executor pool named "%s".' % (transform_name, pool_name))
+
+    service_specs = {}
+    for service_name, service_config in (yaml_config.get('service_objects') or {}).items():
+        if not (service_config or {}).get('class'):
+            errors.append('service object "%s": missing the required setting "class".' % service_name)
+            continue
+        service_specs[service_name] = common.ServiceObjectSpec(service_name, None,
+                                                               depends_on=service_config.get('depends_on'))
+    try:
+        common.dependency_levels(service_specs)
+    except (common.UnknownServiceDependencyException, common.CircularServiceDependencyException) as err:
+        errors.append(str(err))
+
+    return errors
+
+
+def normalize_config(yaml_config):
+    '''Fill in the empty sections and settings which YAML loads as None, so that consumers
+    of the config need not check for them.
+    '''
+    for section in ['service_objects', 'data_shapes', 'transforms']:
+        yaml_config[section] = yaml_config.get(section) or {}
+
+    for service_config in yaml_config['service_objects'].values():
+        service_config['init_params'] = service_config.get('init_params') or []
+
+    for shape_name in yaml_config['data_shapes']:
+        shape_config = yaml_config['data_shapes'][shape_name] or {}
+        shape_config['fields'] = shape_config.get('fields') or []
+        yaml_config['data_shapes'][shape_name] = shape_config
+
+    for transform_config in yaml_config['transforms'].values():
+        if transform_config.get('method'):
+            transform_config['method'] = transform_config['method'].upper()
+    return yaml_config
+
+
+def compile_config(config_path, snapshot_path=None):
+    '''Validate and normalize a YAML config file, then write its snapshot.
+    Returns the path of the snapshot.
+    '''
+    import yaml
+    snapshot_path = snapshot_path or default_snapshot_path(config_path)
+    # fingerprint exactly the bytes that get parsed
+    with open(config_path, 'rb') as f:
+        source_stat = os.fstat(f.fileno())
+        source = f.read()
+    yaml_config = yaml.safe_load(source)
+    errors = validate_config(yaml_config)
+    if errors:
+        raise InvalidConfigException(config_path, errors)
+
+    snapshot = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'source_size': source_stat.st_size,
+        'source_mtime_ns': source_stat.st_mtime_ns,
+        'source_sha256': hashlib.sha256(source).hexdigest(),
+        'config': normalize_config(yaml_config)
+    }
+    # write to a temp file first, so a worker never reads a partial snapshot
+    temp_path = '%s.%d.tmp' % (snapshot_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, snapshot_path)
+    return snapshot_path
+
+
+def read_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        log.warning('Ignoring unreadable config snapshot %s: %s' % (snapshot_path, err))
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+        return None
+    return snapshot
+
+
+def is_fresh(snapshot, config_path):
+    '''A snapshot is fresh if its source file is unchanged: the same size and mtime or,
+    failing that (e.g. after a fresh checkout), the same content hash.
+    '''
+    source_stat = os.stat(config_path)
+    if snapshot['source_size'] != source_stat.st_size:
+        return False
+    if snapshot['source_mtime_ns'] == source_stat.st_mtime_ns:
+        return True
+    return snapshot['source_sha256'] == file_digest(config_path)
+
+
+def load_config(config_path, snapshot_path=None):
+    '''Load a config file from its snapshot if there is a fresh one, else from the YAML.'''
+    snapshot_path = snapshot_path or default_snapshot_path(config_path)
+    snapshot = read_snapshot(snapshot_path)
+    if snapshot is not None:
+        if is_fresh(snapshot, config_path):
+            return snapshot['config']
+        log.warning('Config snapshot %s is stale; loading %s instead. Run "snap compile-config" to refresh it.'
+                    % (snapshot_path, config_path))
+    return normalize_config(common.read_config_file(config_path))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+#
+# uWSGI deployment settings for snap services (used by the uwsgen script).
+#
+# Each environment in the uwsgi_environments config section names a performance
+# profile. The profile sets the worker and thread counts from the host's core count:
+#
+#   cpu:    one single-threaded worker per core; the GIL makes threads useless
+#           for CPU-bound transforms, so parallelism comes from processes
+#   io:     fewer workers, each with many threads, since transforms spend most of
+#           their time waiting on databases and other services
+#   mixed:  one worker per core with a few threads each (the default)
+#
+# Any of the computed settings can be overridden per environment.
+#
+
+
+import os
+from snap import common
+
+
+DEFAULT_PROFILE = 'mixed'
+
+
+class PerformanceProfile(object):
+    def __init__(self, name, processes_per_core, threads, listen, harakiri, max_requests, offload_threads):
+        self.name = name
+        self.processes_per_core = processes_per_core
+        self.threads = threads
+        self.listen = listen
+        self.harakiri = harakiri
+        self.max_requests = max_requests
+        self.offload_threads = offload_threads
+
+
+
+PROFILES = {
+    'cpu': PerformanceProfile('cpu', processes_per_core=1.0, threads=1, listen=256, harakiri=30,
+                              max_requests=5000, offload_threads=0),
+    'io': PerformanceProfile('io', processes_per_core=0.5, threads=16, listen=1024, harakiri=120,
+                             max_requests=20000, offload_threads=2),
+    'mixed': PerformanceProfile('mixed', processes_per_core=1.0, threads=4, listen=512, harakiri=60,
+                                max_requests=10000, offload_threads=1)
+}
+
+# settings an environment may set directly, overriding its profile
+OVERRIDE_SETTINGS = ['cores', 'processes', 'threads', 'listen', 'harakiri', 'max_requests',
+                     'cheaper', 'thunder_lock', 'offload_threads', 'lazy_apps']
+
+
+class UnknownProfileException(Exception):
+    def __init__(self, env_name, profile_name):
+        Exception.__init__(self, 'uWSGI environment "%s" names unknown performance profile "%s" (choose one of: %s).'
+                           % (env_name, profile_name, ', '.join(sorted(PROFILES))))
+
+
+class InvalidUWSGISettingException(Exception):
+    def __init__(self, env_name, setting, value):
+        Exception.__init__(self, 'Invalid value %r for setting "%s" in uWSGI environment "%s".' % (value, setting, env_name))
+
+
+def host_core_count():
+    # the cores this process may run on, which in a container can be fewer than the machine has
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class UWSGIEnvironment(object):
+    def __init__(self, name, base_dir, python_home, socket_dir, log_dir, profile=DEFAULT_PROFILE, **overrides):
+        self.name = name
+        self.base_dir = common.load_config_var(base_dir)
+        self.python_home = common.load_config_var(python_home)
+        self.socket_dir = common.load_config_var(socket_dir)
+        self.log_dir = common.load_config_var(log_dir)
+
+        if profile not in PROFILES:
+            raise UnknownProfileException(name, profile)
+        self.profile = PROFILES[profile]
+
+        for setting in ['cores', 'processes', 'threads', 'listen', 'harakiri', 'max_requests', 'cheaper', 'offload_threads']:
+            value = overrides.get(setting)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+                raise InvalidUWSGISettingException(name, setting, value)
+
+        self.cores = overrides.get('cores') or host_core_count()
+        self.processes = overrides.get('processes') or max(1, int(round(self.cores * self.profile.processes_per_core)))
+        self.threads = overrides.get('threads') or self.profile.threads
+        self.listen = overrides.get('listen') or self.profile.listen
+        self.harakiri = overrides.get('harakiri', self.profile.harakiri)
+        self.max_requests = overrides.get('max_requests', self.profile.max_requests)
+        self.offload_threads = overrides.get('offload_threads', self.profile.offload_threads)
+        # spare workers uWSGI keeps when idle; the rest are started as load rises
+        self.cheaper = overrides.get('cheaper', max(1, self.processes // 4) if self.processes > 2 else 0)
+        if self.cheaper >= self.processes:
+            raise InvalidUWSGISettingException(name, 'cheaper', self.cheaper)
+        # serialize accept() among workers, so a new connection wakes one of them rather than all
+        self.thunder_lock = overrides.get('thunder_lock', self.processes > 1)
+        # load the app in each worker after the fork, instead of once in the master
+        self.lazy_apps = overrides.get('lazy_apps', False)
+
+
+    def __repr__(self):
+        lines = ['%s (%s profile):' % (self.name, self.profile.name),
+                 '--base directory: %s' % self.base_dir,
+                 '--python home: %s' % self.python_home,
+                 '--socket directory: %s' % self.socket_dir,
+                 '--log directory: %s' % self.log_dir,
+                 '--processes: %d (%d cores), threads: %d' % (self.processes, self.cores, self.threads)]
+        return '\n'.join(lines)
+
+
+
+def load_uwsgi_environments(yaml_config):
+    config_section = yaml_config.get('uwsgi_environments') or {}
+
+    environments = {}
+    for env_name, env_config in config_section.items():
+        overrides = {setting: env_config[setting] for setting in OVERRIDE_SETTINGS if setting in env_config}
+        environments[env_name] = UWSGIEnvironment(env_name,
+                                                  env_config['base_directory'],
+                                                  env_config['python_home'],
+                                                  env_config['socket_directory'],
+                                                  env_config['log_directory'],
+                                                  env_config.get('profile', DEFAULT_PROFILE),
+                                                  **overrides)
+    return environments
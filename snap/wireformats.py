@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+#
+# Binary wire formats (MessagePack and CBOR) for request bodies and responses.
+#
+# The underlying libraries (msgpack, cbor2) are optional; each one is imported
+# the first time a payload in its format is decoded or encoded, or a transform
+# which can respond in its format is registered.
+#
+
+
+from snap import jsoncodec
+
+
+MIMETYPE_MSGPACK = 'application/msgpack'
+MIMETYPE_CBOR = 'application/cbor'
+
+
+class MissingWireFormatLibraryException(Exception):
+    def __init__(self, mimetype, package_name):
+        Exception.__init__(self, 'Handling %s content requires the "%s" package, which is not installed.'
+                           % (mimetype, package_name))
+
+
+class MsgpackFormat(object):
+    mimetype = MIMETYPE_MSGPACK
+    package_name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+    def dumps(self, obj):
+        return self._msgpack.packb(obj, use_bin_type=True, default=jsoncodec.encode_default)
+
+
+class CborFormat(object):
+    mimetype = MIMETYPE_CBOR
+    package_name = 'cbor2'
+
+    def __init__(self):
+        import cbor2
+        self._cbor2 = cbor2
+
+    def loads(self, data):
+        return self._cbor2.loads(data)
+
+    def dumps(self, obj):
+        return self._cbor2.dumps(obj, default=self._encode_default)
+
+    @staticmethod
+    def _encode_default(encoder, obj):
+        encoder.encode(jsoncodec.encode_default(obj))
+
+
+FORMATS = {
+    MIMETYPE_MSGPACK: MsgpackFormat,
+    MIMETYPE_CBOR: CborFormat
+}
+
+_loaded_formats = {}
+
+
+def get(mimetype):
+    wire_format = _loaded_formats.get(mimetype)
+    if wire_format is None:
+        format_class = FORMATS[mimetype]
+        try:
+            wire_format = format_class()
+        except ImportError:
+            raise MissingWireFormatLibraryException(mimetype, format_class.package_name)
+        _loaded_formats[mimetype] = wire_format
+    return wire_format
+
+
+def available(mimetype):
+    '''False if mimetype is a binary wire format whose library is not installed.'''
+    if mimetype not in FORMATS:
+        return True
+    try:
+        get(mimetype)
+    except MissingWireFormatLibraryException:
+        return False
+    return True
+
+
+def transcode_output(output_data, mimetype):
+    '''Encode transform output in the given binary format. Transforms conventionally return
+    JSON text, so str output is parsed as JSON first; bytes are assumed to be encoded already.
+    '''
+    if isinstance(output_data, bytes):
+        return output_data
+    if isinstance(output_data, str):
+        output_data = jsoncodec.loads(output_data)
+    return get(mimetype).dumps(output_data)
+
+
+def encode_msgpack(output_data):
+    return transcode_output(output_data, MIMETYPE_MSGPACK)
+
+
+def encode_cbor(output_data):
+    return transcode_output(output_data, MIMETYPE_CBOR)
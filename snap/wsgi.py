@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+#
+# Minimal WSGI application container for generated snap services
+# (routegen --target=wsgi). It serves the same handlers as the ASGI runtime,
+# synchronously and without Flask/Werkzeug request setup.
+#
+
+
+import io
+import json
+import os
+from snap import runtime
+from snap.loggers import request_logger as log
+
+
+# CGI-style keys for the two headers which PEP 3333 leaves without the HTTP_ prefix
+UNPREFIXED_HEADER_KEYS = {'CONTENT_TYPE': 'Content-Type', 'CONTENT_LENGTH': 'Content-Length'}
+
+
+def environ_key(header_name):
+    key = header_name.upper().replace('-', '_')
+    if key in UNPREFIXED_HEADER_KEYS:
+        return key
+    return 'HTTP_' + key
+
+
+class EnvironHeaders(object):
+    '''Read-only, case-insensitive view of the request headers in a WSGI environ. Headers
+    are looked up in the environ as they are asked for, rather than copied per request.
+    '''
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def get(self, name, default=None):
+        return self.environ.get(environ_key(name), default)
+
+    def __getitem__(self, name):
+        return self.environ[environ_key(name)]
+
+    def __contains__(self, name):
+        return environ_key(name) in self.environ
+
+    def items(self):
+        for key, value in self.environ.items():
+            if key.startswith('HTTP_'):
+                yield key[5:].replace('_', '-').title(), value
+            elif key in UNPREFIXED_HEADER_KEYS and value:
+                yield UNPREFIXED_HEADER_KEYS[key], value
+
+    def __iter__(self):
+        return (name for name, value in self.items())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class BoundedInput(object):
+    '''Reads at most length bytes from a wsgi.input stream, which (unless the server sets
+    wsgi.input_terminated) may block rather than end at the end of the request body.
+    '''
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.stream.readline(size) if size else b''
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def input_stream(environ):
+    '''Return the request body as a file-like object, without reading it.'''
+    if environ.get('wsgi.input_terminated'):
+        # e.g. a chunked request the server has de-chunked: read it to the end
+        return environ['wsgi.input']
+    try:
+        content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length <= 0:
+        return io.BytesIO(b'')
+    return BoundedInput(environ['wsgi.input'], content_length)
+
+
+class ResponseStream(object):
+    '''The WSGI iterable for a streamed response. It encodes each chunk, and passes the
+    server's close() (called even when the client goes away early) on to the body.
+    '''
+
+    def __init__(self, body):
+        self.body = body
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return runtime.encode_chunk(next(self.body))
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class WSGIApplication(object):
+    '''Exposes the attributes snap.setup() expects of a Flask app (config, debug,
+    instance_path) and dispatches WSGI requests to handler functions registered with
+    the route() decorator.
+    '''
+
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self.config = {}
+        self.debug = False
+        self.instance_path = os.path.join(os.getcwd(), 'instance')
+        self.routes = runtime.RouteTable()
+
+
+    def route(self, rule, methods=None):
+        def decorator(handler):
+            self.routes.add(rule, methods or ['GET'], handler)
+            return handler
+        return decorator
+
+
+    def __call__(self, environ, start_response):
+        # PEP 3333 passes the path as latin-1-decoded bytes
+        path = environ.get('PATH_INFO', '/').encode('latin-1').decode('utf-8', 'replace')
+        request = runtime.Request(environ['REQUEST_METHOD'],
+                                  path,
+                                  environ.get('QUERY_STRING', ''),
+                                  EnvironHeaders(environ),
+                                  body_stream=input_stream(environ))
+        try:
+            handler, route_vars = self.routes.match(request.method, request.path)
+            response = handler(request, **route_vars)
+
+        except runtime.NoSuchRouteException as err:
+            response = runtime.Response(json.dumps({'error_message': str(err)}), status=404, mimetype='application/json')
+
+        except runtime.MethodNotAllowedException as err:
+            response = runtime.Response(json.dumps({'error_message': str(err)}), status=405, mimetype='application/json')
+
+        except Exception:
+            log.error('Exception thrown: ', exc_info=True)
+            response = runtime.Response(b'', status=500)
+
+        start_response(runtime.status_line(response.status), response.header_list())
+        if response.is_streaming:
+            return ResponseStream(response.body)
+        return [response.body]
@@ -1,6 +1,7 @@
 import unittest
 import os, sys
 import datetime
+import importlib.util
 import time
 import sh
 import json
@@ -47,6 +48,27 @@ class HTTPServiceTest(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
 
 
+    def test_cached_transform_should_answer_matching_etag_with_304(self):
+        port = self.app_config['globals']['port']
+        r = requests.get('http://localhost:%s/ping' % port)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('ETag', r.headers)
+        self.assertIn('max-age', r.headers['Cache-Control'])
+
+        r = requests.get('http://localhost:%s/ping' % port, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r.status_code, 304)
+
+
+    def test_should_answer_406_when_no_output_mimetype_is_acceptable(self):
+        port = self.app_config['globals']['port']
+        r = requests.get('http://localhost:%s/ping' % port, headers={'Accept': 'text/html'})
+        self.assertEqual(r.status_code, 406)
+
+        r = requests.get('http://localhost:%s/ping' % port, headers={'Accept': 'text/html, application/*;q=0.5'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'application/json')
+
+
     def test_should_reject_transform_requests_not_compliant_with_datashape(self):
         port = self.app_config['globals']['port']
         payload = {'foo': 'bar'}
@@ -108,6 +130,82 @@ class HTTPServiceTest(unittest.TestCase):
         response = r.json()
         self.assertIn('test_decoder_called', response)
 
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is not installed')
+    def test_msgpack_request_should_get_a_msgpack_response_when_accepted(self):
+        import msgpack
+        port = self.app_config['globals']['port']
+        headers = {'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
+        payload = {'placeholder': 'binary'}
+        r = requests.post('http://localhost:%s/posttest' % port,
+                          data=msgpack.packb(payload),
+                          headers=headers)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(r.content)['placeholder'], 'binary')
+
+
+    def test_batch_endpoint_should_return_a_status_for_every_record(self):
+        port = self.app_config['globals']['port']
+        headers = {'Content-Type': 'application/json'}
+        payload = [{'placeholder': 'first'}, {'optional_field': 'no placeholder'}, {'placeholder': 'third'}]
+        r = requests.post('http://localhost:%s/posttest/batch' % port,
+                          data=json.dumps(payload),
+                          headers=headers)
+
+        self.assertEqual(r.status_code, 200)
+        statuses = r.json()
+        self.assertEqual([s['ok'] for s in statuses], [True, False, True])
+        self.assertEqual(statuses[1]['status'], 400)
+
+
+    def test_batch_endpoint_should_accept_ndjson(self):
+        port = self.app_config['globals']['port']
+        headers = {'Content-Type': 'application/x-ndjson'}
+        payload = '\n'.join(json.dumps({'placeholder': str(i)}) for i in range(5))
+        r = requests.post('http://localhost:%s/posttest/batch' % port,
+                          data=payload,
+                          headers=headers)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json()), 5)
+
+
+    def test_streaming_transform_should_consume_chunked_ndjson_upload(self):
+        port = self.app_config['globals']['port']
+        headers = {'Content-Type': 'application/x-ndjson'}
+
+        def generate_body():
+            for i in range(1000):
+                yield ('%s\n' % json.dumps({'value': i})).encode()
+
+        r = requests.post('http://localhost:%s/streamsum' % port,
+                          data=generate_body(),
+                          headers=headers)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {'count': 1000, 'total': sum(range(1000))})
+
+
+    def test_streaming_transform_should_reject_noncompliant_records(self):
+        port = self.app_config['globals']['port']
+        headers = {'Content-Type': 'application/x-ndjson'}
+        payload = '\n'.join([json.dumps({'value': 1}), json.dumps({'other': 2})])
+        r = requests.post('http://localhost:%s/streamsum' % port,
+                          data=payload,
+                          headers=headers)
+
+        self.assertEqual(r.status_code, 400)
+
+
+    def test_generator_output_should_be_streamed_as_a_chunked_response(self):
+        port = self.app_config['globals']['port']
+        r = requests.get('http://localhost:%s/streamexport?count=2500' % port, stream=True)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('Transfer-Encoding'), 'chunked')
+        self.assertEqual(json.loads(r.content), [{'id': i} for i in range(2500)])
+
+
     def test_custom_field_validator_is_triggered_by_specified_request_field_datatype(self):
         port = self.app_config['globals']['port']
 
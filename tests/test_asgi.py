@@ -0,0 +1,302 @@
+import unittest
+import os
+import asyncio
+import importlib
+import json
+from context import snap
+from snap import core, runtime, asgi
+
+
+GENERATED_ASGI_MODULE = 'test_asgi_app'
+GENERATED_OPTIMIZED_ASGI_MODULE = 'test_optimized_asgi_app'
+
+
+def call_asgi(app, method, path, body=b'', headers=None, query_string=b''):
+    scope = {'type': 'http',
+             'method': method,
+             'path': path,
+             'query_string': query_string,
+             'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    status = sent[0]['status']
+    response_body = b''.join(m.get('body', b'') for m in sent[1:])
+    return status, response_body
+
+
+class ASGIApplicationTest(unittest.TestCase):
+    module_name = GENERATED_ASGI_MODULE
+
+    @classmethod
+    def setUpClass(cls):
+        project_home = os.getenv('SNAP_TEST_HOME')
+        if not project_home:
+            raise Exception('the environment variable SNAP_TEST_HOME has not been set.')
+        os.environ['SNAP_CONFIG'] = os.path.join(project_home, '..', 'data', 'good_sample_config.yaml')
+        cls.app_module = importlib.import_module(cls.module_name)
+
+
+    def test_generated_asgi_app_should_serve_get_transforms(self):
+        status, body = call_asgi(self.app_module.app, 'GET', '/ping')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'message': 'pong'})
+
+
+    def test_generated_asgi_app_should_decode_post_content(self):
+        status, body = call_asgi(self.app_module.app,
+                                 'POST',
+                                 '/posttest',
+                                 body=json.dumps({'placeholder': 'value'}).encode(),
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 200)
+        self.assertIn('test_decoder_called', json.loads(body))
+
+
+    def test_generated_asgi_app_should_reject_noncompliant_input(self):
+        status, body = call_asgi(self.app_module.app,
+                                 'POST',
+                                 '/posttest',
+                                 body=json.dumps({'foo': 'bar'}).encode(),
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 400)
+
+
+    def test_generated_asgi_app_should_record_stage_latencies(self):
+        call_asgi(self.app_module.app,
+                  'POST',
+                  '/posttest',
+                  body=json.dumps({'placeholder': 'value'}).encode(),
+                  headers={'Content-Type': 'application/json'})
+        report = self.app_module.xformer.stage_report()
+        self.assertEqual(set(report['post_target'].keys()), {'decode', 'validate', 'transform', 'respond'})
+
+
+    def test_generated_asgi_app_should_run_streaming_transforms(self):
+        body = '\n'.join(json.dumps({'value': i}) for i in range(10)).encode()
+        status, response_body = call_asgi(self.app_module.app,
+                                          'POST',
+                                          '/streamsum',
+                                          body=body,
+                                          headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(response_body), {'count': 10, 'total': 45})
+
+
+    def test_generated_asgi_app_should_stream_a_body_sent_in_chunks(self):
+        body = ''.join(json.dumps({'value': i}) + '\n' for i in range(10)).encode()
+        messages = [{'type': 'http.request', 'body': body[i:i + 7], 'more_body': i + 7 < len(body)}
+                    for i in range(0, len(body), 7)]
+        scope = {'type': 'http',
+                 'method': 'POST',
+                 'path': '/streamsum',
+                 'query_string': b'',
+                 'headers': [(b'content-type', b'application/x-ndjson')]}
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app_module.app(scope, receive, send))
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(json.loads(sent[1]['body']), {'count': 10, 'total': 45})
+
+
+    def test_generated_asgi_app_should_stream_generator_output(self):
+        status, body = call_asgi(self.app_module.app, 'GET', '/streamexport', query_string=b'count=250&format=ndjson')
+        self.assertEqual(status, 200)
+        lines = body.decode().splitlines()
+        self.assertEqual(len(lines), 250)
+        self.assertEqual(json.loads(lines[-1]), {'id': 249})
+
+
+    def test_generated_asgi_app_should_shed_requests_over_the_admission_limit(self):
+        xformer = self.app_module.xformer
+        limit = xformer.admission_stats()['custom_validator']['limit']
+        permits = [xformer.admit('custom_validator', block=False) for i in range(limit)]
+        try:
+            status, body = call_asgi(self.app_module.app, 'POST', '/customvalidator',
+                                     body=b'{}', headers={'Content-Type': 'application/json'})
+        finally:
+            for permit in permits:
+                permit.release()
+        self.assertEqual(status, 503)
+        self.assertIn('error_message', json.loads(body))
+
+
+    def test_shed_requests_should_not_wait_for_their_body(self):
+        xformer = self.app_module.xformer
+        limit = xformer.admission_stats()['custom_validator']['limit']
+        permits = [xformer.admit('custom_validator', block=False) for i in range(limit)]
+        scope = {'type': 'http',
+                 'method': 'POST',
+                 'path': '/customvalidator',
+                 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')]}
+        received = []
+        sent = []
+
+        async def receive():
+            # a client which is slow to send its body
+            received.append(True)
+            await asyncio.sleep(10)
+
+        async def send(message):
+            sent.append(message)
+
+        try:
+            asyncio.run(asyncio.wait_for(self.app_module.app(scope, receive, send), 5))
+        finally:
+            for permit in permits:
+                permit.release()
+        self.assertEqual(sent[0]['status'], 503)
+        self.assertEqual(received, [])
+
+
+    def test_generated_asgi_app_should_shed_batches_over_the_admission_limit(self):
+        xformer = self.app_module.xformer
+        limit = xformer.admission_stats()['custom_validator']['limit']
+        permits = [xformer.admit('custom_validator', block=False) for i in range(limit)]
+        try:
+            status, body = call_asgi(self.app_module.app, 'POST', '/customvalidator/batch',
+                                     body=b'[{}]', headers={'Content-Type': 'application/json'})
+        finally:
+            for permit in permits:
+                permit.release()
+        self.assertEqual(status, 503)
+
+        status, body = call_asgi(self.app_module.app, 'POST', '/customvalidator/batch',
+                                 body=b'[{}]', headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 200)
+        self.assertEqual(xformer.admission_stats()['custom_validator']['in_flight'], 0)
+
+
+    def test_generated_asgi_app_should_return_404_for_unknown_routes(self):
+        status, body = call_asgi(self.app_module.app, 'GET', '/no/such/route')
+        self.assertEqual(status, 404)
+
+
+class OptimizedASGIApplicationTest(ASGIApplicationTest):
+    '''Runs the same tests against the app generated by "routegen --optimize".'''
+    module_name = GENERATED_OPTIMIZED_ASGI_MODULE
+
+
+class AsyncTransformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None, sync_threads=2)
+        shape = core.InputShape('async_shape')
+        shape.add_field('value', 'int', True)
+        self.shape = shape
+
+
+    def test_async_transform_functions_should_be_awaited(self):
+        async def async_func(input_data, service_objects, **kwargs):
+            await asyncio.sleep(0)
+            return core.TransformStatus(input_data['value'] * 2)
+
+        self.xformer.register_transform('double', self.shape, async_func, 'application/json')
+        status = asyncio.run(self.xformer.transform_async('double', {'value': 21}))
+        self.assertEqual(status.output_data, 42)
+
+
+    def test_sync_transform_functions_should_run_on_the_executor(self):
+        import threading
+
+        def sync_func(input_data, service_objects, **kwargs):
+            return core.TransformStatus(threading.current_thread().name)
+
+        self.xformer.register_transform('whereami', self.shape, sync_func, 'application/json')
+        status = asyncio.run(self.xformer.transform_async('whereami', {'value': 1}))
+        self.assertTrue(status.output_data.startswith('snap-transform'))
+
+
+    def test_async_transform_functions_should_run_from_sync_transform(self):
+        async def async_func(input_data, service_objects, **kwargs):
+            return core.TransformStatus('done')
+
+        self.xformer.register_transform('async_from_sync', self.shape, async_func, 'application/json')
+        self.assertEqual(self.xformer.transform('async_from_sync', {'value': 1}).output_data, 'done')
+
+
+class ASGIRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = [b'{"value": 1}\n{"val', b'ue": 2}\n', b'{"value": 3}\n']
+        self.received = []
+
+
+    async def receive(self):
+        self.received.append(True)
+        return {'type': 'http.request',
+                'body': self.chunks[len(self.received) - 1],
+                'more_body': len(self.received) < len(self.chunks)}
+
+
+    def test_request_stream_should_receive_the_body_as_it_is_read(self):
+        async def read_stream():
+            request = asgi.ASGIRequest('POST', '/stream', '', runtime.Headers(), self.receive)
+            stream = request.stream
+            loop = asyncio.get_running_loop()
+            first_line = await loop.run_in_executor(None, stream.readline)
+            chunks_received = len(self.received)
+            return first_line, chunks_received, await loop.run_in_executor(None, stream.read)
+
+        first_line, chunks_received, rest = asyncio.run(read_stream())
+        self.assertEqual(first_line, b'{"value": 1}\n')
+        self.assertEqual(chunks_received, 1)
+        self.assertEqual(rest, b'{"value": 2}\n{"value": 3}\n')
+
+
+    def test_request_stream_should_not_be_read_on_the_event_loop(self):
+        async def read_stream():
+            request = asgi.ASGIRequest('POST', '/stream', '', runtime.Headers(), self.receive)
+            return request.stream.read()
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(read_stream())
+
+
+    def test_loaded_body_should_be_available_as_data(self):
+        async def load():
+            request = asgi.ASGIRequest('POST', '/stream', '', runtime.Headers(), self.receive)
+            await request.load_body()
+            return request.data
+
+        self.assertEqual(asyncio.run(load()), b''.join(self.chunks))
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def test_route_table_should_convert_typed_route_variables(self):
+        table = runtime.RouteTable()
+        table.add('/widget/<int:widget_id>', ['GET'], 'widget_handler')
+        handler, route_vars = table.match('GET', '/widget/42')
+        self.assertEqual(handler, 'widget_handler')
+        self.assertEqual(route_vars, {'widget_id': 42})
+
+
+    def test_route_table_should_distinguish_missing_routes_from_bad_methods(self):
+        table = runtime.RouteTable()
+        table.add('/ping', ['GET'], 'ping_handler')
+        with self.assertRaises(runtime.MethodNotAllowedException):
+            table.match('POST', '/ping')
+        with self.assertRaises(runtime.NoSuchRouteException):
+            table.match('GET', '/pong')
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
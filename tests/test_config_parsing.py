@@ -1,6 +1,9 @@
 import unittest
 from context import snap
+from snap import snap as snap_main, common, snapshot
 import os
+import shutil
+import tempfile
 import yaml
 
 
@@ -43,6 +46,68 @@ class ConfigfileLoadTest(unittest.TestCase):
             self.assertIn(field, so_config)
 
 
+    def test_service_object_with_pool_size_should_be_pooled(self):
+        service_objects = snap_main.initialize_services(self.good_yaml_config)
+        self.assertNotIsInstance(service_objects[TEST_SVC_NAME], common.ServiceObjectPool)
+
+        pool = service_objects['pooled_test_service']
+        self.assertIsInstance(pool, common.ServiceObjectPool)
+        self.assertEqual(pool.size, 4)
+        self.assertEqual(pool.timeout, 2)
+
+
+    def test_lazy_service_object_should_be_built_on_first_lookup(self):
+        service_objects = snap_main.initialize_services(self.good_yaml_config)
+        self.assertIsInstance(service_objects['lazy_test_service'], common.LazyServiceObject)
+
+        registry = common.ServiceObjectRegistry(service_objects)
+        service = registry.lookup('lazy_test_service')
+        self.assertNotIsInstance(service, common.LazyServiceObject)
+        self.assertIs(registry.lookup('lazy_test_service'), service)
+
+
+    def test_logging_config_should_only_write_a_logfile_when_one_is_configured(self):
+        console_only = snap_main.build_logging_config()
+        self.assertNotIn('file_handler', console_only['handlers'])
+        self.assertEqual(console_only['root']['handlers'], ['console'])
+
+        with_logfile = snap_main.build_logging_config('/var/log/snap/test.log')
+        self.assertEqual(with_logfile['handlers']['file_handler']['filename'], '/var/log/snap/test.log')
+        self.assertIn('file_handler', with_logfile['root']['handlers'])
+
+
+    def test_config_snapshot_should_be_used_only_while_fresh(self):
+        project_home = os.getenv('SNAP_TEST_HOME')
+        temp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(temp_dir, 'good_sample_config.yaml')
+            # the service config the application tests run against
+            shutil.copy(os.path.join(project_home, '..', 'data', 'good_sample_config.yaml'), config_path)
+            snapshot_path = snapshot.compile_config(config_path)
+            self.assertEqual(snapshot.load_config(config_path), snapshot.read_snapshot(snapshot_path)['config'])
+
+            with open(config_path, 'a') as f:
+                f.write('\napp_name: changed\n')
+            self.assertFalse(snapshot.is_fresh(snapshot.read_snapshot(snapshot_path), config_path))
+            self.assertEqual(snapshot.load_config(config_path)['app_name'], 'changed')
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_invalid_config_should_not_compile(self):
+        errors = snapshot.validate_config({'globals': {}, 'transforms': {'t': {'input_shape': 'missing'}}})
+        self.assertIn('transform "t": no data shape named "missing".', errors)
+        self.assertIn('globals: missing the required setting "port".', errors)
+
+
+    def test_transforms_should_only_use_defined_executor_pools(self):
+        errors = snapshot.validate_config({'globals': {},
+                                           'executor_pools': {'heavy': {'threads': 0}},
+                                           'transforms': {'t': {'executor_pool': 'light'}}})
+        self.assertIn('executor pool "heavy": threads must be a positive integer.', errors)
+        self.assertIn('transform "t": no executor pool named "light".', errors)
+
+
     def test_datashape_config_should_contain_required_fields(self):
         datashape_required_fields = ['fields']
         datashape_field_required_fields = ['name', 'datatype', 'required']
@@ -0,0 +1,1030 @@
+import unittest
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+from context import snap
+from snap import core, common, cache, metrics, jsoncodec, wireformats, reload, concurrency, admission, executors
+import asyncio
+
+
+def build_test_shape():
+    shape = core.InputShape('core_test_shape')
+    shape.add_field('name', 'string', True)
+    shape.add_field('count', 'int', True)
+    shape.add_field('ratio', 'float', False)
+    return shape
+
+
+class CompiledShapeTest(unittest.TestCase):
+
+    def test_compiled_shape_should_accept_compliant_data(self):
+        shape = build_test_shape()
+        missing, errors = shape.compile().check({'name': 'widget', 'count': '3'})
+        self.assertEqual(missing, [])
+        self.assertEqual(errors, [])
+
+
+    def test_compiled_shape_should_report_missing_and_malformed_fields_in_one_pass(self):
+        shape = build_test_shape()
+        missing, errors = shape.compile().check({'count': 'three', 'ratio': 'half'})
+        self.assertEqual(missing, shape.scan({'count': 'three', 'ratio': 'half'}))
+        self.assertEqual(len(errors), 2)
+
+
+    def test_compiled_shape_should_match_two_pass_format_errors(self):
+        shape = build_test_shape()
+        input_data = {'name': 'widget', 'count': 'three', 'ratio': '0.5'}
+        missing, errors = shape.compile().check(input_data)
+        self.assertEqual(errors, shape.validate_data_format(input_data))
+
+
+    def test_adding_a_field_should_invalidate_the_compiled_shape(self):
+        shape = build_test_shape()
+        compiled = shape.compile()
+        self.assertIs(compiled, shape.compile())
+        shape.add_field('extra', 'string', True)
+        missing, errors = shape.compile().check({'name': 'widget', 'count': 1})
+        self.assertEqual(len(missing), 1)
+
+
+    def test_action_should_raise_missing_field_exception_before_format_errors(self):
+        action = core.Action(build_test_shape(), lambda data, services, **kwargs: core.TransformStatus('ok'), 'application/json')
+        with self.assertRaises(core.MissingInputFieldException):
+            action.execute({'count': 'three'}, None)
+
+        with self.assertRaises(core.NonCompliantDataFormat):
+            action.execute({'name': 'widget', 'count': 'three'}, None)
+
+
+    def test_unrecognized_datatype_should_be_reported_as_a_format_error(self):
+        shape = core.InputShape('bad_type_shape')
+        shape.add_field('when', 'no_such_type', False)
+        missing, errors = shape.compile().check({'when': 'now'})
+        self.assertEqual(len(errors), 1)
+        self.assertIn('Unrecognized datatype', errors[0])
+
+
+    def test_registering_a_validator_should_invalidate_the_compiled_shape(self):
+        def validate_zipcode(value):
+            if len(str(value)) != 5:
+                raise ValueError('not a zipcode')
+
+        self.addCleanup(core.custom_field_type_validators.pop, 'zipcode', None)
+        shape = core.InputShape('zipcode_shape')
+        shape.add_field('zip', 'zipcode', True)
+        action = core.Action(shape, lambda data, services, **kwargs: core.TransformStatus('ok'), 'application/json')
+        with self.assertRaises(core.NonCompliantDataFormat):
+            action.validate({'zip': '12345'})
+
+        core.custom_field_type_validators['zipcode'] = validate_zipcode
+        action.validate({'zip': '12345'})
+        with self.assertRaises(core.NonCompliantDataFormat):
+            action.validate({'zip': '123'})
+
+
+class BatchTransformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None)
+        self.xformer.register_transform('count', build_test_shape(), self.count_func, 'application/json')
+        self.xformer.register_error_code(core.MissingInputFieldException, core.HTTP_BAD_REQUEST)
+        self.batch_calls = []
+
+
+    def count_func(self, input_data, service_objects, **kwargs):
+        return core.TransformStatus(input_data['count'])
+
+
+    def bulk_count_func(self, records, service_objects, **kwargs):
+        self.batch_calls.append(len(records))
+        return [core.TransformStatus(r['count']) for r in records]
+
+
+    def test_batch_should_return_statuses_in_record_order(self):
+        records = [{'name': 'a', 'count': 1}, {'count': 2}, {'name': 'c', 'count': 'x'}, {'name': 'd', 'count': 4}]
+        statuses = self.xformer.transform_batch('count', records)
+        self.assertEqual([s.ok for s in statuses], [True, False, False, True])
+        self.assertEqual(statuses[3].output_data, 4)
+        self.assertEqual(statuses[1].get_error_code(), core.HTTP_BAD_REQUEST)
+
+
+    def test_batch_function_should_receive_all_valid_records_at_once(self):
+        self.xformer.register_batch_transform('count', self.bulk_count_func)
+        records = [{'name': 'a', 'count': i} for i in range(10)] + [{'name': 'missing count'}]
+        statuses = self.xformer.transform_batch('count', records)
+        self.assertEqual(self.batch_calls, [10])
+        self.assertFalse(statuses[-1].ok)
+
+
+    def test_batch_status_data_should_report_per_record_status_codes(self):
+        statuses = self.xformer.transform_batch('count', [{'name': 'a', 'count': 1}, {}])
+        data = core.batch_status_data(statuses)
+        self.assertEqual([d['status'] for d in data], [core.HTTP_OK, core.HTTP_BAD_REQUEST])
+
+
+    def test_async_batch_should_await_async_transforms(self):
+        async def async_count_func(input_data, service_objects, **kwargs):
+            await asyncio.sleep(0)
+            return core.TransformStatus(input_data['count'])
+
+        self.xformer.register_transform('async_count', build_test_shape(), async_count_func, 'application/json')
+        records = [{'name': 'a', 'count': 1}, {'count': 2}, {'name': 'c', 'count': 3}]
+        statuses = asyncio.run(self.xformer.transform_batch_async('async_count', records))
+        data = core.batch_status_data(statuses)
+        self.assertEqual([d['status'] for d in data], [core.HTTP_OK, core.HTTP_BAD_REQUEST, core.HTTP_OK])
+        self.assertEqual([d.get('data') for d in data], [1, None, 3])
+
+        # and from a synchronous runtime, each record gets its own event loop
+        self.assertEqual(self.xformer.transform_batch('async_count', records)[2].output_data, 3)
+
+
+    def test_async_batch_should_run_sync_transforms_and_batch_functions(self):
+        self.assertEqual([s.output_data for s in asyncio.run(self.xformer.transform_batch_async('count', [{'name': 'a', 'count': 5}]))], [5])
+        self.xformer.register_batch_transform('count', self.bulk_count_func)
+        statuses = asyncio.run(self.xformer.transform_batch_async('count', [{'name': 'a', 'count': i} for i in range(3)]))
+        self.assertEqual([s.output_data for s in statuses], [0, 1, 2])
+        self.assertEqual(self.batch_calls, [3])
+
+
+    def test_unmapped_exception_should_fail_only_its_own_record(self):
+        def fragile_func(input_data, service_objects, **kwargs):
+            if input_data['count'] == 2:
+                raise KeyError('boom')
+            return core.TransformStatus(input_data['count'])
+
+        self.xformer.register_transform('fragile', build_test_shape(), fragile_func, 'application/json')
+        records = [{'name': 'a', 'count': i} for i in range(4)]
+        for statuses in [self.xformer.transform_batch('fragile', records),
+                         asyncio.run(self.xformer.transform_batch_async('fragile', records))]:
+            self.assertEqual([s.ok for s in statuses], [True, True, False, True])
+            self.assertEqual(statuses[2].get_error_code(), core.HTTP_DEFAULT_ERRORCODE)
+
+
+    def test_batch_should_run_under_the_deadline_and_executor_pool(self):
+        threads = []
+
+        def slow_count_func(input_data, service_objects, **kwargs):
+            threads.append(threading.current_thread().name)
+            if input_data['count'] > 1:
+                time.sleep(0.2)
+            return core.TransformStatus(input_data['count'])
+
+        self.xformer.register_transform('slow_count', build_test_shape(), slow_count_func, 'application/json')
+        pool = self.xformer.add_executor_pool('batch_pool', 1, 0)
+        self.addCleanup(pool.shutdown)
+        self.xformer.assign_executor_pool('slow_count', 'batch_pool')
+
+        statuses = self.xformer.transform_batch('slow_count', [{'name': 'a', 'count': 1}])
+        self.assertTrue(statuses[0].ok)
+        self.assertTrue(threads[0].startswith('snap-pool-batch_pool'))
+
+        self.xformer.set_timeout('slow_count', 50)
+        records = [{'name': 'a', 'count': 2}, {'name': 'b', 'count': 3}, {'count': 4}]
+        statuses = self.xformer.transform_batch('slow_count', records)
+        self.assertEqual([s.get_error_code() for s in statuses],
+                         [core.HTTP_GATEWAY_TIMEOUT, core.HTTP_GATEWAY_TIMEOUT, core.HTTP_BAD_REQUEST])
+
+        # the timed-out batch still holds the pool's only thread
+        statuses = asyncio.run(self.xformer.transform_batch_async('slow_count', [{'name': 'a', 'count': 1}]))
+        self.assertEqual(statuses[0].get_error_code(), core.HTTP_SERVICE_UNAVAILABLE)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_cache_should_count_hits_and_misses(self):
+        response_cache = cache.ResponseCache(60)
+        key = response_cache.key_for({'id': 1})
+        self.assertIsNone(response_cache.get(key))
+        response_cache.put(key, '{"id": 1}')
+        self.assertEqual(response_cache.get(key).body, '{"id": 1}')
+        stats = response_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+
+    def test_cache_should_evict_least_recently_used_entries(self):
+        response_cache = cache.ResponseCache(60, max_entries=2)
+        for i in range(3):
+            response_cache.put((i,), str(i))
+        self.assertIsNone(response_cache.get((0,)))
+        self.assertIsNotNone(response_cache.get((2,)))
+        self.assertEqual(response_cache.stats()['evictions'], 1)
+
+
+    def test_cache_should_expire_entries_after_ttl(self):
+        response_cache = cache.ResponseCache(0.01)
+        response_cache.put(('k',), 'value')
+        time.sleep(0.02)
+        self.assertIsNone(response_cache.get(('k',)))
+
+
+    def test_cache_key_should_only_use_key_fields(self):
+        response_cache = cache.ResponseCache(60, key_fields=['id'])
+        self.assertEqual(response_cache.key_for({'id': 1, 'verbose': 'yes'}),
+                         response_cache.key_for({'id': 1, 'verbose': 'no'}))
+
+
+    def test_cache_entry_max_age_should_be_its_remaining_ttl(self):
+        entry = cache.ResponseCache(60).put(('k',), 'value')
+        self.assertIn(entry.headers['Cache-Control'], ['max-age=59', 'max-age=60'])
+        entry.expires_at = time.monotonic() + 10.5
+        self.assertEqual(entry.headers['Cache-Control'], 'max-age=10')
+        entry.expires_at = time.monotonic() - 1
+        self.assertEqual(entry.headers['Cache-Control'], 'max-age=0')
+
+
+    def test_cache_entry_should_match_weak_and_listed_etags(self):
+        entry = cache.ResponseCache(60).put(('k',), 'value')
+        self.assertTrue(entry.matches('W/%s' % entry.etag))
+        self.assertTrue(entry.matches('"other", %s' % entry.etag))
+        self.assertFalse(entry.matches('"other"'))
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_histogram_percentiles_should_be_close_to_recorded_latencies(self):
+        histogram = metrics.LatencyHistogram()
+        for i in range(1, 101):
+            histogram.record(i / 1000.0)
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.002)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.003)
+        self.assertEqual(histogram.count, 100)
+
+
+    def test_transformer_should_report_validate_and_transform_stages(self):
+        xformer = core.Transformer(None)
+        xformer.register_transform('count', build_test_shape(),
+                                   lambda data, services, **kwargs: core.TransformStatus('ok'),
+                                   'application/json')
+        xformer.enable_instrumentation()
+        for i in range(3):
+            xformer.transform('count', {'name': 'a', 'count': i})
+        with xformer.timed('count', 'respond'):
+            pass
+
+        report = xformer.stage_report()
+        self.assertEqual(set(report['count'].keys()), {'validate', 'transform', 'respond'})
+        self.assertEqual(report['count']['transform']['count'], 3)
+
+
+    def test_disabled_instrumentation_should_record_nothing(self):
+        xformer = core.Transformer(None)
+        self.assertIs(xformer.timed('count', 'decode'), metrics.NULL_TIMER)
+        self.assertEqual(xformer.stage_report(), {})
+
+
+class StreamingOutputTest(unittest.TestCase):
+
+    def test_json_array_stream_should_encode_any_number_of_records(self):
+        import json
+        for count in [0, 1, 5, 250]:
+            chunks = list(core.stream_json_array(({'n': i} for i in range(count)), records_per_chunk=10))
+            self.assertEqual(json.loads(''.join(chunks)), [{'n': i} for i in range(count)])
+
+
+    def test_ndjson_stream_should_yield_bounded_chunks(self):
+        chunks = list(core.stream_ndjson(({'n': i} for i in range(25)), records_per_chunk=10))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks).count('\n'), 25)
+
+
+    def test_transform_status_should_detect_generator_output(self):
+        self.assertTrue(core.TransformStatus(core.stream_ndjson([])).is_streaming)
+        self.assertFalse(core.TransformStatus('{}').is_streaming)
+
+
+class JSONCodecTest(unittest.TestCase):
+
+    def tearDown(self):
+        jsoncodec.select('stdlib')
+
+
+    def test_every_installed_codec_should_round_trip_bytes_and_complex_numbers(self):
+        for codec_name in jsoncodec.CODECS:
+            try:
+                codec = jsoncodec.CODECS[codec_name]()
+            except ImportError:
+                continue
+            self.assertEqual(codec.loads(b'{"a": [1, 2]}'), {'a': [1, 2]})
+            self.assertEqual(codec.loads(codec.dumps({'z': complex(1, 2)})), {'z': [1.0, 2.0]})
+            self.assertIsInstance(codec.dumps_bytes({}), bytes)
+
+
+    def test_selecting_an_uninstalled_codec_should_fall_back_to_an_available_one(self):
+        import importlib.util
+        codec = jsoncodec.select('ujson')
+        if importlib.util.find_spec('ujson') is None:
+            self.assertNotEqual(codec.name, 'ujson')
+        self.assertIs(codec, jsoncodec.current)
+
+
+    def test_selecting_an_unknown_codec_should_raise(self):
+        with self.assertRaises(jsoncodec.UnsupportedJSONCodecException):
+            jsoncodec.select('simdjson')
+
+
+    def test_encode_output_should_only_encode_unencoded_output(self):
+        self.assertEqual(core.encode_output('{"a": 1}'), '{"a": 1}')
+        self.assertEqual(jsoncodec.loads(core.encode_output({'a': 1})), {'a': 1})
+
+
+class MediaTypeTest(unittest.TestCase):
+
+    def test_content_type_spellings_should_resolve_to_the_registered_decoder(self):
+        protocol = core.ContentProtocol()
+        protocol.update('application/json', 'json_decoder')
+        protocol.update('text/*', 'text_decoder')
+
+        self.assertEqual(protocol.decoding_map.resolve('application/json'), 'json_decoder')
+        self.assertEqual(protocol.decoding_map.resolve('Application/JSON; charset=utf-8'), 'json_decoder')
+        self.assertEqual(protocol.decoding_map.resolve('text/plain;charset="UTF-8"'), 'text_decoder')
+        self.assertIsNone(protocol.decoding_map.resolve('image/png'))
+
+
+    def test_media_type_parameters_should_be_parsed(self):
+        media_type = core.parse_media_type('text/plain; Charset="UTF-8"; q=0.3')
+        self.assertEqual(media_type.essence, 'text/plain')
+        self.assertEqual(media_type.params['charset'], 'UTF-8')
+        self.assertEqual(media_type.quality, 0.3)
+
+
+    def test_negotiation_should_honor_quality_and_specificity(self):
+        offered = ['application/json', 'application/x-ndjson']
+        self.assertEqual(core.negotiate(None, offered), 'application/json')
+        self.assertEqual(core.negotiate('*/*', offered), 'application/json')
+        self.assertEqual(core.negotiate('application/x-ndjson', offered), 'application/x-ndjson')
+        self.assertEqual(core.negotiate('application/*;q=0.5, application/x-ndjson', offered), 'application/x-ndjson')
+        self.assertEqual(core.negotiate('application/*, application/json;q=0', offered), 'application/x-ndjson')
+        self.assertIsNone(core.negotiate('text/html', offered))
+
+
+    def test_transformer_should_negotiate_among_registered_output_mimetypes(self):
+        xformer = core.Transformer({})
+        xformer.register_transform('export', build_test_shape(), lambda data, svc: data,
+                                   ['application/json', 'application/x-ndjson'])
+        self.assertEqual(xformer.target_mimetype_for_transform('export'), 'application/json')
+        self.assertEqual(xformer.target_mimetype_for_transform('export', 'application/x-ndjson'),
+                         'application/x-ndjson')
+        self.assertIsNone(xformer.target_mimetype_for_transform('export', 'text/csv'))
+
+
+class WireFormatTest(unittest.TestCase):
+
+    def test_output_should_be_encoded_according_to_the_response_mimetype(self):
+        for mimetype, package_name in ((wireformats.MIMETYPE_MSGPACK, 'msgpack'),
+                                       (wireformats.MIMETYPE_CBOR, 'cbor2')):
+            if importlib.util.find_spec(package_name) is None:
+                continue
+            wire_format = wireformats.get(mimetype)
+            self.assertEqual(wire_format.loads(core.encode_output({'a': [1, 2]}, mimetype)), {'a': [1, 2]})
+            # JSON text returned by a transform is transcoded
+            self.assertEqual(wire_format.loads(core.encode_output('{"a": 1}', mimetype)), {'a': 1})
+
+        self.assertEqual(core.encode_output('{"a": 1}', core.MIMETYPE_JSON), '{"a": 1}')
+
+
+    def test_missing_wire_format_library_should_raise(self):
+        wireformats.FORMATS['application/x-test-format'] = MissingLibraryFormat
+        try:
+            with self.assertRaises(wireformats.MissingWireFormatLibraryException):
+                wireformats.get('application/x-test-format')
+        finally:
+            del wireformats.FORMATS['application/x-test-format']
+
+
+    def test_formats_without_their_library_should_not_be_negotiated(self):
+        wireformats.FORMATS['application/x-test-format'] = MissingLibraryFormat
+        try:
+            xformer = core.Transformer({})
+            xformer.register_transform('export', build_test_shape(), lambda data, svc: data,
+                                       ['application/json', 'application/x-test-format'])
+            xformer.register_transform('binary_only', build_test_shape(), lambda data, svc: data,
+                                       'application/x-test-format')
+        finally:
+            del wireformats.FORMATS['application/x-test-format']
+
+        self.assertIsNone(xformer.target_mimetype_for_transform('export', 'application/x-test-format'))
+        self.assertEqual(xformer.target_mimetype_for_transform('export', 'application/x-test-format, */*;q=0.1'),
+                         'application/json')
+        self.assertEqual(xformer.bind('export').negotiate('application/*'), 'application/json')
+        # a transform offering only formats which cannot be encoded falls back to JSON
+        self.assertEqual(xformer.target_mimetype_for_transform('binary_only'), 'application/json')
+        self.assertIsNone(xformer.target_mimetype_for_transform('binary_only', 'application/x-test-format'))
+
+
+class MissingLibraryFormat(object):
+    package_name = 'not_a_real_package'
+
+    def __init__(self):
+        import not_a_real_package
+
+
+class ServiceObjectPoolTest(unittest.TestCase):
+
+    def test_each_concurrent_checkout_should_get_its_own_instance(self):
+        registry = common.ServiceObjectRegistry({'pooled': common.ServiceObjectPool('pooled', object, 3)})
+        checked_out = []
+        barrier = threading.Barrier(3)
+
+        def use_service():
+            with registry.checkout('pooled') as instance:
+                checked_out.append(instance)
+                barrier.wait(timeout=5)
+
+        threads = [threading.Thread(target=use_service) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(id(i) for i in checked_out)), 3)
+        stats = registry.pool_stats()['pooled']
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['max_in_use'], 3)
+        self.assertEqual(stats['in_use'], 0)
+
+
+    def test_exhausted_pool_should_time_out(self):
+        pool = common.ServiceObjectPool('pooled', object, 1, timeout=0.01)
+        with pool.checkout():
+            with self.assertRaises(common.ServiceObjectPoolExhaustedException):
+                pool.acquire()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+        with pool.checkout() as instance:
+            self.assertIsNotNone(instance)
+
+
+    def test_pooled_service_should_not_be_shared_through_lookup(self):
+        registry = common.ServiceObjectRegistry({'shared': object(),
+                                                 'pooled': common.ServiceObjectPool('pooled', object, 1)})
+        with registry.checkout('shared') as instance:
+            self.assertIs(instance, registry.lookup('shared'))
+        with self.assertRaises(common.PooledServiceObjectLookupException):
+            registry.lookup('pooled')
+
+
+class ServiceInitializationTest(unittest.TestCase):
+
+    def build_specs(self, build_log, **dependencies):
+        def factory(alias):
+            def build():
+                build_log.append(alias)
+                return alias
+            return build
+        return {alias: common.ServiceObjectSpec(alias, factory(alias), depends_on=depends_on)
+                for alias, depends_on in dependencies.items()}
+
+
+    def test_services_should_be_leveled_by_dependency(self):
+        specs = self.build_specs([], db=[], cache=[], repo=['db'], api=['repo', 'cache'])
+        levels = common.dependency_levels(specs)
+        self.assertEqual([sorted(level) for level in levels], [['cache', 'db'], ['repo'], ['api']])
+
+
+    def test_circular_or_unknown_dependencies_should_raise(self):
+        with self.assertRaises(common.CircularServiceDependencyException):
+            common.dependency_levels(self.build_specs([], a=['b'], b=['a']))
+        with self.assertRaises(common.UnknownServiceDependencyException):
+            common.dependency_levels(self.build_specs([], a=['missing']))
+
+
+    def test_lazy_service_should_build_its_dependencies_first(self):
+        build_log = []
+        specs = self.build_specs(build_log, db=[], repo=['db'])
+        for spec in specs.values():
+            spec.lazy = True
+        registry = common.ServiceObjectRegistry({alias: common.LazyServiceObject(spec)
+                                                 for alias, spec in specs.items()})
+        self.assertEqual(build_log, [])
+        self.assertEqual(registry.lookup('repo'), 'repo')
+        self.assertEqual(build_log, ['db', 'repo'])
+        registry.lookup('repo')
+        self.assertEqual(build_log, ['db', 'repo'])
+
+
+class ClosableService(object):
+    def __init__(self, alias, event_log):
+        self.alias = alias
+        self.event_log = event_log
+
+    def close(self):
+        self.event_log.append(('close', self.alias))
+
+
+class ServiceLifecycleTest(unittest.TestCase):
+
+    def build_registry(self, event_log, **spec_settings):
+        specs = {}
+        for alias, settings in spec_settings.items():
+            specs[alias] = common.ServiceObjectSpec(alias,
+                                                    lambda alias=alias: ClosableService(alias, event_log),
+                                                    **settings)
+        return common.ServiceObjectRegistry({alias: spec.build() for alias, spec in specs.items()}, specs)
+
+
+    def test_forked_worker_should_build_its_own_service_objects(self):
+        event_log = []
+        registry = self.build_registry(event_log, conn={}, config={'fork_safe': True})
+        inherited_conn = registry.lookup('conn')
+        inherited_config = registry.lookup('config')
+
+        registry.pid = -1   # as seen by a process forked from the registry's creator
+        self.assertIsNot(registry.lookup('conn'), inherited_conn)
+        self.assertIs(registry.lookup('config'), inherited_config)
+        # the parent's connection is left alone
+        self.assertEqual(event_log, [])
+
+
+    def test_close_should_close_dependents_before_their_dependencies(self):
+        event_log = []
+        registry = self.build_registry(event_log, db={}, repo={'depends_on': ['db']}, pool={'pool_size': 2})
+        with registry.checkout('pool'):
+            registry.close()
+            self.assertEqual(event_log[0], ('close', 'repo'))
+            self.assertIn(('close', 'db'), event_log)
+            self.assertEqual(event_log.count(('close', 'pool')), 1)
+        self.assertEqual(event_log.count(('close', 'pool')), 2)
+
+        registry.close()
+        self.assertEqual(len(event_log), 4)
+
+
+def validate_sku(value):
+    if not str(value).startswith('SKU'):
+        raise Exception('not a SKU: %s' % value)
+    return True
+
+
+class HotReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None)
+        self.xformer.register_transform('count', build_test_shape(), self.count_func, 'application/json')
+
+
+    def count_func(self, input_data, service_objects, **kwargs):
+        return core.TransformStatus(input_data['count'])
+
+
+    def build_config(self, fields):
+        return {
+            'globals': {},
+            'data_shapes': {'core_test_shape': {'fields': fields}},
+            'transforms': {'count': {'input_shape': 'core_test_shape',
+                                     'output_mimetype': ['application/json', 'application/msgpack']}}
+        }
+
+
+    def test_swapped_state_should_apply_the_new_shape_and_mimetypes(self):
+        new_state = snap.build_runtime_state(self.xformer, self.build_config([
+            {'name': 'count', 'datatype': 'int', 'required': True},
+            {'name': 'label', 'datatype': 'string', 'required': True}
+        ]))
+        old_action = self.xformer.actions['count']
+        old_state = self.xformer.swap_state(new_state)
+
+        self.assertIs(old_state.actions['count'], old_action)
+        new_action = self.xformer.actions['count']
+        self.assertIs(new_action.transform_function, old_action.transform_function)
+        self.assertEqual(new_action.output_mimetypes, ['application/json', 'application/msgpack'])
+        with self.assertRaises(core.MissingInputFieldException):
+            new_action.execute({'count': 1}, None)
+        self.assertEqual(new_action.execute({'count': 1, 'label': 'x'}, None).output_data, 1)
+
+
+    def test_bound_transform_should_follow_a_swapped_state(self):
+        bound_transform = self.xformer.bind('count')
+        self.assertIs(self.xformer.bind('count'), bound_transform)
+        self.xformer.swap_state(snap.build_runtime_state(self.xformer, self.build_config([
+            {'name': 'count', 'datatype': 'int', 'required': True}
+        ])))
+        self.assertIs(bound_transform.action, self.xformer.actions['count'])
+        self.assertEqual(bound_transform.negotiate('application/msgpack'), 'application/msgpack')
+        self.assertEqual(bound_transform.transform({'count': 2}).output_data, 2)
+
+
+    def test_executor_pool_should_survive_a_reload(self):
+        pool = self.xformer.add_executor_pool('heavy', 2)
+        self.addCleanup(pool.shutdown)
+        self.xformer.assign_executor_pool('count', 'heavy')
+        config = self.build_config([{'name': 'count', 'datatype': 'int', 'required': True}])
+        config['transforms']['count']['executor_pool'] = 'heavy'
+        self.xformer.swap_state(snap.build_runtime_state(self.xformer, config))
+        self.assertIs(self.xformer.actions['count'].executor_pool, pool)
+        self.assertEqual(self.xformer.transform('count', {'count': 3}).output_data, 3)
+        self.assertEqual(pool.stats()['completed'], 1)
+
+        # a pool the running service does not have keeps the current assignment
+        config['transforms']['count']['executor_pool'] = 'unknown'
+        self.xformer.swap_state(snap.build_runtime_state(self.xformer, config))
+        self.assertIs(self.xformer.actions['count'].executor_pool, pool)
+
+
+    def test_compiled_shape_should_use_the_validators_it_was_given(self):
+        shape = core.InputShape('custom_type_shape')
+        shape.add_field('code', 'sku', True)
+        validators = {'sku': validate_sku}
+        missing, errors = shape.compile(validators).check({'code': 'SKU-1'})
+        self.assertEqual(errors, [])
+        missing, errors = shape.compile(validators).check({'code': 'ABC'})
+        self.assertEqual(len(errors), 1)
+
+
+    def test_watcher_should_call_back_once_per_change(self):
+        calls = []
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+            f.write('globals: {}\n')
+        try:
+            watcher = reload.ConfigWatcher(f.name, lambda: calls.append(1))
+            self.assertFalse(watcher.check())
+            with open(f.name, 'a') as config_file:
+                config_file.write('transforms: {}\n')
+            self.assertTrue(watcher.check())
+            self.assertFalse(watcher.check())
+            self.assertEqual(calls, [1])
+        finally:
+            os.remove(f.name)
+
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None)
+        self.xformer.register_transform('count', build_test_shape(), self.slow_count_func, 'application/json')
+        self.xformer.enable_coalescing('count')
+        self.calls = []
+        self.release = threading.Event()
+
+
+    def slow_count_func(self, input_data, service_objects, **kwargs):
+        self.calls.append(input_data['count'])
+        self.release.wait(5)
+        return core.TransformStatus(input_data['count'])
+
+
+    def run_concurrently(self, inputs):
+        statuses = [None] * len(inputs)
+
+        def call(index):
+            statuses[index] = self.xformer.transform('count', inputs[index])
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(len(inputs))]
+        for t in threads:
+            t.start()
+        # let every caller join its flight before the leaders finish
+        while self.xformer.coalescing_stats()['count']['shared'] < len(inputs) - len(set(map(str, inputs))):
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return statuses
+
+
+    def test_identical_concurrent_calls_should_share_one_execution(self):
+        statuses = self.run_concurrently([{'name': 'a', 'count': 1}] * 8)
+        self.assertEqual(self.calls, [1])
+        self.assertTrue(all(s is statuses[0] for s in statuses))
+        self.assertEqual(self.xformer.coalescing_stats()['count']['executions'], 1)
+
+
+    def test_different_inputs_should_not_be_coalesced(self):
+        statuses = self.run_concurrently([{'name': 'a', 'count': 1}, {'name': 'a', 'count': '1'}])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual([s.output_data for s in statuses], [1, '1'])
+
+
+    def test_calls_after_the_flight_lands_should_run_again(self):
+        self.release.set()
+        self.xformer.transform('count', {'name': 'a', 'count': 1})
+        self.xformer.transform('count', {'name': 'a', 'count': 1})
+        self.assertEqual(self.calls, [1, 1])
+
+
+    def test_followers_should_share_the_leaders_exception(self):
+        flight = concurrency.SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            self.release.wait(5)
+            raise ValueError('backend down')
+
+        def follow():
+            try:
+                flight.do('key', fail)
+            except ValueError as err:
+                errors.append(err)
+
+        leader = threading.Thread(target=follow)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=follow)
+        follower.start()
+        while flight.shared < 1:
+            time.sleep(0.001)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(flight.executions, 1)
+
+
+    def test_followers_should_stop_waiting_at_their_deadline(self):
+        leader = threading.Thread(target=self.xformer.transform, args=('count', {'name': 'a', 'count': 1}))
+        leader.start()
+        while not self.calls:
+            time.sleep(0.001)
+        status = self.xformer.transform('count', {'name': 'a', 'count': 1},
+                                        headers={core.REQUEST_TIMEOUT_HEADER: '20'})
+        self.release.set()
+        leader.join()
+        self.assertFalse(status.ok)
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+        self.assertEqual(self.calls, [1])
+
+
+    def test_async_followers_should_stop_waiting_at_their_timeout(self):
+        flight = concurrency.SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0.2)
+            return value
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do_async('key', fetch, 42))
+            await asyncio.sleep(0)
+            with self.assertRaises(concurrency.FlightTimeoutException):
+                await flight.do_async('key', fetch, 42, timeout=0.01)
+            # the follower giving up does not cancel the leader's call
+            return await leader
+
+        self.assertEqual(asyncio.run(run()), (42, False))
+
+
+    def test_async_calls_should_share_one_execution(self):
+        flight = concurrency.SingleFlight()
+        calls = []
+
+        async def fetch(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        async def run():
+            return await asyncio.gather(*[flight.do_async('key', fetch, 42) for i in range(5)])
+
+        results = asyncio.run(run())
+        self.assertEqual(calls, [42])
+        self.assertEqual([r[0] for r in results], [42] * 5)
+        self.assertEqual([r[1] for r in results], [False] + [True] * 4)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_requests_over_the_limit_should_be_shed(self):
+        controller = admission.AdmissionController(max_concurrency=2)
+        permits = [controller.try_acquire(), controller.try_acquire()]
+        self.assertIsNone(controller.try_acquire())
+        permits[0].release()
+        permits[0].release()
+        self.assertIsNotNone(controller.try_acquire())
+        self.assertEqual(controller.stats()['shed'], 1)
+        self.assertEqual(controller.stats()['in_flight'], 2)
+
+
+    def test_queued_request_should_run_when_a_permit_is_released(self):
+        controller = admission.AdmissionController(max_concurrency=1, max_queue=1, queue_timeout_ms=5000)
+        permit = controller.try_acquire()
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(controller.try_acquire()))
+        waiter.start()
+        while controller.stats()['waiting'] < 1:
+            time.sleep(0.001)
+        # the queue is full, so the next request is shed without waiting
+        self.assertIsNone(controller.try_acquire())
+        permit.release()
+        waiter.join()
+        self.assertIsNotNone(results[0])
+
+
+    def test_queued_request_should_be_shed_after_the_queue_timeout(self):
+        controller = admission.AdmissionController(max_concurrency=1, max_queue=1, queue_timeout_ms=10)
+        controller.try_acquire()
+        self.assertIsNone(controller.try_acquire())
+        self.assertIsNone(controller.try_acquire(block=False))
+        self.assertEqual(controller.stats()['shed'], 2)
+
+
+    def test_adaptive_limit_should_back_off_on_slow_requests_and_recover(self):
+        controller = admission.AdmissionController(max_concurrency=10, target_latency_ms=100, backoff=0.5)
+        controller.try_acquire()
+        controller.release(0.5)
+        self.assertEqual(controller.stats()['limit'], 5)
+
+        # rounds of fast requests, each using the whole limit
+        for i in range(50):
+            limit = controller.stats()['limit']
+            for j in range(limit):
+                controller.try_acquire()
+            for j in range(limit):
+                controller.release(0.001)
+        self.assertEqual(controller.stats()['limit'], 10)
+
+
+    def test_permit_held_by_a_stream_should_be_released_when_the_stream_ends(self):
+        controller = admission.AdmissionController(max_concurrency=1)
+        permit = controller.try_acquire()
+        stream = permit.release_after(iter(['a', 'b']))
+        # the handler returns (and releases) before the body is sent
+        permit.release()
+        self.assertEqual(controller.stats()['in_flight'], 1)
+        self.assertEqual(list(stream), ['a', 'b'])
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+        permit = controller.try_acquire()
+        permit.release_after(x for x in 'ab').close()
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+
+    def test_permit_held_by_an_async_stream_should_be_released_when_the_stream_closes(self):
+        async def chunks():
+            yield 'a'
+            yield 'b'
+
+        async def read_first_chunk(stream):
+            chunk = await stream.__anext__()
+            await stream.aclose()
+            return chunk
+
+        controller = admission.AdmissionController(max_concurrency=1)
+        permit = controller.try_acquire()
+        stream = permit.release_after(chunks())
+        permit.release()
+        self.assertTrue(core.is_output_stream(stream))
+        self.assertEqual(asyncio.run(read_first_chunk(stream)), 'a')
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+
+    def test_transforms_without_admission_control_should_admit_everything(self):
+        xformer = core.Transformer(None)
+        xformer.register_transform('count', build_test_shape(), lambda data, services, **kwargs: None, 'application/json')
+        self.assertIs(xformer.admit('count'), admission.NULL_PERMIT)
+        xformer.enable_admission_control('count', max_concurrency=1)
+        self.assertIsNotNone(xformer.admit('count'))
+        self.assertIsNone(xformer.admit('count', block=False))
+        self.assertEqual(xformer.admission_stats()['count']['shed'], 1)
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None, sync_threads=2)
+        self.xformer.register_transform('sleep', build_test_shape(), self.sleep_func, 'application/json')
+        self.xformer.register_error_code(core.TransformTimeoutException, core.HTTP_GATEWAY_TIMEOUT)
+        self.budgets = []
+        self.threads = []
+
+
+    def sleep_func(self, input_data, service_objects, **kwargs):
+        self.threads.append(threading.current_thread())
+        if kwargs.get('deadline') is not None:
+            self.budgets.append(kwargs['deadline'].remaining_ms())
+        time.sleep(input_data['count'] / 1000.0)
+        return core.TransformStatus('slept')
+
+
+    def test_transform_overrunning_its_timeout_should_fail_with_504(self):
+        self.xformer.set_timeout('sleep', 20)
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 500})
+        self.assertFalse(status.ok)
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+
+    def test_transform_should_receive_its_remaining_budget(self):
+        self.xformer.set_timeout('sleep', 5000)
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 1})
+        self.assertEqual(status.output_data, 'slept')
+        self.assertTrue(0 < self.budgets[0] <= 5000)
+
+
+    def test_request_timeout_header_should_tighten_the_deadline(self):
+        self.xformer.set_timeout('sleep', 5000)
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 500}, headers={core.REQUEST_TIMEOUT_HEADER: '20'})
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 1}, headers={core.REQUEST_TIMEOUT_HEADER: 'soon'})
+        self.assertTrue(status.ok)
+        self.assertEqual(len(self.budgets), 2)
+
+
+    def test_caller_deadline_should_bound_the_transform(self):
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 1}, deadline=core.Deadline(5000))
+        self.assertEqual(status.output_data, 'slept')
+        self.assertTrue(0 < self.budgets[0] <= 5000)
+
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 500}, deadline=core.Deadline(20))
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+
+    def test_caller_deadline_should_bound_a_batch(self):
+        records = [{'name': 'a', 'count': 1}, {'name': 'b', 'count': 1}]
+        statuses = self.xformer.transform_batch('sleep', records, deadline=core.Deadline(5000))
+        self.assertEqual([s.output_data for s in statuses], ['slept', 'slept'])
+
+        statuses = self.xformer.transform_batch('sleep', [{'name': 'a', 'count': 500}], deadline=core.Deadline(20))
+        self.assertEqual(statuses[0].get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+
+    def test_transform_without_a_deadline_should_run_inline(self):
+        status = self.xformer.transform('sleep', {'name': 'a', 'count': 1})
+        self.assertTrue(status.ok)
+        self.assertEqual(self.budgets, [])
+        self.assertEqual(self.threads, [threading.current_thread()])
+
+
+    def test_bound_transform_without_a_deadline_should_run_inline(self):
+        sleep_transform = self.xformer.bind('sleep')
+        status = sleep_transform.transform({'name': 'a', 'count': 1}, headers={})
+        self.assertEqual(status.output_data, 'slept')
+        self.assertEqual(self.threads, [threading.current_thread()])
+
+
+    def test_bound_transform_should_honor_deadlines(self):
+        sleep_transform = self.xformer.bind('sleep')
+        status = sleep_transform.transform({'name': 'a', 'count': 500}, headers={core.REQUEST_TIMEOUT_HEADER: '20'})
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+        status = sleep_transform.transform({'name': 'a', 'count': 500}, deadline=core.Deadline(20))
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+        self.xformer.set_timeout('sleep', 20)
+        status = sleep_transform.transform({'name': 'a', 'count': 500})
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+
+    def test_async_transform_overrunning_its_timeout_should_fail_with_504(self):
+        async def slow_func(input_data, service_objects, **kwargs):
+            await asyncio.sleep(1)
+            return core.TransformStatus('done')
+
+        self.xformer.register_transform('slow', build_test_shape(), slow_func, 'application/json')
+        status = asyncio.run(self.xformer.transform_async('slow', {'name': 'a', 'count': 1},
+                                                          deadline=core.Deadline(20)))
+        self.assertEqual(status.get_error_code(), core.HTTP_GATEWAY_TIMEOUT)
+
+
+class ExecutorPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xformer = core.Transformer(None)
+        self.xformer.register_transform('report', build_test_shape(), self.report_func, 'application/json')
+        self.xformer.register_error_code(executors.ExecutorPoolFullException, core.HTTP_SERVICE_UNAVAILABLE)
+        self.xformer.add_executor_pool('heavy', threads=1, max_queue=1)
+        self.xformer.assign_executor_pool('report', 'heavy')
+        self.release = threading.Event()
+        self.threads = []
+
+
+    def report_func(self, input_data, service_objects, **kwargs):
+        self.threads.append(threading.current_thread().name)
+        if input_data['name'] == 'slow':
+            self.release.wait(5)
+        return core.TransformStatus('report')
+
+
+    def test_transform_should_run_on_its_pool(self):
+        status = self.xformer.transform('report', {'name': 'fast', 'count': 1})
+        self.assertEqual(status.output_data, 'report')
+        self.assertTrue(self.threads[0].startswith('snap-pool-heavy'))
+
+
+    def test_calls_beyond_the_pool_capacity_should_be_refused(self):
+        pool = self.xformer.executor_pools['heavy']
+        callers = [threading.Thread(target=self.xformer.transform, args=('report', {'name': 'slow', 'count': 1}))
+                   for i in range(2)]
+        for caller in callers:
+            caller.start()
+        while pool.stats()['pending'] < 2:
+            time.sleep(0.001)
+        status = self.xformer.transform('report', {'name': 'fast', 'count': 1})
+        self.release.set()
+        for caller in callers:
+            caller.join()
+        self.assertEqual(status.get_error_code(), core.HTTP_SERVICE_UNAVAILABLE)
+        self.assertEqual(self.xformer.executor_pool_stats()['heavy']['rejected'], 1)
+
+
+    def test_unknown_pool_should_be_rejected(self):
+        with self.assertRaises(executors.NoSuchExecutorPoolException):
+            self.xformer.assign_executor_pool('report', 'light')
+        with self.assertRaises(executors.InvalidExecutorPoolSettingsException):
+            executors.BoundedExecutor('empty', 0)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
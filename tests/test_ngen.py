@@ -0,0 +1,82 @@
+import unittest
+import os
+from context import snap
+from snap import ngen
+
+
+def server_config(**settings):
+    config = {'hostname': 'api.example.com', 'port': 80}
+    config.update(settings)
+    return config
+
+
+def sample_config(**settings):
+    return {'nginx_servers': {'prod': server_config(**settings)},
+            'transforms': {'ping': {'route': '/ping', 'method': 'GET', 'cache': {'ttl': 30}},
+                           'widget': {'route': '/widget/<int:widget_id>', 'method': 'GET', 'cache': {'ttl': 1}},
+                           'uncached': {'route': '/uncached', 'method': 'GET'},
+                           'update': {'route': '/update', 'method': 'POST'}}}
+
+
+class NginxGenerationTest(unittest.TestCase):
+
+    def test_upstream_pool_should_balance_across_all_sockets_and_hosts(self):
+        config = ngen.load_nginx_config_table(sample_config(uwsgi_sock='/run/a.sock',
+                                                            upstreams=['/run/b.sock',
+                                                                       {'address': '10.0.0.2:3031', 'weight': 2, 'backup': True}]))['prod']
+        output = ngen.render_nginx_config(config)
+        self.assertIn('least_conn;', output)
+        self.assertIn('server unix:/run/a.sock;', output)
+        self.assertIn('server unix:/run/b.sock;', output)
+        self.assertIn('server 10.0.0.2:3031 weight=2 backup;', output)
+        self.assertIn('worker_processes  auto;', output)
+        self.assertIn('gzip              on;', output)
+        self.assertIn('uwsgi_buffering on;', output)
+        # the uwsgi protocol cannot keep upstream connections open
+        self.assertNotIn('keepalive 32;', output)
+
+
+    def test_http_upstreams_should_use_keepalive_connections(self):
+        config = ngen.load_nginx_config_table(sample_config(upstreams=['10.0.0.2:8000'], protocol='http'))['prod']
+        output = ngen.render_nginx_config(config)
+        self.assertIn('keepalive 32;', output)
+        self.assertIn('proxy_pass http://snap_prod;', output)
+        self.assertIn('proxy_set_header Connection "";', output)
+        self.assertNotIn('uwsgi_', output)
+
+
+    def test_microcache_should_cover_only_cacheable_get_transforms(self):
+        config = ngen.load_nginx_config_table(sample_config(uwsgi_sock='/run/a.sock', microcache={'ttl': 2}))['prod']
+        locations = {route.route: route for route in config.microcached_routes}
+        self.assertEqual(sorted(locations), ['/ping', '/widget/<int:widget_id>'])
+        self.assertEqual(locations['/ping'].ttl, 2)
+        # a transform's own cache ttl caps the microcache ttl
+        self.assertEqual(locations['/widget/<int:widget_id>'].ttl, 1)
+        self.assertEqual(locations['/widget/<int:widget_id>'].location, '~ ^/widget/[^/]+$')
+
+        output = ngen.render_nginx_config(config)
+        self.assertIn('location = /ping {', output)
+        self.assertIn('uwsgi_cache_valid 200 2s;', output)
+        self.assertIn('keys_zone=snap_prod_cache:10m', output)
+
+
+    def test_microcache_should_be_off_by_default(self):
+        config = ngen.load_nginx_config_table(sample_config(uwsgi_sock='/run/a.sock'))['prod']
+        self.assertEqual(config.microcached_routes, [])
+        self.assertNotIn('uwsgi_cache', ngen.render_nginx_config(config))
+
+
+    def test_invalid_settings_should_be_rejected(self):
+        with self.assertRaises(ngen.InvalidNginxSettingException):
+            ngen.load_nginx_config_table(sample_config())
+        with self.assertRaises(ngen.InvalidNginxSettingException):
+            ngen.load_nginx_config_table(sample_config(uwsgi_sock='/run/a.sock', balance='random'))
+        with self.assertRaises(ngen.InvalidNginxSettingException):
+            ngen.load_nginx_config_table(sample_config(uwsgi_sock='/run/a.sock', microcache={'ttl': 0}))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
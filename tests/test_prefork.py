@@ -0,0 +1,120 @@
+import unittest
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from context import snap
+from snap import prefork
+
+
+SERVER_SCRIPT = '''
+import os, sys
+from snap import prefork
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+class Services(object):
+    def close(self):
+        print('closed %%d' %% os.getpid(), flush=True)
+
+app.config = {'services': Services()}
+
+server = prefork.PreforkServer(app, '127.0.0.1', 0, workers=2, max_requests=3, reuseport=%r, graceful_timeout=5)
+print(server.bind(), flush=True)
+server.run()
+'''
+
+SMAPS_ROLLUP = """55d0c5a00000-7ffd2f7ff000 ---p 00000000 00:00 0                          [rollup]
+Rss:               30000 kB
+Pss:               13000 kB
+Shared_Clean:      20000 kB
+Shared_Dirty:       5000 kB
+Private_Clean:      1000 kB
+Private_Dirty:      4000 kB
+Referenced:        30000 kB
+"""
+
+
+class MemoryReportTest(unittest.TestCase):
+
+    def test_smaps_fields_should_be_summed_in_kilobytes(self):
+        totals = prefork.parse_smaps(SMAPS_ROLLUP + SMAPS_ROLLUP)
+        self.assertEqual(totals['Rss'], 60000)
+        self.assertEqual(totals['Private_Dirty'], 8000)
+
+
+    @unittest.skipUnless(os.path.exists('/proc/self/smaps'), 'requires /proc smaps')
+    def test_memory_report_should_split_shared_and_private_memory(self):
+        report = prefork.memory_report([os.getpid()])
+        usage = report['workers'][os.getpid()]
+        self.assertGreater(usage['rss'], 0)
+        self.assertEqual(usage['shared'] + usage['private'], usage['rss'])
+        self.assertEqual(report['totals']['rss'], usage['rss'])
+        self.assertIn('private kB', prefork.format_memory_report(report))
+
+
+    def test_invalid_settings_should_be_rejected(self):
+        with self.assertRaises(prefork.InvalidServerSettingException):
+            prefork.PreforkServer(None, '127.0.0.1', 0, workers=2, max_requests=-1)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+class PreforkServerTest(unittest.TestCase):
+
+    def run_server(self, reuseport):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.join(os.path.dirname(__file__), '..')] + sys.path)
+        process = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT % reuseport],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL,
+                                   env=env)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.kill)
+        port = int(process.stdout.readline())
+        return process, 'http://127.0.0.1:%d/' % port
+
+
+    def request_pid(self, url):
+        for attempt in range(50):
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    return int(response.read())
+            except (IOError, OSError):
+                # no worker is listening yet
+                time.sleep(0.1)
+        self.fail('the server did not answer')
+
+
+    def check_recycling_and_shutdown(self, reuseport):
+        process, url = self.run_server(reuseport)
+        pids = set(self.request_pid(url) for i in range(12))
+        # two workers serving three requests each before they are replaced
+        self.assertGreaterEqual(len(pids), 4)
+        self.assertNotIn(process.pid, pids)
+
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(timeout=10), 0)
+        # every worker, recycled or shut down, closed its service objects before exiting
+        closed_pids = set(int(line.split()[1]) for line in process.stdout.read().decode().splitlines())
+        self.assertTrue(pids <= closed_pids)
+
+
+    def test_workers_should_share_the_listening_socket_and_be_recycled(self):
+        self.check_recycling_and_shutdown(False)
+
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'requires SO_REUSEPORT')
+    def test_workers_should_listen_with_reuseport_and_be_recycled(self):
+        self.check_recycling_and_shutdown(True)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
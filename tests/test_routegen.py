@@ -1,5 +1,6 @@
 import unittest
 import os
+import json
 import yaml
 from contextlib import contextmanager
 import py_compile as pc
@@ -8,6 +9,7 @@ from snap import snap, common
 
 
 GENERATED_APP_FILE = 'test_app.py'
+GENERATED_OPTIMIZED_APP_MODULE = 'test_optimized_app'
 
 
 class RouteGenerationTest(unittest.TestCase):
@@ -52,6 +54,44 @@ class RouteGenerationTest(unittest.TestCase):
             transform_function = getattr(transform_module, funcname)
             transform_function({}, common.ServiceObjectRegistry({}))
 
+
+class OptimizedRouteGenerationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        project_home = os.getenv('SNAP_TEST_HOME')
+        if not project_home:
+            raise Exception('the environment variable SNAP_TEST_HOME has not been set.')
+        os.environ['SNAP_CONFIG'] = os.path.join(project_home, '..', 'data', 'good_sample_config.yaml')
+        cls.app_module = pc.importlib.import_module(GENERATED_OPTIMIZED_APP_MODULE)
+        cls.client = cls.app_module.app.test_client()
+
+
+    def test_optimized_handlers_should_be_bound_to_their_transforms(self):
+        bound_transform = self.app_module.post_target_transform
+        self.assertIs(bound_transform.action, self.app_module.xformer.actions['post_target'])
+
+
+    def test_optimized_handlers_should_serve_get_and_post_transforms(self):
+        response = self.client.get('/ping')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'message': 'pong'})
+
+        response = self.client.post('/posttest', json={'placeholder': 'value'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('test_decoder_called', json.loads(response.data))
+
+        response = self.client.post('/posttest', json={'foo': 'bar'})
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_optimized_handlers_should_negotiate_the_output_mimetype(self):
+        response = self.client.get('/ping', headers={'Accept': 'text/csv'})
+        self.assertEqual(response.status_code, 406)
+        response = self.client.post('/posttest', json={'placeholder': 'value'}, headers={'Accept': '*/*'})
+        self.assertEqual(response.mimetype, 'application/json')
+
+
 def main():
     unittest.main()
 
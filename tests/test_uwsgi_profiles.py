@@ -0,0 +1,77 @@
+import unittest
+import os
+import jinja2
+from context import snap
+from snap import common, config_templates, uwsgi_profiles
+
+
+def environment_config(**settings):
+    env_config = {'base_directory': '/srv/svc',
+                  'python_home': '/srv/svc/venv',
+                  'socket_directory': '/srv/svc/run',
+                  'log_directory': '/srv/svc/log'}
+    env_config.update(settings)
+    return {'uwsgi_environments': {'prod': env_config}}
+
+
+class UWSGIProfileTest(unittest.TestCase):
+
+    def test_profiles_should_size_workers_and_threads_from_the_core_count(self):
+        cpu_env = uwsgi_profiles.load_uwsgi_environments(environment_config(profile='cpu', cores=8))['prod']
+        self.assertEqual((cpu_env.processes, cpu_env.threads), (8, 1))
+
+        io_env = uwsgi_profiles.load_uwsgi_environments(environment_config(profile='io', cores=8))['prod']
+        self.assertEqual((io_env.processes, io_env.threads), (4, 16))
+
+        mixed_env = uwsgi_profiles.load_uwsgi_environments(environment_config(cores=8))['prod']
+        self.assertEqual(mixed_env.profile.name, uwsgi_profiles.DEFAULT_PROFILE)
+        self.assertEqual((mixed_env.processes, mixed_env.threads), (8, 4))
+        self.assertTrue(mixed_env.thunder_lock)
+        self.assertEqual(mixed_env.cheaper, 2)
+
+
+    def test_environment_settings_should_override_the_profile(self):
+        uwsgi_env = uwsgi_profiles.load_uwsgi_environments(environment_config(profile='cpu',
+                                                                              cores=8,
+                                                                              processes=3,
+                                                                              harakiri=0,
+                                                                              lazy_apps=True))['prod']
+        self.assertEqual(uwsgi_env.processes, 3)
+        self.assertEqual(uwsgi_env.harakiri, 0)
+        self.assertTrue(uwsgi_env.lazy_apps)
+
+
+    def test_the_core_count_should_default_to_the_host(self):
+        uwsgi_env = uwsgi_profiles.load_uwsgi_environments(environment_config(profile='cpu'))['prod']
+        self.assertEqual(uwsgi_env.cores, uwsgi_profiles.host_core_count())
+        self.assertGreaterEqual(uwsgi_env.processes, 1)
+
+
+    def test_invalid_settings_should_be_rejected(self):
+        with self.assertRaises(uwsgi_profiles.UnknownProfileException):
+            uwsgi_profiles.load_uwsgi_environments(environment_config(profile='gpu'))
+        with self.assertRaises(uwsgi_profiles.InvalidUWSGISettingException):
+            uwsgi_profiles.load_uwsgi_environments(environment_config(threads='many'))
+        with self.assertRaises(uwsgi_profiles.InvalidUWSGISettingException):
+            uwsgi_profiles.load_uwsgi_environments(environment_config(processes=2, cheaper=2))
+
+
+    def test_uwsgi_template_should_render_the_profile_settings(self):
+        uwsgi_env = uwsgi_profiles.load_uwsgi_environments(environment_config(cores=4, offload_threads=0))['prod']
+        j2env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+        initfile = j2env.from_string(config_templates.UWSGI).render(uwsgi_config=uwsgi_env)
+        settings = dict(line.split(' = ', 1) for line in initfile.splitlines() if ' = ' in line and not line.startswith('#'))
+        self.assertEqual(settings['processes'], '4')
+        self.assertEqual(settings['threads'], '4')
+        self.assertEqual(settings['thunder-lock'], 'true')
+        self.assertEqual(settings['max-requests'], '10000')
+        self.assertEqual(settings['cheaper'], '1')
+        self.assertNotIn('offload-threads', settings)
+        self.assertNotIn('lazy-apps', settings)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
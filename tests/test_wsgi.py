@@ -0,0 +1,202 @@
+import unittest
+import os
+import io
+import importlib
+import json
+import subprocess
+import sys
+from context import snap
+from snap import core, runtime, wsgi
+
+
+GENERATED_WSGI_MODULE = 'test_wsgi_app'
+GENERATED_OPTIMIZED_WSGI_MODULE = 'test_optimized_wsgi_app'
+
+
+def call_wsgi(app, method, path, body=b'', headers=None, query_string=''):
+    environ = {'REQUEST_METHOD': method,
+               'PATH_INFO': path,
+               'QUERY_STRING': query_string,
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body)}
+    for name, value in (headers or {}).items():
+        environ[wsgi.environ_key(name)] = value
+    started = []
+
+    def start_response(status, header_list):
+        started.append((status, dict(header_list)))
+
+    response_body = b''.join(app(environ, start_response))
+    status, response_headers = started[0]
+    return int(status.split()[0]), response_headers, response_body
+
+
+class WSGIApplicationTest(unittest.TestCase):
+    module_name = GENERATED_WSGI_MODULE
+
+    @classmethod
+    def setUpClass(cls):
+        project_home = os.getenv('SNAP_TEST_HOME')
+        if not project_home:
+            raise Exception('the environment variable SNAP_TEST_HOME has not been set.')
+        os.environ['SNAP_CONFIG'] = os.path.join(project_home, '..', 'data', 'good_sample_config.yaml')
+        cls.app_module = importlib.import_module(cls.module_name)
+
+
+    def test_generated_wsgi_app_should_serve_get_transforms(self):
+        status, headers, body = call_wsgi(self.app_module.app, 'GET', '/ping')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(body), {'message': 'pong'})
+
+
+    def test_cache_miss_should_answer_matching_etag_with_304(self):
+        status, headers, body = call_wsgi(self.app_module.app, 'GET', '/ping')
+        etag = headers['ETag']
+        self.app_module.xformer.response_cache('ping').clear()
+
+        status, headers, body = call_wsgi(self.app_module.app, 'GET', '/ping', headers={'If-None-Match': etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(headers['ETag'], etag)
+        # max-age is the time the new entry has left, which is at most the transform's ttl of 30s
+        self.assertIn(headers['Cache-Control'], ['max-age=29', 'max-age=30'])
+
+
+    def test_generated_wsgi_app_should_decode_post_content(self):
+        status, headers, body = call_wsgi(self.app_module.app,
+                                          'POST',
+                                          '/posttest',
+                                          body=json.dumps({'placeholder': 'value'}).encode(),
+                                          headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 200)
+        self.assertIn('test_decoder_called', json.loads(body))
+
+
+    def test_generated_wsgi_app_should_reject_noncompliant_input(self):
+        status, headers, body = call_wsgi(self.app_module.app,
+                                          'POST',
+                                          '/posttest',
+                                          body=json.dumps({'foo': 'bar'}).encode(),
+                                          headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 400)
+
+
+    def test_generated_wsgi_app_should_stream_generator_output(self):
+        status, headers, body = call_wsgi(self.app_module.app, 'GET', '/streamexport', query_string='count=250&format=ndjson')
+        self.assertEqual(status, 200)
+        lines = body.decode().splitlines()
+        self.assertEqual(len(lines), 250)
+        self.assertEqual(json.loads(lines[-1]), {'id': 249})
+
+
+    def test_streamed_response_should_hold_its_admission_permit_until_closed(self):
+        xformer = self.app_module.xformer
+        environ = {'REQUEST_METHOD': 'GET',
+                   'PATH_INFO': '/streamexport',
+                   'QUERY_STRING': 'count=10',
+                   'wsgi.input': io.BytesIO(b'')}
+        response = self.app_module.app(environ, lambda status, header_list: None)
+        self.assertEqual(xformer.admission_stats()['stream_export']['in_flight'], 1)
+        next(response)
+        # the client went away: the server closes the response without reading the rest
+        response.close()
+        self.assertEqual(xformer.admission_stats()['stream_export']['in_flight'], 0)
+
+
+    def test_generated_wsgi_app_should_answer_unknown_routes_and_methods(self):
+        status, headers, body = call_wsgi(self.app_module.app, 'GET', '/no/such/route')
+        self.assertEqual(status, 404)
+        status, headers, body = call_wsgi(self.app_module.app, 'DELETE', '/ping')
+        self.assertEqual(status, 405)
+
+
+class OptimizedWSGIApplicationTest(WSGIApplicationTest):
+    '''Runs the same tests against the app generated by "routegen --target=wsgi --optimize".'''
+    module_name = GENERATED_OPTIMIZED_WSGI_MODULE
+
+
+class WSGIRuntimeTest(unittest.TestCase):
+
+    def test_native_runtimes_should_not_import_flask(self):
+        # in a fresh interpreter, since the Flask app tests have already imported it here
+        script = 'import sys, snap.wsgi, snap.asgi; print(sorted(m for m in ("flask", "werkzeug", "jinja2") if m in sys.modules))'
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        self.assertEqual(output.decode().strip(), '[]')
+
+
+    def test_route_variables_should_be_converted_and_passed_to_the_handler(self):
+        app = wsgi.WSGIApplication(__name__)
+
+        @app.route('/widget/<int:widget_id>/<string:part>', methods=['GET'])
+        def widget(request, widget_id, part):
+            return runtime.Response(json.dumps({'id': widget_id, 'part': part, 'q': request.args.get('q')}),
+                                    mimetype=core.MIMETYPE_JSON)
+
+        status, headers, body = call_wsgi(app, 'GET', '/widget/42/handle', query_string='q=x')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'id': 42, 'part': 'handle', 'q': 'x'})
+        self.assertEqual(call_wsgi(app, 'GET', '/widget/abc/handle')[0], 404)
+
+
+    def test_chunked_request_bodies_should_be_read_to_the_end(self):
+        app = wsgi.WSGIApplication(__name__)
+
+        @app.route('/echo', methods=['POST'])
+        def echo(request):
+            return runtime.Response(request.data, mimetype=core.MIMETYPE_JSON)
+
+        body = json.dumps({'id': 1}).encode()
+        environ = {'REQUEST_METHOD': 'POST',
+                   'PATH_INFO': '/echo',
+                   'wsgi.input': io.BytesIO(body),
+                   'wsgi.input_terminated': True}
+        started = []
+        response_body = b''.join(app(environ, lambda status, headers: started.append(status)))
+        self.assertEqual(started, ['200 OK'])
+        self.assertEqual(response_body, body)
+
+
+    def test_request_body_should_be_streamed_rather_than_read_before_dispatch(self):
+        app = wsgi.WSGIApplication(__name__)
+        body = b''.join(json.dumps({'id': i}).encode() + b'\n' for i in range(100))
+        wsgi_input = io.BytesIO(body + b'trailing bytes beyond the content length')
+        positions = []
+
+        @app.route('/ingest', methods=['POST'])
+        def ingest(request):
+            positions.append(wsgi_input.tell())
+            ids = []
+            for line in request.stream:
+                positions.append(wsgi_input.tell())
+                ids.append(json.loads(line)['id'])
+            return runtime.Response(json.dumps(ids), mimetype=core.MIMETYPE_JSON)
+
+        environ = {'REQUEST_METHOD': 'POST',
+                   'PATH_INFO': '/ingest',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': wsgi_input}
+        response_body = b''.join(app(environ, lambda status, headers: None))
+        self.assertEqual(json.loads(response_body), list(range(100)))
+        self.assertEqual(positions[0], 0)
+        self.assertLess(positions[1], len(body))
+        # nothing past the declared body is read
+        self.assertEqual(positions[-1], len(body))
+
+
+    def test_environ_headers_should_be_case_insensitive(self):
+        headers = wsgi.EnvironHeaders({'CONTENT_TYPE': 'application/json',
+                                       'CONTENT_LENGTH': '',
+                                       'HTTP_X_REQUEST_TIMEOUT_MS': '250',
+                                       'PATH_INFO': '/'})
+        self.assertEqual(headers['content-type'], 'application/json')
+        self.assertEqual(headers.get(core.REQUEST_TIMEOUT_HEADER), '250')
+        self.assertNotIn('Accept', headers)
+        self.assertEqual(dict(headers.items()), {'Content-Type': 'application/json', 'X-Request-Timeout-Ms': '250'})
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -17,4 +17,19 @@ def post_validator_func(input_data, service_objects, **kwargs):
     return core.TransformStatus(json.dumps({'message': 'called test validator function'}))
 
 def custom_validator_func(input_data, service_objects, **kwargs):
-    return core.TransformStatus(json.dumps(input_data))
\ No newline at end of file
+    return core.TransformStatus(json.dumps(input_data))
+
+def stream_sum_func(input_data, service_objects, **kwargs):
+    count = 0
+    total = 0
+    for record in kwargs['records']:
+        count += 1
+        total += int(record['value'])
+    return core.TransformStatus(json.dumps({'count': count, 'total': total}))
+
+def stream_export_func(input_data, service_objects, **kwargs):
+    records = ({'id': i} for i in range(int(input_data.get('count', 10))))
+    if input_data.get('format') == 'ndjson':
+        return core.TransformStatus(core.stream_ndjson(records))
+    return core.TransformStatus(core.stream_json_array(records))
+